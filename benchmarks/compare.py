@@ -0,0 +1,49 @@
+"""
+Compare two benchmark suite results, e.g. of two commits.
+
+    python benchmarks/compare.py before.json after.json
+"""
+
+import argparse
+import json
+
+
+def key(result):
+    return result["name"], json.dumps(result["params"], sort_keys=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("before")
+    parser.add_argument("after")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=1.1,
+        help="slowdown ratio of the medians reported as a regression",
+    )
+    args = parser.parse_args()
+
+    with open(args.before) as f:
+        before = {key(result): result for result in json.load(f)["results"]}
+    with open(args.after) as f:
+        after = {key(result): result for result in json.load(f)["results"]}
+
+    regressions = 0
+    for name, params in sorted(set(before) & set(after)):
+        old = before[(name, params)]["median"]
+        new = after[(name, params)]["median"]
+        ratio = new / old if old else float("inf")
+        flag = ""
+        if ratio > args.threshold:
+            flag = "  REGRESSION"
+            regressions += 1
+        print(
+            f"{name:24} {params:40} {old * 1000:10.1f} ms {new * 1000:10.1f} ms"
+            f" {ratio:6.2f}x{flag}"
+        )
+    raise SystemExit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
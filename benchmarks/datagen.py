@@ -0,0 +1,290 @@
+"""
+Synthetic study data with the shape of the production data: seeds csv,
+participants recruited in waves, surveys and consents.
+
+    PYTHONPATH=src python benchmarks/datagen.py --seeds 100000 --out-dir data
+"""
+
+import argparse
+import csv
+import io
+import os
+import random
+from datetime import datetime, timedelta
+
+from bson import json_util
+
+SEED_COLUMNS = [
+    "MRN",
+    "PAT_NAME",
+    "PAT_AGE",
+    "PAT_SEX",
+    "RACE",
+    "ETHNIC_GROUP",
+    "LANGUAGE",
+    "EMAIL_ADDRESS",
+    "MOBILE_NUM",
+    "HOME_NUM",
+    "ADD_LINE_1",
+    "CITY",
+    "STATE",
+    "ZIP",
+    "ORDER_TYPE",
+    "TEST_NAME",
+    "TEST_RESULT",
+    "SPECIMN_TAKEN_DATE",
+    "SPECIMEN_SOURCE",
+    "RESULT_DATE",
+    "ENC_TYPE",
+    "DEPARTMENT",
+]
+RACES = ["White", "Black or African American", "Asian", "Other", "2 or more races"]
+ETHNIC_GROUPS = ["Hispanic Mexican", "Hispanic Other", "Not Hispanic/Latino"]
+FIRST_NAMES = ["Ana", "José", "Li", "Sam", "Maria", "John", "Aisha", "Wei"]
+LAST_NAMES = ["Smith", "Núñez", "Nguyen", "Okafor", "Garcia", "Brown", "Kim"]
+DATE_FORMAT = "%m/%d/%Y %I:%M:%S %p"
+
+
+def seed_rows(count, start=0, rng=None, now=None):
+    """
+    :return: list of seed csv rows as dicts, MRNs start..start+count
+    """
+    rng = rng or random.Random(start)
+    now = now or datetime.now()
+    rows = []
+    for i in range(start, start + count):
+        result_date = now - timedelta(minutes=rng.randrange(60 * 24 * 60))
+        taken_date = result_date - timedelta(hours=rng.randrange(1, 48))
+        phone = f"{rng.randrange(200, 999)}-555-{i % 10000:04d}"
+        rows.append(
+            {
+                "MRN": f"MRN{i:08d}",
+                "PAT_NAME": f"{rng.choice(LAST_NAMES)},{rng.choice(FIRST_NAMES)}",
+                "PAT_AGE": rng.randrange(18, 95),
+                "PAT_SEX": rng.choice(["Male", "Female"]),
+                "RACE": rng.choice(RACES),
+                "ETHNIC_GROUP": rng.choice(ETHNIC_GROUPS),
+                "LANGUAGE": rng.choice(["English", "Spanish"]),
+                # some seeds have no usable email and are excluded
+                "EMAIL_ADDRESS": (
+                    f"MRN{i:08d}@duketest.com" if rng.random() > 0.05 else ""
+                ),
+                "MOBILE_NUM": phone,
+                "HOME_NUM": phone,
+                "ADD_LINE_1": f"{rng.randrange(1, 9999)} Main Street",
+                "CITY": "DURHAM",
+                "STATE": "North Carolina",
+                "ZIP": f"27{rng.randrange(700, 799)}",
+                "ORDER_TYPE": "Microbiology",
+                "TEST_NAME": "CORONAVIRUS (COVID-19) SARS-COV-2 (BKR)",
+                "TEST_RESULT": rng.choice(["DETECTED", "NOT DETECTED"]),
+                "SPECIMN_TAKEN_DATE": taken_date.strftime(DATE_FORMAT),
+                "SPECIMEN_SOURCE": "Nasopharyngeal Swab",
+                "RESULT_DATE": result_date.strftime(DATE_FORMAT),
+                "ENC_TYPE": rng.choice(["Office Visit", "Hospital Encounter"]),
+                "DEPARTMENT": "DUKE URGENT CARE SOUTH",
+            }
+        )
+    return rows
+
+
+def write_seeds_csv(f, rows):
+    writer = csv.DictWriter(f, SEED_COLUMNS, lineterminator="\n")
+    writer.writeheader()
+    writer.writerows(rows)
+
+
+def seeds_csv(count, start=0, rng=None):
+    """
+    :return: seeds csv file content as bytes
+    """
+    out = io.StringIO()
+    write_seeds_csv(out, seed_rows(count, start, rng))
+    return out.getvalue().encode("utf-8")
+
+
+def study(
+    seeds,
+    waves=3,
+    coupons=3,
+    include_rate=0.3,
+    redeem_rate=0.6,
+    survey_rate=0.8,
+    rng=None,
+    now=None,
+):
+    """
+    Recruitment of a study: a seeds csv, the included seeds as wave 0 and
+    waves of peers invited through coupons (PARENT_RECORD_ID) by the
+    participants who completed the survey. Peers that were not redeemed keep
+    an open coupon.
+    :return: dict of seeds (csv rows), participants, surveys, consents and
+        CRM comments
+    """
+    rng = rng or random.Random(0)
+    now = now or datetime.now()
+    rows = seed_rows(seeds, rng=rng, now=now)
+    participants, surveys, consents, comments = [], [], [], []
+    record_id = 0
+
+    def add(doc, issued):
+        nonlocal record_id
+        record_id += 1
+        first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+        comment = {
+            "time": issued.strftime("%Y-%m-%dT%H:%M:%S"),
+            "comment": f"Successfully sent coupon Coupon-{record_id:08d}"
+            f" to participant{record_id}@duketest.com",
+        }
+        comments.append({**comment, "RECORD_ID": record_id})
+        doc.update(
+            {
+                "_id": str(record_id).zfill(8),
+                "RECORD_ID": record_id,
+                "FIRST_NAME": doc.get("FIRST_NAME", first),
+                "LAST_NAME": doc.get("LAST_NAME", last),
+                "PAT_AGE": doc.get("PAT_AGE", rng.randrange(18, 95)),
+                "PAT_SEX": doc.get("PAT_SEX", rng.choice(["Male", "Female"])),
+                "RACE": doc.get("RACE", rng.choice(RACES)),
+                "ETHNIC_GROUP": doc.get("ETHNIC_GROUP", rng.choice(ETHNIC_GROUPS)),
+                "EMAIL_ADDRESS": doc.get(
+                    "EMAIL_ADDRESS", f"participant{record_id}@duketest.com"
+                ),
+                "MOBILE_NUM": f"919-555-{record_id % 10000:04d}",
+                "PREFERRED_COMMUNICATION": "Email",
+                "COUPON": f"Coupon-{record_id:08d}",
+                "COUPON_ISSUE_DATE": issued,
+                "NUM_COUPONS": coupons,
+                "CREATED_AT": issued,
+                # summary of the latest CRM comments
+                "comments": [comment],
+            }
+        )
+        doc["PAT_NAME"] = f"{doc['LAST_NAME']},{doc['FIRST_NAME']}"
+        participants.append(doc)
+        return doc
+
+    def enroll(doc):
+        # redeem, consent and survey, then name contacts
+        if rng.random() > redeem_rate:
+            return False
+        issued = doc["COUPON_ISSUE_DATE"]
+        doc["COUPON_REDEEM_DATE"] = issued + timedelta(hours=rng.randrange(1, 48))
+        doc["CONSENT_DATE"] = doc["COUPON_REDEEM_DATE"] + timedelta(minutes=10)
+        consents.append(
+            {
+                "_id": doc["_id"],
+                "RECORD_ID": doc["RECORD_ID"],
+                "CONSENTED": "Y",
+                "firstName": doc["FIRST_NAME"],
+                "lastName": doc["LAST_NAME"],
+                "CREATED_AT": doc["CONSENT_DATE"],
+            }
+        )
+        if rng.random() > survey_rate:
+            return False
+        doc["SURVEY_COMPLETION_DATE"] = doc["CONSENT_DATE"] + timedelta(minutes=20)
+        surveys.append(
+            {
+                "_id": doc["_id"],
+                "RECORD_ID": doc["RECORD_ID"],
+                "preferred_communication": "Email",
+                "age": doc["PAT_AGE"],
+                "gender": doc["PAT_SEX"],
+                "ethnic": doc["ETHNIC_GROUP"],
+                "language": rng.choice(["English", "Spanish"]),
+                "zip": f"27{rng.randrange(700, 799)}",
+                "completed": True,
+                "CREATED_AT": doc["SURVEY_COMPLETION_DATE"],
+            }
+        )
+        doc["contacts"] = [
+            {
+                "CONTACT_ID": str(c + 1).zfill(3),
+                "FIRST_NAME": rng.choice(FIRST_NAMES),
+                "LAST_NAME": rng.choice(LAST_NAMES),
+            }
+            for c in range(rng.randrange(1, coupons + 1))
+        ]
+        doc["ENROLLMENT_COMPLETED_DATE"] = doc["SURVEY_COMPLETION_DATE"]
+        return True
+
+    wave = []
+    for row in rows:
+        if rng.random() > include_rate:
+            continue
+        result_date = datetime.strptime(row["RESULT_DATE"], DATE_FORMAT)
+        first, last = row["PAT_NAME"].split(",")[::-1]
+        doc = add(
+            {
+                "PTYPE": "seed",
+                "MRN": row["MRN"],
+                "FIRST_NAME": first,
+                "LAST_NAME": last,
+                "PAT_AGE": row["PAT_AGE"],
+                "PAT_SEX": row["PAT_SEX"],
+                "RACE": row["RACE"],
+                "ETHNIC_GROUP": row["ETHNIC_GROUP"],
+                "STATUS": "INCLUDE",
+                "TEST_RESULT": row["TEST_RESULT"],
+                "RESULT_DATE": result_date,
+                "REPORT_DATE": result_date + timedelta(hours=12),
+            },
+            result_date + timedelta(days=1),
+        )
+        if enroll(doc):
+            wave.append(doc)
+
+    for _ in range(waves):
+        next_wave = []
+        for parent in wave:
+            invited = min(coupons, len(parent["contacts"]))
+            issued = parent["SURVEY_COMPLETION_DATE"] + timedelta(hours=1)
+            peers = [
+                add({"PTYPE": "peer", "PARENT_RECORD_ID": parent["RECORD_ID"]}, issued)
+                for _ in range(invited)
+            ]
+            parent["peer-coupons"] = [
+                {"RECORD_ID": peer["RECORD_ID"], "COUPON": peer["COUPON"]}
+                for peer in peers
+            ]
+            parent["COUPON_SENT"] = invited
+            next_wave += [peer for peer in peers if enroll(peer)]
+        wave = next_wave
+
+    return {
+        "seeds": rows,
+        "participants": participants,
+        "surveys": surveys,
+        "consents": consents,
+        "comments": comments,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--seeds", type=int, default=10000)
+    parser.add_argument("--waves", type=int, default=3)
+    parser.add_argument("--coupons", type=int, default=3)
+    parser.add_argument("--random-seed", type=int, default=0)
+    parser.add_argument("--out-dir", default=".")
+    args = parser.parse_args()
+
+    data = study(
+        args.seeds, args.waves, args.coupons, rng=random.Random(args.random_seed)
+    )
+    os.makedirs(args.out_dir, exist_ok=True)
+    with open(os.path.join(args.out_dir, "seeds.csv"), "w") as f:
+        write_seeds_csv(f, data["seeds"])
+    # mongoimport --jsonArray
+    for name in ("participants", "surveys", "consents", "comments"):
+        with open(os.path.join(args.out_dir, f"{name}.json"), "w") as f:
+            f.write(json_util.dumps(data[name]))
+    print(
+        f"{len(data['seeds'])} seeds, {len(data['participants'])} participants, "
+        f"{len(data['surveys'])} surveys written to {args.out_dir}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+Encode time of a large seed report with the stdlib and the orjson encoder.
+
+    PYTHONPATH=src python benchmarks/json_encode.py --rows 50000
+"""
+
+import argparse
+import random
+import time
+from datetime import datetime, timedelta
+
+from flask import Flask, jsonify
+
+from app import json_encoder
+from app.config import ProdConfig
+
+
+def seed_report(rows):
+    rng = random.Random(0)
+    start = datetime(2021, 1, 1)
+    records = []
+    for i in range(rows):
+        result_date = start + timedelta(minutes=rng.randrange(500000))
+        # seeds of one csv upload share their report date
+        report_date = start + timedelta(days=i // 500)
+        records.append(
+            {
+                "MRN": f"MRN{i:07d}",
+                "RECORD_ID": i,
+                "FIRST_NAME": rng.choice(["Ana", "José", "Li", "Sam"]),
+                "LAST_NAME": rng.choice(["Smith", "Núñez", "Nguyen", "Okafor"]),
+                "EMAIL_ADDRESS": f"seed{i}@duketest.com",
+                "MOBILE_NUM": f"919-555-{i % 10000:04d}",
+                "PAT_AGE": rng.randrange(18, 90),
+                "PAT_SEX": rng.choice(["Male", "Female"]),
+                "RACE": "Other",
+                "ETHNIC_GROUP": "Hispanic Mexican",
+                "STATUS": rng.choice(["ELIGIBLE", "DEFER", "EXCLUDE"]),
+                "TEST_RESULT": "Positive",
+                "RESULT_DATE": result_date,
+                "REPORT_DATE": report_date,
+                "COUPON_ISSUE_DATE": result_date + timedelta(days=2),
+            }
+        )
+    return {"reason": "success", "records": records, "result": rows}
+
+
+def best_of(repeat, func):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=50000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    app.config.from_object(ProdConfig)
+    app.json_encoder = json_encoder.JSONEncoder
+    data = seed_report(args.rows)
+    with app.app_context():
+        stdlib = best_of(args.repeat, lambda: jsonify(data))
+        fast = best_of(args.repeat, lambda: json_encoder.make_json_response(data))
+        identical = (
+            jsonify(data).get_data() == json_encoder.make_json_response(data).get_data()
+        )
+    print(f"rows: {args.rows}")
+    print(f"stdlib: {stdlib * 1000:.1f} ms")
+    print(f"orjson: {fast * 1000:.1f} ms ({stdlib / fast:.1f}x)")
+    print(f"identical output: {identical}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,304 @@
+"""
+Multi user load scenario: staff users refreshing the dashboards and adding
+CRM comments while participants redeem their coupon, consent, take the
+survey and name their contacts. Reports p50/p95/p99 latency per endpoint.
+
+    PYTHONPATH=src python benchmarks/loadtest.py --mongo mock --duration 30
+    PYTHONPATH=src python benchmarks/loadtest.py \
+        --mongo mongodb://localhost:27017 --url http://localhost:8000
+
+The study is generated and loaded into --db before the run. With --url the
+requests go to a running server, which must use the same mongo database,
+otherwise the app is driven in process. mongomock is not thread safe, so
+with --mongo mock the requests of all users are served one at a time.
+"""
+
+import argparse
+import io
+import json
+import math
+import queue
+import random
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import nullcontext
+
+import datagen
+import requests
+from suite import check, create_benchmark_app, git_commit
+
+
+class TestClient(object):
+    # the app in process through the flask test client
+    def __init__(self, app, lock=None):
+        self.client = app.test_client()
+        self.lock = lock or nullcontext()
+
+    def get(self, url):
+        with self.lock:
+            response = self.client.get(url)
+            return response.status_code, response.get_json(silent=True)
+
+    def post(self, url, json=None, data=None):
+        with self.lock:
+            response = self.client.post(url, json=json, data=data)
+            return response.status_code, response.get_json(silent=True)
+
+
+class HttpClient(object):
+    # a running server, one session and connection per user
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip("/")
+        self.session = requests.Session()
+
+    def get(self, url):
+        response = self.session.get(self.base_url + url)
+        return response.status_code, _json(response)
+
+    def post(self, url, json=None, data=None):
+        response = self.session.post(self.base_url + url, json=json, data=data)
+        return response.status_code, _json(response)
+
+
+def _json(response):
+    try:
+        return response.json()
+    except ValueError:
+        return None
+
+
+class Recorder(object):
+    def __init__(self):
+        self.seconds = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.lock = threading.Lock()
+
+    def call(self, name, func, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            status_code, body = func(*args, **kwargs)
+        except requests.RequestException:
+            status_code, body = None, None
+        elapsed = time.perf_counter() - start
+        with self.lock:
+            self.seconds[name].append(elapsed)
+            if status_code is None or status_code >= 400:
+                self.errors[name] += 1
+        return body
+
+    def report(self, duration):
+        results = []
+        for name, seconds in sorted(self.seconds.items()):
+            ordered = sorted(seconds)
+            results.append(
+                {
+                    "name": name,
+                    "count": len(ordered),
+                    "errors": self.errors[name],
+                    "per_second": len(ordered) / duration,
+                    "mean": sum(ordered) / len(ordered),
+                    "p50": percentile(ordered, 50),
+                    "p95": percentile(ordered, 95),
+                    "p99": percentile(ordered, 99),
+                    "max": ordered[-1],
+                }
+            )
+        return results
+
+
+def percentile(ordered, p):
+    # nearest rank
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+def staff_user(client, recorder, stop, rng, record_ids, think):
+    while not stop.is_set():
+        action = rng.choices(
+            ["seedreport", "cohort", "testschedule", "contacts", "crm", "comment"],
+            weights=[4, 4, 2, 2, 2, 1],
+        )[0]
+        if action == "seedreport":
+            recorder.call(
+                "GET /api/seedreport", client.get, "/api/seedreport?limit=100"
+            )
+        elif action == "cohort":
+            recorder.call("GET /api/cohort", client.get, "/api/cohort?limit=100")
+        elif action == "testschedule":
+            recorder.call("GET /api/testschedule", client.get, "/api/testschedule")
+        elif action == "contacts":
+            url = "/api/participants?contacts=y&limit=100"
+            recorder.call("GET /api/participants", client.get, url)
+        elif action == "crm":
+            url = f"/api/crm?record_id={rng.choice(record_ids)}"
+            recorder.call("GET /api/crm", client.get, url)
+        else:
+            comment = {
+                "RECORD_ID": rng.choice(record_ids),
+                "comment": "Called participant, left a voicemail",
+            }
+            recorder.call("POST /api/crm", client.post, "/api/crm", json=comment)
+        stop.wait(rng.uniform(0, think))
+
+
+def participant_user(client, recorder, stop, rng, coupons, think):
+    while not stop.is_set():
+        try:
+            coupon = coupons.get_nowait()
+        except queue.Empty:
+            return
+        body = recorder.call(
+            "GET /api/redeem", client.get, f"/api/redeem?coupon={coupon}"
+        )
+        if not body or not body.get("records"):
+            continue
+        record_id = body["records"]["RECORD_ID"]
+        steps = [
+            ("POST /api/redeem", "/api/redeem", {"json": {"RECORD_ID": record_id}}),
+            (
+                "POST /api/consent",
+                "/api/consent",
+                {
+                    "data": {
+                        "RECORD_ID": record_id,
+                        "CONSENTED": "Y",
+                        "firstName": "Load",
+                        "lastName": "Test",
+                        "allow": "y",
+                        "confirm": "y",
+                    }
+                },
+            ),
+            (
+                "POST /api/survey",
+                "/api/survey",
+                {
+                    "json": {
+                        "RECORD_ID": record_id,
+                        "preferred_communication": "Email",
+                        "age": rng.randrange(18, 95),
+                        "language": "English",
+                        "completed": True,
+                    }
+                },
+            ),
+            (
+                "POST /api/participants",
+                "/api/participants",
+                {
+                    "json": {
+                        "RECORD_ID": record_id,
+                        "contacts": [
+                            {"FIRST_NAME": "Peer", "LAST_NAME": f"Contact{i}"}
+                            for i in range(rng.randrange(1, 4))
+                        ],
+                        "ENROLLMENT_COMPLETED": "Y",
+                    }
+                },
+            ),
+        ]
+        for name, url, kwargs in steps:
+            if stop.wait(rng.uniform(0, think)):
+                return
+            recorder.call(name, client.post, url, **kwargs)
+
+
+def load_study(app, args):
+    from app import db_utils
+
+    data = datagen.study(args.study_seeds, rng=random.Random(args.random_seed))
+    client = app.test_client()
+    with app.app_context():
+        db_utils.remove_db(args.db)
+        db_utils.create_indexes()
+        content = io.StringIO()
+        datagen.write_seeds_csv(content, data["seeds"])
+        csv_file = io.BytesIO(content.getvalue().encode("utf-8"))
+        check(client.post("/api/uploadcsv", data={"csv": (csv_file, "seeds.csv")}))
+        db_utils.insert_participants(data["participants"])
+        db = db_utils.get_db_handle()
+        for name, coll in (
+            ("surveys", "survey"),
+            ("consents", "consent"),
+            ("comments", "comments"),
+        ):
+            if data[name]:
+                db[app.config["COLLECTIONS"][coll]].insert_many(data[name])
+        db_utils.init_record_id_counter()
+    return data
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--mongo", default="mock", help="mock or a mongodb uri")
+    parser.add_argument("--db", default="snowballgr_benchmark")
+    parser.add_argument("--url", help="base url of a running server")
+    parser.add_argument("--study-seeds", type=int, default=5000)
+    parser.add_argument("--staff", type=int, default=4)
+    parser.add_argument("--participants", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--think", type=float, default=0.5, help="max seconds")
+    parser.add_argument("--random-seed", type=int, default=0)
+    parser.add_argument("--output", help="json file, stdout if not set")
+    args = parser.parse_args()
+
+    app = create_benchmark_app(args)
+    data = load_study(app, args)
+    record_ids = [doc["RECORD_ID"] for doc in data["participants"]]
+    coupons = queue.Queue()
+    for doc in data["participants"]:
+        if "COUPON_REDEEM_DATE" not in doc:
+            coupons.put(doc["COUPON"])
+
+    lock = threading.Lock() if args.mongo == "mock" else None
+    recorder = Recorder()
+    stop = threading.Event()
+    users = []
+    for i in range(args.staff + args.participants):
+        client = HttpClient(args.url) if args.url else TestClient(app, lock)
+        user = staff_user if i < args.staff else participant_user
+        target = record_ids if i < args.staff else coupons
+        rng = random.Random(args.random_seed + i)
+        users.append(
+            threading.Thread(
+                target=user,
+                args=(client, recorder, stop, rng, target, args.think),
+                daemon=True,
+            )
+        )
+    start = time.perf_counter()
+    for user in users:
+        user.start()
+    stop.wait(args.duration)
+    stop.set()
+    for user in users:
+        user.join()
+    duration = time.perf_counter() - start
+
+    results = recorder.report(duration)
+    for result in results:
+        print(
+            f"{result['name']:24} {result['count']:6} req {result['errors']:4} err"
+            f"  p50 {result['p50'] * 1000:8.1f} ms  p95 {result['p95'] * 1000:8.1f} ms"
+            f"  p99 {result['p99'] * 1000:8.1f} ms",
+            file=sys.stderr,
+        )
+    report = {
+        "commit": git_commit(),
+        "mongo": "mock" if args.mongo == "mock" else "mongod",
+        "staff": args.staff,
+        "participants": args.participants,
+        "duration": duration,
+        "study": {name: len(docs) for name, docs in data.items()},
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""
+netId role lookups parsing rbac_config.json on every call, as done before,
+against the in memory role registry.
+
+    PYTHONPATH=src python benchmarks/rbac_lookup.py --users 500
+"""
+
+import argparse
+import json
+import os
+import tempfile
+import timeit
+
+from app.rbac import RoleRegistry
+
+
+def parse_per_call(path, net_id):
+    with open(path) as json_file:
+        access_roles = json.load(json_file)
+    entry = access_roles.get(net_id)
+    return entry.get("role") if entry else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--lookups", type=int, default=10000)
+    args = parser.parse_args()
+
+    roles = {
+        f"net{i:05d}": {"role": "admin" if i % 2 else "viewer"}
+        for i in range(args.users)
+    }
+    roles["roles"] = {"admin": ["seeds", "download"], "viewer": ["seeds"]}
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "rbac_config.json")
+        with open(path, "w") as f:
+            json.dump(roles, f)
+        registry = RoleRegistry()
+        registry.path = path
+        registry.check_interval = 5
+        net_id = f"net{args.users // 2:05d}"
+        assert parse_per_call(path, net_id) == registry.role(net_id)
+
+        n = args.lookups
+        per_call = timeit.timeit(lambda: parse_per_call(path, net_id), number=n)
+        cached = timeit.timeit(lambda: registry.role(net_id), number=n)
+        permission = timeit.timeit(
+            lambda: registry.has_permission(net_id, "download"), number=n
+        )
+    print(f"users: {args.users}, lookups: {n}")
+    print(f"parse per call: {per_call / n * 1e6:.2f} us/lookup")
+    print(f"registry role: {cached / n * 1e6:.2f} us/lookup")
+    print(f"registry permission: {permission / n * 1e6:.2f} us/lookup")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,272 @@
+"""
+Time the hot endpoints against a local mongod or an in memory mongo stand-in
+(mongomock) and write the results as json.
+
+    PYTHONPATH=src python benchmarks/suite.py --mongo mock --output before.json
+    PYTHONPATH=src python benchmarks/suite.py \
+        --mongo mongodb://localhost:27017 --sizes 1000,10000,100000
+
+The app runs in testing mode, so SendGrid and SMS notifications are stubbed.
+Against a mongod the benchmark database (--db) is dropped before the run.
+mongomock runs aggregations in python, so the stand-in only gives numbers
+comparable with other stand-in runs, the download benchmarks are slow there.
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+import datagen
+
+ENV_DEFAULTS = {
+    "SERVICE_APP_ENV": "test",
+    "SERVICE_SESSION_KEY": "benchmark",
+    "SERVICE_MONGODB_URI": "mongodb://localhost:27017",
+    "SERVICE_DB_NAME": "snowballgr_benchmark",
+    "SERVICE_SENDGRID_API_KEY": "benchmark",
+    "SERVICE_SENDGRID_FROM_ADDRESS": "benchmark@duketest.com",
+    "SERVICE_SENDGRID_INVITE_TEMPLATE": "benchmark",
+    "SERVICE_COMMUNICATION_PHONE_NUMBER": "+10000000000",
+    "SERVICE_COMMUNICATION_CONNECTION_STRING": "benchmark",
+}
+
+
+def use_mongomock():
+    # every PyMongo gets the same in memory client
+    try:
+        import mongomock
+        import mongomock.gridfs
+    except ImportError:
+        sys.exit("--mongo mock needs mongomock, pip install mongomock")
+    import flask_pymongo
+
+    mongomock.gridfs.enable_gridfs_integration()
+    client = mongomock.MongoClient()
+
+    def init_app(self, app, uri=None, *args, **kwargs):
+        self.cx = client
+        self.db = client[app.config["MONGODB_NAME"]]
+
+    flask_pymongo.PyMongo.init_app = init_app
+
+
+def create_benchmark_app(args):
+    for key, value in ENV_DEFAULTS.items():
+        os.environ.setdefault(key, value)
+    if args.mongo == "mock":
+        use_mongomock()
+    else:
+        os.environ["SERVICE_MONGODB_URI"] = args.mongo
+
+    from app.app import create_app
+
+    app = create_app("test", testing=True)
+    app.config["MONGODB_NAME"] = args.db
+    # production settings: compact json
+    app.config["DEBUG"] = False
+    return app
+
+
+def summarize(name, params, seconds):
+    ordered = sorted(seconds)
+    return {
+        "name": name,
+        "params": params,
+        "repeat": len(seconds),
+        "seconds": seconds,
+        "min": ordered[0],
+        "median": statistics.median(ordered),
+        "mean": statistics.mean(ordered),
+        "max": ordered[-1],
+    }
+
+
+def measure(name, func, repeat, setup=None, **params):
+    """
+    Time func repeat times, setup runs before each call and is not timed
+    """
+    seconds = []
+    for i in range(repeat):
+        if setup is not None:
+            setup(i)
+        start = time.perf_counter()
+        func(i)
+        seconds.append(time.perf_counter() - start)
+    result = summarize(name, params, seconds)
+    print(
+        f"{name} {params}: median {result['median'] * 1000:.1f} ms, "
+        f"min {result['min'] * 1000:.1f} ms",
+        file=sys.stderr,
+    )
+    return result
+
+
+def check(response):
+    if response.status_code != 200:
+        raise RuntimeError(f"{response.status_code}: {response.get_data()[:500]}")
+    return response
+
+
+def run(app, args):
+    from app import db_utils
+    from app.cache import report_cache
+
+    client = app.test_client()
+    results = []
+
+    def selected(name):
+        return not args.cases or name in args.cases
+
+    with app.app_context():
+        db_utils.remove_db(args.db)
+        db_utils.create_indexes()
+
+        # UploadCSV at each size, into an empty seeds collection every time
+        for size in args.sizes if selected("uploadcsv") else []:
+            content = datagen.seeds_csv(size)
+
+            def upload(i, content=content):
+                data = {"csv": (datagen.io.BytesIO(content), "seeds.csv")}
+                check(client.post("/api/uploadcsv", data=data))
+
+            results.append(
+                measure(
+                    "uploadcsv",
+                    upload,
+                    args.repeat,
+                    setup=lambda i: db_utils.remove_collection("seeds"),
+                    rows=size,
+                )
+            )
+
+        # report queries over the largest upload and the participants
+        participants = datagen.study(args.study_seeds)["participants"]
+        db_utils.insert_participants(participants)
+        db_utils.init_record_id_counter()
+        queries = [
+            ("seedreport", "/api/seedreport"),
+            ("seedreport_page", "/api/seedreport?limit=100"),
+            ("cohort", "/api/cohort"),
+            ("cohort_page", "/api/cohort?limit=100"),
+            ("testschedule", "/api/testschedule"),
+            ("participants_contacts", "/api/participants?contacts=y"),
+        ]
+        for name, url in queries:
+            if not selected(name):
+                continue
+            results.append(
+                measure(
+                    name,
+                    lambda i, url=url: check(client.get(url)),
+                    args.repeat,
+                    # time the queries, not the report cache
+                    setup=lambda i: report_cache.clear(),
+                    seeds=max(args.sizes),
+                    participants=len(participants),
+                )
+            )
+
+        # coupons that can still be redeemed
+        coupons = [
+            doc["COUPON"]
+            for doc in participants
+            if "ENROLLMENT_COMPLETED_DATE" not in doc
+        ]
+        if selected("redeem"):
+            results.append(
+                measure(
+                    "redeem",
+                    lambda i: check(client.get(f"/api/redeem?coupon={coupons[i]}")),
+                    min(args.repeat * 20, len(coupons)),
+                    participants=len(participants),
+                )
+            )
+
+        # every call invites the peers of another participant
+        parents = [doc["RECORD_ID"] for doc in participants if "contacts" in doc]
+        if selected("invitepeer"):
+            results.append(
+                measure(
+                    "invitepeer",
+                    lambda i: check(
+                        client.post("/api/invitepeer", json={"RECORD_ID": parents[i]})
+                    ),
+                    min(args.repeat, len(parents)),
+                    coupons=participants[0]["NUM_COUPONS"],
+                )
+            )
+
+        for coll in ("seeds", "participants"):
+            if not selected(f"download_{coll}"):
+                continue
+            results.append(
+                measure(
+                    f"download_{coll}",
+                    lambda i, coll=coll: check(
+                        client.get(f"/api/download?type={coll}")
+                    ).get_data(),
+                    args.repeat,
+                    seeds=max(args.sizes),
+                    participants=len(participants),
+                )
+            )
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--mongo", default="mock", help="mock or a mongodb uri")
+    parser.add_argument("--db", default="snowballgr_benchmark")
+    parser.add_argument(
+        "--sizes",
+        type=lambda sizes: [int(size) for size in sizes.split(",")],
+        default=[1000, 10000, 100000],
+        help="seeds csv rows per upload",
+    )
+    parser.add_argument(
+        "--study-seeds",
+        type=int,
+        default=10000,
+        help="seeds the participants of the queried study are recruited from",
+    )
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument(
+        "--cases",
+        type=lambda cases: set(cases.split(",")),
+        help="comma separated benchmark names to run, all if not set",
+    )
+    parser.add_argument("--output", help="json file, stdout if not set")
+    args = parser.parse_args()
+
+    app = create_benchmark_app(args)
+    report = {
+        "commit": git_commit(),
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "mongo": "mock" if args.mongo == "mock" else "mongod",
+        "results": run(app, args),
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+
+
+if __name__ == "__main__":
+    main()
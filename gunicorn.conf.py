@@ -0,0 +1,26 @@
+# Server hooks of the app, loaded by gunicorn from the working directory
+import os
+
+from app.config import CONFIGURATIONS
+from app.metrics import metrics
+from app.outbox import outbox
+from app.rbac import role_registry
+
+
+def post_worker_init(worker):
+    # background threads and the SIGHUP reload only run in the workers serving
+    # requests, not in the cli, migrations or the benchmarks
+    outbox.start()
+    role_registry.install_signal_handler()
+
+
+def worker_exit(server, worker):
+    # last requests of the worker, before the master folds its metrics
+    if metrics.directory is not None:
+        metrics.flush()
+
+
+def child_exit(server, worker):
+    # runs in the master, which does not load the app
+    config = CONFIGURATIONS[os.environ["SERVICE_APP_ENV"]]
+    metrics.mark_process_dead(worker.pid, config.METRICS_DIR)
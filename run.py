@@ -1,8 +1,12 @@
 import os
 
 from app.app import create_app
+from app.outbox import outbox
+from app.rbac import role_registry
 
 app = create_app(os.environ['SERVICE_APP_ENV'])
 
 if __name__ == "__main__":
+    outbox.start()
+    role_registry.install_signal_handler()
     app.run(debug=True, port=8000)
@@ -0,0 +1,67 @@
+import click
+from flask import current_app as app
+from flask.cli import with_appcontext
+
+from app import db_utils
+
+# explain stages that read every document or sort the results in memory
+COLLSCAN = "COLLSCAN"
+IN_MEMORY_SORT = "SORT"
+
+
+def plan_stages(plan):
+    """
+    Names of all stages of an explain plan, from the root to the leaves
+    """
+    stages = []
+    while plan:
+        # slot based engine nests the classic plan under queryPlan
+        plan = plan.get("queryPlan", plan)
+        if "stage" in plan:
+            stages.append(plan["stage"])
+        for child in plan.get("inputStages", []):
+            stages += plan_stages(child)
+        plan = plan.get("inputStage")
+    return stages
+
+
+def plan_issues(explain):
+    """
+    :param explain: output of cursor.explain()
+    :return: list of COLLSCAN and SORT if the winning plan has them
+    """
+    stages = plan_stages(explain.get("queryPlanner", {}).get("winningPlan", {}))
+    return [stage for stage in (COLLSCAN, IN_MEMORY_SORT) if stage in stages]
+
+
+def advise(shapes):
+    """
+    Explain the canonical query of each endpoint
+    :return: dict of endpoint to its plan stages and issues
+    """
+    report = {}
+    for name, shape in shapes.items():
+        explain = db_utils.explain_query(
+            shape["collection"], shape["filter"], shape.get("sort")
+        )
+        winning = explain.get("queryPlanner", {}).get("winningPlan", {})
+        report[name] = {"stages": plan_stages(winning), "issues": plan_issues(explain)}
+    return report
+
+
+@click.command("index-advisor")
+@click.option("--create", is_flag=True, help="Create the indexes before explaining")
+@with_appcontext
+def index_advisor(create):
+    """Report endpoint queries that scan the collection or sort in memory."""
+    if create:
+        db_utils.create_indexes()
+    report = advise(app.config["QUERY_SHAPES"])
+    for name, result in report.items():
+        stages = " <- ".join(result["stages"]) or "unknown plan"
+        if result["issues"]:
+            click.echo(f"{name}: {', '.join(result['issues'])} ({stages})")
+        else:
+            click.echo(f"{name}: ok ({stages})")
+    if any(result["issues"] for result in report.values()):
+        raise SystemExit(1)
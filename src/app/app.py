@@ -1,11 +1,29 @@
 from flask import Flask
 from flask_cors import CORS
 
+from app.advisor import index_advisor
+from app.cache import consent_form_cache, report_cache
+from app.compression import compression
 from app.config import CONFIGURATIONS
-from app.db_utils import create_indexes
-from app.resources.admin import Download, DownloadFileFromURL, HealthCheck
-from app.resources.consentform import ConsentForm, ConsentFormHistory
-from app.resources.invite import InvitePeer, SeedStatus
+from app.coupons import coupon_pool
+from app.db_utils import create_indexes, init_record_id_counter
+from app.json_encoder import JSONEncoder
+from app.metrics import metrics
+from app.migrations import migrate_comments, migrate_status_log
+from app.outbox import outbox
+from app.rbac import role_registry
+from app.resources.admin import Download, DownloadFileFromURL, HealthCheck, Metrics
+from app.resources.consentform import (
+    ConsentForm,
+    ConsentFormHistory,
+    ConsentFormPdf,
+)
+from app.resources.invite import (
+    BulkSeedStatus,
+    InvitePeer,
+    SeedStatus,
+    StatusEvents,
+)
 from app.resources.participant import (
     CohortReport,
     Consent,
@@ -15,7 +33,13 @@ from app.resources.participant import (
     Survey,
     TestSchedule,
 )
-from app.resources.seed import AddNewSeed, SeedReport, UpdateSeeds, UploadCSV
+from app.resources.seed import (
+    AddNewSeed,
+    BulkUpdateSeeds,
+    SeedReport,
+    UpdateSeeds,
+    UploadCSV,
+)
 from app.services import api, logger, mongo
 
 
@@ -27,9 +51,12 @@ def register_endpoints(app):
     api.add_resource(HealthCheck, "/healthcheck")
     api.add_resource(SeedReport, "/seedreport")
     api.add_resource(SeedStatus, "/seedstatus")
+    api.add_resource(BulkSeedStatus, "/bulkseedstatus")
+    api.add_resource(StatusEvents, "/statusevents")
     api.add_resource(InvitePeer, "/invitepeer")
     api.add_resource(UploadCSV, "/uploadcsv")
     api.add_resource(UpdateSeeds, "/updateseed")
+    api.add_resource(BulkUpdateSeeds, "/bulkupdateseed")
     api.add_resource(AddNewSeed, "/addseed")
     api.add_resource(ConsentForm, "/consentform")
     api.add_resource(RedeemCoupon, "/redeem")
@@ -42,6 +69,8 @@ def register_endpoints(app):
     api.add_resource(TestSchedule, "/testschedule")
     api.add_resource(DownloadFileFromURL, "/downloadfile")
     api.add_resource(ConsentFormHistory, "/consentformhistory")
+    api.add_resource(ConsentFormPdf, "/consentformpdf")
+    api.add_resource(Metrics, "/metrics")
     logger.info("All endpoints registered!")
 
 
@@ -62,6 +91,7 @@ def create_app(app_env, testing=False):
     app = Flask(__name__)
     app.config.from_object(config)
     app.secret_key = config.SESSION_KEY  # enables flask session
+    app.json_encoder = JSONEncoder
     app.testing = testing  # true for pytest-flask testing env
 
     # Enable CORS.
@@ -70,13 +100,30 @@ def create_app(app_env, testing=False):
     # Attach the api routes.
     register_endpoints(app)
 
-    # Register the app services
-    register_services(app, api, mongo)
+    # Register the app services, metrics before mongo so its command
+    # listener applies to the mongo client, compression after metrics so the
+    # request latency includes it
+    register_services(
+        app,
+        api,
+        metrics,
+        compression,
+        mongo,
+        coupon_pool,
+        outbox,
+        consent_form_cache,
+        report_cache,
+        role_registry,
+    )
     if app_env != "local" and app_env != "test":
         with app.app_context():
             # create indexes in mongo
             create_indexes()
+            init_record_id_counter()
 
+    app.cli.add_command(index_advisor)
+    app.cli.add_command(migrate_comments)
+    app.cli.add_command(migrate_status_log)
     logger.info(f"Configuring app with: {config.__name__}.")
 
     return app
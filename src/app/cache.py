@@ -0,0 +1,161 @@
+import threading
+import time
+from collections import OrderedDict
+
+from bson import json_util
+
+from app.metrics import REPORT_CACHE, metrics
+
+
+class LRUCache(object):
+    """
+    Thread safe least recently used cache, entries optionally expire ttl
+    seconds after they were put
+    """
+
+    def __init__(self, maxsize=128, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if (
+                entry is not None
+                and entry[1] is not None
+                and entry[1] < time.monotonic()
+            ):
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        return entry[0] if entry is not None else None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class ConsentFormCache(object):
+    """
+    Per worker cache of consent form versions. A saved version never changes,
+    but another worker may save a new one, so the current version number is
+    only trusted for CONSENT_FORM_VERSION_TTL seconds.
+    """
+
+    def __init__(self, app=None):
+        self.forms = LRUCache()
+        self.current = LRUCache(maxsize=1)
+        self.max_bytes = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.forms.maxsize = app.config["CONSENT_FORM_CACHE_SIZE"]
+        self.current.ttl = app.config["CONSENT_FORM_VERSION_TTL"]
+        self.max_bytes = app.config["CONSENT_FORM_CACHE_MAX_BYTES"]
+
+    def get(self, version=None):
+        """
+        :param version: form version, current version if None
+        :return: cached form or None
+        """
+        if version is None:
+            version = self.current.get("version")
+            if version is None:
+                return None
+        return self.forms.get(version)
+
+    def put(self, form, current=False):
+        if self.max_bytes is None or len(form["data"]) <= self.max_bytes:
+            self.forms.put(form["version"], form)
+        if current:
+            self.current.put("version", form["version"])
+
+    def invalidate(self):
+        # a new version was saved
+        self.current.clear()
+
+    def clear(self):
+        self.forms.clear()
+        self.current.clear()
+
+
+class ReportCache(object):
+    """
+    Per worker cache of report query results keyed by collection and query.
+    Each collection has a generation number bumped by every write to it, a
+    result loaded before the write is not returned after it. Writes of other
+    workers are only seen through the collection version the reports put in
+    their keys, results are also only trusted for REPORT_CACHE_TTL seconds.
+    """
+
+    def __init__(self, app=None):
+        self.results = LRUCache()
+        self.max_rows = None
+        self._generations = {}
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.results.maxsize = app.config["REPORT_CACHE_SIZE"]
+        self.results.ttl = app.config["REPORT_CACHE_TTL"]
+        self.max_rows = app.config["REPORT_CACHE_MAX_ROWS"]
+
+    def get(self, collection, key, load):
+        """
+        :param collection: name of the queried collection
+        :param key: query and options of the report, json serializable
+        :param load: called to query mongo on a miss
+        :return: result of load, a list of rows or a tuple whose first item
+            is the list of rows
+        """
+        key = (collection, json_util.dumps(key, sort_keys=True))
+        generation = self._generations.get(collection, 0)
+        entry = self.results.get(key)
+        if entry is not None and entry[0] == generation:
+            metrics.inc(REPORT_CACHE, {"collection": collection, "result": "hit"})
+            return entry[1]
+        metrics.inc(REPORT_CACHE, {"collection": collection, "result": "miss"})
+        result = load()
+        rows = result[0] if isinstance(result, tuple) else result
+        if self.max_rows is None or len(rows) <= self.max_rows:
+            self.results.put(key, (generation, result))
+        return result
+
+    def invalidate(self, collection):
+        # a document of the collection was written, called once the write is
+        # done so a result loaded during the write is not kept
+        with self._lock:
+            self._generations[collection] = self._generations.get(collection, 0) + 1
+
+    def clear(self):
+        self.results.clear()
+
+
+consent_form_cache = ConsentFormCache()
+report_cache = ReportCache()
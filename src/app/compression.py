@@ -0,0 +1,129 @@
+import zlib
+
+import brotli
+import zstandard
+from flask import request
+
+
+class GzipCompressor(object):
+    def __init__(self, level):
+        # wbits 31: gzip header and trailer
+        self._obj = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        # flushed so every chunk of a stream can be decoded when it arrives
+        return self._obj.compress(data) + self._obj.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._obj.flush()
+
+
+class BrotliCompressor(object):
+    def __init__(self, level):
+        self._obj = brotli.Compressor(quality=level)
+
+    def compress(self, data):
+        return self._obj.process(data) + self._obj.flush()
+
+    def finish(self):
+        return self._obj.finish()
+
+
+class ZstdCompressor(object):
+    def __init__(self, level):
+        self._obj = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data):
+        return self._obj.compress(data) + self._obj.flush(
+            zstandard.COMPRESSOBJ_FLUSH_BLOCK
+        )
+
+    def finish(self):
+        return self._obj.flush()
+
+
+COMPRESSORS = {"gzip": GzipCompressor, "br": BrotliCompressor, "zstd": ZstdCompressor}
+
+
+class Compression(object):
+    """
+    Compresses responses with the encoding negotiated through Accept-Encoding.
+    Bodies smaller than COMPRESS_MIN_SIZE are sent as is, streamed responses
+    are compressed chunk by chunk.
+    """
+
+    def __init__(self, app=None):
+        self.encodings = []
+        self.min_size = 0
+        self.mimetypes = set()
+        self.levels = {}
+        self.endpoint_levels = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        unknown = set(app.config["COMPRESS_ENCODINGS"]) - set(COMPRESSORS)
+        if unknown:
+            raise ValueError(
+                f"Unsupported COMPRESS_ENCODINGS {sorted(unknown)}, "
+                f"supported are {sorted(COMPRESSORS)}"
+            )
+        self.encodings = list(app.config["COMPRESS_ENCODINGS"])
+        self.min_size = app.config["COMPRESS_MIN_SIZE"]
+        self.mimetypes = set(app.config["COMPRESS_MIMETYPES"])
+        self.levels = app.config["COMPRESS_LEVELS"]
+        self.endpoint_levels = app.config["COMPRESS_ENDPOINT_LEVELS"]
+        app.after_request(self._after_request)
+
+    def level(self, endpoint, encoding):
+        levels = self.endpoint_levels.get(endpoint, {})
+        return levels.get(encoding, self.levels[encoding])
+
+    def _after_request(self, response):
+        if (
+            not self.encodings
+            or response.mimetype not in self.mimetypes
+            or response.status_code != 200
+            or request.method == "HEAD"
+            or "Content-Encoding" in response.headers
+            or response.direct_passthrough
+        ):
+            return response
+        # the body depends on the request header, also when not compressed
+        response.vary.add("Accept-Encoding")
+        streamed = response.is_streamed
+        if not streamed and response.content_length < self.min_size:
+            return response
+        encoding = request.accept_encodings.best_match(self.encodings)
+        if encoding is None:
+            return response
+
+        compressor = COMPRESSORS[encoding](self.level(request.endpoint, encoding))
+        if streamed:
+            chunks = response.iter_encoded()
+            response.response = _compress_stream(chunks, compressor, response.response)
+            response.headers.pop("Content-Length", None)
+        else:
+            data = response.get_data()
+            response.set_data(compressor.compress(data) + compressor.finish())
+        response.headers["Content-Encoding"] = encoding
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            # the compressed body is not byte for byte the same representation
+            response.set_etag(etag, weak=True)
+        return response
+
+
+def _compress_stream(chunks, compressor, source):
+    try:
+        for chunk in chunks:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.finish()
+    finally:
+        if hasattr(source, "close"):
+            source.close()
+
+
+compression = Compression()
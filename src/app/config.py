@@ -1,4 +1,6 @@
 import os
+import tempfile
+from datetime import datetime
 
 from dotenv import load_dotenv
 
@@ -22,17 +24,114 @@ class DefaultConfig(object):
         "consent": "Consent",
         "survey": "Surveys",
         "consentform": "ConsentForm",
+        "counters": "Counters",
+        "outbox": "Outbox",
+        "tombstones": "Tombstones",
+        "comments": "Comments",
+        "status_events": "StatusEvents",
     }
 
     # Lifetime of token (in days) for various states throughout the process
     TTLD_GENERATION_TO_CONSENT = os.getenv("TTLD_GENERATION_TO_CONSENT", "4")
     TTLD_TEST_RESULT = 99999
 
+    # Number of seeds written per insert_many call when uploading seed csv
+    SEED_INSERT_BATCH_SIZE = int(os.getenv("SEED_INSERT_BATCH_SIZE", "1000"))
+    # Number of documents read from mongo per csv chunk in /download
+    DOWNLOAD_BATCH_SIZE = int(os.getenv("DOWNLOAD_BATCH_SIZE", "500"))
+    # Access roles by netId, checked for changes at most every RBAC_CHECK_SECONDS
+    RBAC_CONFIG_PATH = os.getenv(
+        "RBAC_CONFIG_PATH", os.path.join(os.path.dirname(__file__), "rbac_config.json")
+    )
+    RBAC_CHECK_SECONDS = int(os.getenv("RBAC_CHECK_SECONDS", "5"))
+    # Request header with the netId of the signed in user, set by the
+    # authenticating proxy in front of the api, which must drop it from the
+    # client request. REMOTE_USER of the wsgi server is used when it is missing
+    AUTH_USER_HEADER = os.getenv("AUTH_USER_HEADER", "X-Remote-User")
+    # Each worker writes its metrics into METRICS_DIR every METRICS_FLUSH_SECONDS,
+    # /api/metrics adds them up
+    METRICS_DIR = os.getenv(
+        "METRICS_DIR", os.path.join(tempfile.gettempdir(), "snowballgr-metrics")
+    )
+    METRICS_FLUSH_SECONDS = int(os.getenv("METRICS_FLUSH_SECONDS", "5"))
+    METRICS_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+    # orjson or stdlib, encoder of the json responses
+    JSON_ENCODER = os.getenv("JSON_ENCODER", "orjson")
+    # Largest page the report endpoints return when paginated with limit
+    MAX_PAGE_SIZE = int(os.getenv("MAX_PAGE_SIZE", "1000"))
+
+    # Pre-generated coupons kept per worker, refilled in background when the
+    # pool drops below the low water mark
+    COUPON_POOL_SIZE = int(os.getenv("COUPON_POOL_SIZE", "200"))
+    COUPON_POOL_LOW_WATER = int(os.getenv("COUPON_POOL_LOW_WATER", "50"))
+    # Times a participant is inserted again with a new coupon when its coupon
+    # was issued by another worker in between
+    COUPON_INSERT_RETRIES = int(os.getenv("COUPON_INSERT_RETRIES", "3"))
+
+    # Outbox delivery of coupon invitations, failed deliveries are retried
+    # with exponential backoff starting at OUTBOX_BACKOFF_SECONDS
+    OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", "2"))
+    # Messages claimed per round, emails among them go out in one request
+    OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "100"))
+    OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "5"))
+    OUTBOX_BACKOFF_SECONDS = int(os.getenv("OUTBOX_BACKOFF_SECONDS", "30"))
+    OUTBOX_POLL_SECONDS = int(os.getenv("OUTBOX_POLL_SECONDS", "10"))
+    OUTBOX_LEASE_SECONDS = int(os.getenv("OUTBOX_LEASE_SECONDS", "300"))
+    # Days sent and failed messages are kept in the outbox
+    OUTBOX_RETENTION_DAYS = int(os.getenv("OUTBOX_RETENTION_DAYS", "30"))
+
+    # Consent form versions cached per worker, forms larger than max bytes
+    # are streamed from gridfs instead
+    CONSENT_FORM_CACHE_SIZE = int(os.getenv("CONSENT_FORM_CACHE_SIZE", "4"))
+    CONSENT_FORM_CACHE_MAX_BYTES = int(
+        os.getenv("CONSENT_FORM_CACHE_MAX_BYTES", str(10 * 1024 * 1024))
+    )
+    # Seconds a worker trusts its cached current consent form version
+    CONSENT_FORM_VERSION_TTL = int(os.getenv("CONSENT_FORM_VERSION_TTL", "60"))
+
+    # Report query results cached per worker. Writes of the worker invalidate
+    # its cache right away, writes of other workers show after the ttl seconds
+    REPORT_CACHE_SIZE = int(os.getenv("REPORT_CACHE_SIZE", "64"))
+    REPORT_CACHE_TTL = int(os.getenv("REPORT_CACHE_TTL", "30"))
+    # larger results are not cached
+    REPORT_CACHE_MAX_ROWS = int(os.getenv("REPORT_CACHE_MAX_ROWS", "10000"))
+    # CRM comments are kept in their own collection, the participant only
+    # keeps the latest ones as a summary
+    CRM_LATEST_COMMENTS = int(os.getenv("CRM_LATEST_COMMENTS", "5"))
+    # Seeds per bulk seed status or bulk seed update request
+    MAX_BULK_SEED_STATUS = int(os.getenv("MAX_BULK_SEED_STATUS", "1000"))
+    # Days deleted records are remembered for the since sync of the reports,
+    # clients that synced before have to reload everything
+    TOMBSTONE_TTL_DAYS = int(os.getenv("TOMBSTONE_TTL_DAYS", "30"))
+    # Seconds a since is moved back, for writes stamped before the previous
+    # sync but saved after it. Clients may get such records twice
+    SINCE_MARGIN_SECONDS = int(os.getenv("SINCE_MARGIN_SECONDS", "5"))
+    # Report date ranges start at a multiple of this many seconds, so the
+    # queries of repeated refreshes are identical, 0 to not round
+    REPORT_DATE_GRANULARITY = int(os.getenv("REPORT_DATE_GRANULARITY", "60"))
+
+    # Response compression negotiated through Accept-Encoding, encodings in
+    # order of preference, any of gzip, br and zstd
+    COMPRESS_ENCODINGS = [
+        encoding
+        for encoding in os.getenv("COMPRESS_ENCODINGS", "zstd,br,gzip").split(",")
+        if encoding
+    ]
+    # smaller bodies are not worth compressing, streamed ones always are
+    COMPRESS_MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", "1024"))
+    COMPRESS_MIMETYPES = ["application/json", "text/csv", "text/plain", "text/html"]
+    COMPRESS_LEVELS = {"gzip": 6, "br": 4, "zstd": 3}
+    # levels by endpoint, the large csv downloads favour speed
+    COMPRESS_ENDPOINT_LEVELS = {"download": {"gzip": 1, "br": 1, "zstd": 1}}
+
     REACT_APP_UI_ROOT = os.getenv("REACT_APP_UI_ROOT", "http://localhost:3000")
     # Email Settings
     SENDGRID_API_KEY = os.environ["SERVICE_SENDGRID_API_KEY"]
     SENDGRID_FROM_ADDRESS = os.environ["SERVICE_SENDGRID_FROM_ADDRESS"]
     SENDGRID_SEED_TEMPLATE = os.environ["SERVICE_SENDGRID_INVITE_TEMPLATE"]
+    SENDGRID_API_HOST = os.getenv(
+        "SERVICE_SENDGRID_API_HOST", "https://api.sendgrid.com"
+    )
 
     # SMS Settings
     SMS_PHONE_NUMBER = os.environ["SERVICE_COMMUNICATION_PHONE_NUMBER"]
@@ -52,6 +151,8 @@ class DefaultConfig(object):
     HOME_NUM = "HOME_NUM"
     PREFERRED_COMM = "PREFERRED_COMMUNICATION"
     PARTICIPANT_TOKEN = "COUPON"
+    # free text status log of the seeds before status events, see
+    # flask migrate-status-log
     STATUS_LOG = "STATUS_CHANGE_LOG"
     RESULT_DATE = "RESULT_DATE"
     REPORT_DATE = "REPORT_DATE"
@@ -70,6 +171,13 @@ class DefaultConfig(object):
     PEER_COUPONS_LIST = "peer-coupons"
     CREATED_AT = "CREATED_AT"
     UPDATED_AT = "UPDATED_AT"
+    DELETED_AT = "DELETED_AT"
+    CHANGED_AT = "CHANGED_AT"
+    # status events saved with the status change of a seed, moved into the
+    # status events right after
+    PENDING_STATUS_EVENTS = "PENDING_STATUS_EVENTS"
+    CRM_COMMENTS = "comments"
+    CRM_TIME = "time"
     CONSENT_FORM_FILENAME = "consent-form.pdf"
 
     SEED_STATUS_LIST = [
@@ -91,6 +199,8 @@ class DefaultConfig(object):
         "ZIP",
         RESULT_DATE,
         CREATED_AT,
+        UPDATED_AT,
+        f"{PENDING_STATUS_EVENTS}._id",
     ]
     PARTICIPANTS_INDEXES = [
         "MRN",
@@ -107,6 +217,7 @@ class DefaultConfig(object):
         CONSENT_DATE,
         SURVEY_COMPLETION_DATE,
         CREATED_AT,
+        UPDATED_AT,
         TEST_DATE,
     ]
     CONSENT_FORM_INDEXES = [
@@ -120,12 +231,115 @@ class DefaultConfig(object):
     SURVEY_INDEXES = {
         CREATED_AT,
     }
+    # status is covered by the outbox query shape index
+    OUTBOX_INDEXES = [
+        "next_attempt_at",
+    ]
     COLLECTION_INDEXES = {
         "Seeds": SEEDS_INDEXES,
         "Participants": PARTICIPANTS_INDEXES,
         "ConsentForm.files": CONSENT_FORM_INDEXES,
         "Consent": CONSENT_INDEXES,
         "Surveys": SURVEY_INDEXES,
+        "Outbox": OUTBOX_INDEXES,
+    }
+    # Fields with unique values, sparse so docs without the field are allowed
+    UNIQUE_INDEXES = {
+        "Participants": [PARTICIPANT_TOKEN],
+    }
+    # Canonical query of each endpoint with the compound or partial index
+    # serving it, keys ordered equality, sort then range. The filter values
+    # only need the right types, they are used by the index advisor to
+    # explain the query plan.
+    QUERY_SHAPES = {
+        "seedreport": {
+            "collection": "Seeds",
+            "filter": {
+                "STATUS": {"$in": ["ELIGIBLE", "DEFER", "EXCLUDE"]},
+                RESULT_DATE: {"$gte": datetime(2000, 1, 1)},
+            },
+            "sort": [(REPORT_DATE, -1), ("_id", -1)],
+            # _id too, the page sort is only served without a blocking SORT
+            # when the index has all of its keys
+            "index": [
+                ("STATUS", 1),
+                (REPORT_DATE, -1),
+                ("_id", -1),
+                (RESULT_DATE, 1),
+            ],
+        },
+        "cohort": {
+            "collection": "Participants",
+            "filter": {RESULT_DATE: {"$gte": datetime(2000, 1, 1)}},
+            "sort": [(RECORD_ID, 1)],
+        },
+        "testschedule": {
+            "collection": "Participants",
+            "filter": {"PTYPE": "peer", COUPON_REDEEM_DATE: {"$exists": True}},
+            "sort": [(RECORD_ID, 1)],
+            "index": [("PTYPE", 1), (RECORD_ID, 1)],
+            # only redeemed peers are ever listed
+            "options": {
+                "partialFilterExpression": {COUPON_REDEEM_DATE: {"$exists": True}}
+            },
+        },
+        "participants": {
+            "collection": "Participants",
+            "filter": {
+                "contacts": {"$exists": True},
+                SURVEY_COMPLETION_DATE: {"$exists": True},
+            },
+            "sort": [(RECORD_ID, 1)],
+        },
+        # served by the unique coupon index
+        "redeem": {
+            "collection": "Participants",
+            "filter": {PARTICIPANT_TOKEN: "coupon"},
+        },
+        # CRM comments of a participant, newest first
+        "crm": {
+            "collection": "Comments",
+            "filter": {RECORD_ID: 1},
+            "sort": [(CRM_TIME, -1), ("_id", -1)],
+            "index": [(RECORD_ID, 1), (CRM_TIME, -1), ("_id", -1)],
+        },
+        # status changes of a seed, of a staff user or of a period, newest first
+        "statusevents_mrn": {
+            "collection": "StatusEvents",
+            "filter": {"MRN": "mrn"},
+            "sort": [(CHANGED_AT, -1), ("_id", -1)],
+            "index": [("MRN", 1), (CHANGED_AT, -1), ("_id", -1)],
+        },
+        "statusevents_actor": {
+            "collection": "StatusEvents",
+            "filter": {"ACTOR": "netid"},
+            "sort": [(CHANGED_AT, -1), ("_id", -1)],
+            "index": [("ACTOR", 1), (CHANGED_AT, -1), ("_id", -1)],
+        },
+        "statusevents": {
+            "collection": "StatusEvents",
+            "filter": {CHANGED_AT: {"$gte": datetime(2000, 1, 1)}},
+            "sort": [(CHANGED_AT, -1), ("_id", -1)],
+            "index": [(CHANGED_AT, -1), ("_id", -1)],
+        },
+        # deleted participants for clients syncing with since
+        "tombstones": {
+            "collection": "Tombstones",
+            "filter": {
+                "collection": "Participants",
+                DELETED_AT: {"$gte": datetime(2000, 1, 1)},
+            },
+            "index": [("collection", 1), (DELETED_AT, 1)],
+        },
+        "outbox": {
+            "collection": "Outbox",
+            "filter": {
+                "status": "pending",
+                "next_attempt_at": {"$lte": datetime(2000, 1, 1)},
+            },
+            "sort": [("next_attempt_at", 1)],
+            "index": [("status", 1), ("next_attempt_at", 1)],
+        },
     }
 
     # Fields to extract from mongodb
@@ -267,20 +481,30 @@ class DefaultConfig(object):
         RESULT_DATE: 1,
         REPORT_DATE: 1,
         "STATUS": 1,
-        STATUS_LOG: 1,
         "_id": 0,
     }
-    CRM_FIELD = {
-        "comments": 1,
+    STATUS_EVENT_FIELDS = {
+        "MRN": 1,
+        "FROM_STATUS": 1,
+        "TO_STATUS": 1,
+        "ACTOR": 1,
+        "REASON": 1,
+        CHANGED_AT: 1,
         "_id": 0,
     }
+    # every field posted with a CRM comment, without the bookkeeping ones
+    CRM_FIELDS = {
+        "_id": 0,
+        RECORD_ID: 0,
+        CREATED_AT: 0,
+        UPDATED_AT: 0,
+    }
     CONSENT_FORM_METADATA_FIELDS = {
         "_id": 0,
         "version": 1,
         "comments": 1,
         "modifier": 1,
     }
-
     # unauthorized response:
     UNAUTHORIZED_MESSAGE = 'Error 403: You do not have permission to access this information. If you believe you have \
     received this notification in error, please contact the \
@@ -299,6 +523,8 @@ class DevelopConfig(DefaultConfig):
 
 class TestConfig(DefaultConfig):
     MONGODB_NAME = "test"
+    # deliver outbox messages within the request
+    OUTBOX_WORKERS = 0
 
 
 class ProdConfig(DefaultConfig):
@@ -0,0 +1,69 @@
+import threading
+from collections import deque
+
+from app import db_utils, utils
+from app.services import logger
+
+
+class CouponPool(object):
+    """
+    Per worker pool of pre-generated coupons that have not been issued to any
+    participant yet, refilled in a background thread when it runs low. The
+    unique COUPON index on participants guards against another worker issuing
+    the same coupon in between, the participant is then inserted again with a
+    new coupon.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self._coupons = deque()
+        self._lock = threading.Lock()
+        self._refill_lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.size = app.config["COUPON_POOL_SIZE"]
+        self.low_water = app.config["COUPON_POOL_LOW_WATER"]
+
+    def pop(self):
+        while True:
+            try:
+                coupon = self._coupons.popleft()
+                break
+            except IndexError:
+                # pool drained, refill in the current request
+                self.refill()
+        if len(self._coupons) < self.low_water:
+            self._refill_in_background()
+        return coupon
+
+    def refill(self):
+        with self._lock:
+            missing = self.size - len(self._coupons)
+            if missing <= 0:
+                return
+            candidates = {utils.generate_coupon() for _ in range(missing)}
+            candidates.difference_update(self._coupons)
+            candidates.difference_update(db_utils.get_issued_coupons(candidates))
+            self._coupons.extend(candidates)
+            logger.debug(f"Added {len(candidates)} coupons to coupon pool")
+
+    def _refill_in_background(self):
+        if not self._refill_lock.acquire(blocking=False):
+            # already refilling
+            return
+        threading.Thread(target=self._background_refill, daemon=True).start()
+
+    def _background_refill(self):
+        try:
+            with self.app.app_context():
+                self.refill()
+        except Exception as err:
+            logger.error(f"Failed to refill coupon pool: {str(err)}")
+        finally:
+            self._refill_lock.release()
+
+
+coupon_pool = CouponPool()
@@ -1,23 +1,66 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import Counter
+from datetime import timedelta
+from itertools import islice
+
 import dateutil.parser
+from bson import ObjectId, json_util
 from flask import current_app as app
-from gridfs import GridFS
-from pymongo import ASCENDING, DESCENDING, errors
+from gridfs import GridFS, NoFile
+from pymongo import ASCENDING, DESCENDING, ReturnDocument, UpdateOne, errors
 
 from app import utils
+from app.cache import consent_form_cache, report_cache
 from app.services import logger, mongo
 
 
 def create_indexes():
     db = get_db_handle()
-    # Cosmos db is different from mongodb, compound indexes is only needed if
-    # query needs to sort on multiple fields at once, our case only need single
-    # field indexes
     for coll, indexes in app.config["COLLECTION_INDEXES"].items():
         for index in indexes:
-            db[coll].create_index(index)
+            _create_index(db[coll], index)
+    for coll, indexes in app.config["UNIQUE_INDEXES"].items():
+        for index in indexes:
+            _create_index(db[coll], index, unique=True, sparse=True)
+    # compound and partial indexes for the query shapes of the endpoints
+    for shape in app.config["QUERY_SHAPES"].values():
+        if "index" in shape:
+            _create_index(
+                db[shape["collection"]], shape["index"], **shape.get("options", {})
+            )
+    # tombstones are only kept as long as clients may sync from
+    _create_index(
+        db[app.config["COLLECTIONS"].get("tombstones")],
+        app.config["DELETED_AT"],
+        expireAfterSeconds=app.config["TOMBSTONE_TTL_DAYS"] * 24 * 3600,
+    )
+    # sent and failed outbox messages, pending ones have no finished_at
+    _create_index(
+        db[app.config["COLLECTIONS"].get("outbox")],
+        "finished_at",
+        expireAfterSeconds=app.config["OUTBOX_RETENTION_DAYS"] * 24 * 3600,
+    )
+    for coll in app.config["COLLECTION_INDEXES"]:
         logger.info(db[coll].index_information())
 
 
+def _create_index(coll, keys, **kwargs):
+    # Cosmos db does not support every index option, skip the index instead
+    # of failing the app start
+    try:
+        coll.create_index(keys, **kwargs)
+    except errors.OperationFailure as err:
+        logger.warning(f"Failed to create index {keys} on {coll.name}: {str(err)}")
+
+
+def explain_query(collection_name, query, sort=None):
+    coll = get_db_handle()[collection_name]
+    cursor = coll.find(query)
+    if sort:
+        cursor = cursor.sort(sort)
+    return cursor.explain()
+
+
 def mongodb_check():
     logger.info("Checking database connection...")
     result = "status: "
@@ -41,13 +84,20 @@ def remove_db(db_name=None):
         db_name = app.config["MONGODB_NAME"]
     mc = mongo.cx
     mc.drop_database(db_name)
+    consent_form_cache.clear()
+    report_cache.clear()
 
 
 def remove_collection(collection, db_name=None):
     db = get_db_handle(db_name)
     coll_name = app.config["COLLECTIONS"].get(collection)
     coll = db[coll_name]
-    return coll.drop()
+    if collection == "consentform":
+        consent_form_cache.clear()
+    try:
+        return coll.drop()
+    finally:
+        report_cache.invalidate(coll_name)
 
 
 def remove_all_collections(db_name=None):
@@ -55,6 +105,7 @@ def remove_all_collections(db_name=None):
     for _name, coll in app.config["COLLECTIONS"].items():
         logger.info(f"Dropping collection {coll}")
         db[coll].drop()
+    report_cache.clear()
     list_collections()
 
 
@@ -62,13 +113,171 @@ def list_collections(db_name=None):
     return get_db_handle(db_name).list_collection_names()
 
 
-def _get_many(collection_name, query, fields, sort_field, sort_dir=DESCENDING):
+def _get_many(
+    collection_name, query, fields, sort_field, sort_dir=DESCENDING, computed=None
+):
     logger.debug(f"Query collection {collection_name} with {query} to get {fields}")
     db = get_db_handle()
     coll = db[collection_name]
+    if computed:
+        return coll.aggregate(
+            [
+                {"$match": query},
+                {"$sort": {sort_field: sort_dir}},
+                {"$project": _computed_projection(fields, computed)},
+            ]
+        )
     return coll.find(query, fields).sort(sort_field, sort_dir)
 
 
+def _get_page(
+    collection_name,
+    query,
+    fields,
+    sort,
+    limit,
+    after=None,
+    count=False,
+    computed=None,
+):
+    """
+    One page of a sorted query using keyset pagination, the position of the
+    last document is carried in an opaque token instead of skipping documents
+    :param fields: inclusion or exclusion projection
+    :param sort: list of (field, direction), the last field must be unique
+    :param after: token of the previous page, first page if None
+    :param count: also count all documents matching the query
+    :param computed: derived fields computed by mongo, see _computed_projection
+    :return: (docs, token of the next page or None, total count or None)
+    """
+    db = get_db_handle()
+    coll = db[collection_name]
+    page_query = query
+    if after:
+        page_query = {"$and": [query, _after_query(sort, _decode_page_token(after))]}
+    projection = dict(fields) if fields is not None else None
+    hidden = []
+    if projection is not None:
+        # sort fields are needed to build the next token
+        inclusion = any(projection[field] for field in projection if field != "_id")
+        for field, _ in sort:
+            if inclusion and projection.get(field) != 1:
+                projection[field] = 1
+                hidden.append(field)
+            elif not inclusion and projection.get(field) == 0:
+                del projection[field]
+                hidden.append(field)
+    logger.debug(f"Query collection {collection_name} with {page_query}, {limit} docs")
+    if computed:
+        pipeline = [
+            {"$match": page_query},
+            {"$sort": dict(sort)},
+            {"$limit": limit + 1},
+            {"$project": _computed_projection(projection, computed)},
+        ]
+        docs = list(coll.aggregate(pipeline))
+    else:
+        docs = list(coll.find(page_query, projection).sort(sort).limit(limit + 1))
+    next_token = None
+    if len(docs) > limit:
+        docs = docs[:limit]
+        next_token = _encode_page_token([docs[-1].get(field) for field, _ in sort])
+    for doc in docs:
+        for field in hidden:
+            doc.pop(field, None)
+    total = coll.count_documents(query) if count else None
+    return docs, next_token, total
+
+
+def _after_query(sort, values):
+    # documents sorted after the given values, null and missing values sort
+    # before anything else
+    clauses = []
+    for i, (field, direction) in enumerate(sort):
+        value = values[i]
+        if direction == ASCENDING:
+            cond = {"$ne": None} if value is None else {"$gt": value}
+        elif value is None:
+            cond = None
+        else:
+            cond = {"$not": {"$gte": value}}
+        if cond is not None:
+            clause = {f: v for (f, _), v in zip(sort[:i], values[:i])}
+            clause[field] = cond
+            clauses.append(clause)
+    return {"$or": clauses} if clauses else {"_id": {"$exists": False}}
+
+
+def _encode_page_token(values):
+    return urlsafe_b64encode(json_util.dumps(values).encode("utf-8")).decode("ascii")
+
+
+def _decode_page_token(token):
+    try:
+        return json_util.loads(urlsafe_b64decode(token.encode("ascii")))
+    except Exception:
+        raise ValueError(f"Invalid page token {token}")
+
+
+# Placeholder for the request time in computed fields. Dates are saved in
+# local time by utils.current_time, so it is replaced by that instead of
+# letting mongo use its own (UTC) $$NOW.
+NOW = "$$NOW"
+
+
+def concat_fields(*fields, separator=","):
+    """
+    Computed field joining string fields, missing fields as empty strings
+    """
+    parts = []
+    for field in fields:
+        if parts:
+            parts.append(separator)
+        parts.append({"$ifNull": ["$" + field, ""]})
+    return {"$concat": parts}
+
+
+def age_group(field, groups):
+    """
+    Computed field with the age group ("lo-hi", as accepted by the age filter)
+    the field falls in, None if it is in none of them
+    """
+    branches = []
+    for group in groups:
+        low, high = (int(age) for age in group.split("-"))
+        case = {"$and": [{"$gte": ["$" + field, low]}, {"$lte": ["$" + field, high]}]}
+        branches.append({"case": case, "then": group})
+    return {"$switch": {"branches": branches, "default": None}}
+
+
+def days_since(field):
+    """
+    Computed field with the whole days elapsed since a date field, None if
+    the date is not set
+    """
+    days = {"$floor": {"$divide": [{"$subtract": [NOW, "$" + field]}, 86400000]}}
+    return {"$cond": [{"$ifNull": ["$" + field, False]}, days, None]}
+
+
+def _computed_projection(fields, computed):
+    # $project stage with the plain fields plus the computed ones
+    project = dict(fields) if fields else {}
+    now = utils.current_time()
+    for name, expression in computed.items():
+        project[name] = _bind_now(expression, now)
+    return project
+
+
+def _bind_now(expression, now):
+    if expression == NOW:
+        return now
+    if isinstance(expression, dict):
+        return {k: _bind_now(v, now) for k, v in expression.items()}
+    if isinstance(expression, list):
+        return [_bind_now(v, now) for v in expression]
+    return expression
+
+
 def _get_one(collection_name, query, fields):
     db = get_db_handle()
     coll = db[collection_name]
@@ -78,20 +287,61 @@ def _get_one(collection_name, query, fields):
 def _insert_one(collection_name, doc):
     db = get_db_handle()
     coll = db[collection_name]
-    doc[app.config["CREATED_AT"]] = utils.current_time()
-    return coll.insert_one(doc)
+    now = utils.current_time()
+    # UPDATED_AT too, so the since sync only needs one field
+    doc[app.config["CREATED_AT"]] = doc[app.config["UPDATED_AT"]] = now
+    try:
+        return coll.insert_one(doc)
+    finally:
+        report_cache.invalidate(collection_name)
+
+
+def _insert_many(collection_name, docs, batch_size=None):
+    # unordered insert so one bad document does not stop the rest of the batch,
+    # returns number of inserted docs and write errors indexed into docs
+    db = get_db_handle()
+    coll = db[collection_name]
+    created_at = utils.current_time()
+    batch_size = batch_size or len(docs) or 1
+    inserted = 0
+    write_errors = []
+    for start in range(0, len(docs), batch_size):
+        batch = docs[start : start + batch_size]
+        for doc in batch:
+            doc[app.config["CREATED_AT"]] = doc[app.config["UPDATED_AT"]] = created_at
+        try:
+            inserted += len(coll.insert_many(batch, ordered=False).inserted_ids)
+        except errors.BulkWriteError as bwe:
+            inserted += bwe.details.get("nInserted", 0)
+            for err in bwe.details.get("writeErrors", []):
+                write_errors.append(
+                    {
+                        "index": start + err["index"],
+                        "code": err.get("code"),
+                        "errmsg": err.get("errmsg"),
+                    }
+                )
+        finally:
+            report_cache.invalidate(collection_name)
+    return inserted, write_errors
 
 
 def _update_one(collection_name, query, updates, insertIfNotExists=False):
     db = get_db_handle()
     coll = db[collection_name]
-    return coll.update_one(query, updates, upsert=insertIfNotExists)
+    try:
+        return coll.update_one(query, updates, upsert=insertIfNotExists)
+    finally:
+        report_cache.invalidate(collection_name)
 
 
 def _delete_one(collection_name, query):
     db = get_db_handle()
     coll = db[collection_name]
-    return coll.delete_one(query)
+    try:
+        return coll.delete_one(query)
+    finally:
+        report_cache.invalidate(collection_name)
 
 
 def insert_doc(collection, doc):
@@ -99,8 +349,15 @@ def insert_doc(collection, doc):
 
 
 def upsert_doc(collection, query, doc):
+    now = utils.current_time()
     return _update_one(
-        app.config["COLLECTIONS"].get(collection), query, {"$set": doc}, True
+        app.config["COLLECTIONS"].get(collection),
+        query,
+        {
+            "$set": {**doc, app.config["UPDATED_AT"]: now},
+            "$setOnInsert": {app.config["CREATED_AT"]: now},
+        },
+        True,
     )
 
 
@@ -113,25 +370,185 @@ def insert_seed(doc):
     return _insert_one(app.config["COLLECTIONS"].get("seeds"), doc)
 
 
+def insert_seeds(docs):
+    # docs are expected to have _id and RESULT_DATE already prepared
+    return _insert_many(
+        app.config["COLLECTIONS"].get("seeds"),
+        docs,
+        app.config["SEED_INSERT_BATCH_SIZE"],
+    )
+
+
 def update_seed_report(mrn, updates):
     mrn_query = {"MRN": mrn}
     updates[app.config["UPDATED_AT"]] = utils.current_time()
     _update_one(app.config["COLLECTIONS"].get("seeds"), mrn_query, {"$set": updates})
 
 
-def update_seed_status(mrn, new_status, new_log):
-    mrn_query = {"MRN": mrn}
+def _seed_status_update(new_status, event):
+    # the event is saved in the same single document write as the status, and
+    # moved into the status events by _flush_status_events
+    return {
+        "$set": {
+            "STATUS": new_status,
+            app.config["UPDATED_AT"]: event[app.config["CHANGED_AT"]],
+        },
+        "$push": {app.config["PENDING_STATUS_EVENTS"]: event},
+    }
+
+
+def _status_event(mrn, from_status, to_status, actor, reason, now):
+    # _id set here, so an event copied twice is only saved once
+    event = {
+        "_id": ObjectId(),
+        "MRN": mrn,
+        "FROM_STATUS": from_status,
+        "TO_STATUS": to_status,
+        "ACTOR": actor,
+        app.config["CHANGED_AT"]: now,
+    }
+    if reason is not None:
+        event["REASON"] = reason
+    return event
+
+
+def _insert_status_events(events):
+    # append only: never updated, so no UPDATED_AT and no cached reports
+    if events:
+        coll = get_db_handle()[app.config["COLLECTIONS"].get("status_events")]
+        coll.insert_many(events, ordered=False)
+
+
+def _flush_status_events(mrns=None):
+    """
+    Move the status events pending in the seeds into the status events
+    :param mrns: seeds to flush, every seed with pending events if None
+    :return: number of events moved
+    """
+    db = get_db_handle()
+    seeds = db[app.config["COLLECTIONS"].get("seeds")]
+    field = app.config["PENDING_STATUS_EVENTS"]
+    query = {f"{field}._id": {"$exists": True}}
+    if mrns is not None:
+        query["MRN"] = {"$in": list(mrns)}
+    events = [
+        event
+        for seed in seeds.find(query, {"_id": 0, field: 1})
+        for event in seed[field]
+    ]
+    if not events:
+        return 0
+    try:
+        _insert_status_events(events)
+    except errors.BulkWriteError as bwe:
+        # events copied by an earlier flush that failed to remove them
+        if any(err["code"] != 11000 for err in bwe.details.get("writeErrors", [])):
+            raise
+    ids = [event["_id"] for event in events]
+    # no UPDATED_AT, the reports do not change
+    seeds.update_many(
+        {f"{field}._id": {"$in": ids}}, {"$pull": {field: {"_id": {"$in": ids}}}}
+    )
+    return len(events)
+
+
+def _record_status_events(mrns):
+    # the events are saved with the status changes, a failed move is retried
+    # by the next flush
+    try:
+        _flush_status_events(mrns)
+    except errors.PyMongoError as err:
+        logger.error(f"Status events of {mrns} left pending: {str(err)}")
+
+
+def update_seed_reports(changes):
+    """
+    Update many seeds in one unordered bulk write, see update_seed_report
+    :param changes: list of (mrn, updates)
+    :return: error message of the failed updates by index into changes
+    """
+    now = utils.current_time()
+    return _bulk_update_seeds(
+        [
+            UpdateOne(
+                {"MRN": mrn}, {"$set": {**updates, app.config["UPDATED_AT"]: now}}
+            )
+            for mrn, updates in changes
+        ]
+    )
+
+
+def _bulk_update_seeds(ops):
+    if not ops:
+        return {}
+    coll_name = app.config["COLLECTIONS"].get("seeds")
+    try:
+        get_db_handle()[coll_name].bulk_write(ops, ordered=False)
+    except errors.BulkWriteError as bwe:
+        return {
+            err["index"]: err.get("errmsg")
+            for err in bwe.details.get("writeErrors", [])
+        }
+    finally:
+        report_cache.invalidate(coll_name)
+    return {}
+
+
+def update_seed_status(mrn, from_status, to_status, actor=None, reason=None):
+    """
+    Set the status of a seed and record the change in the status events
+    :param actor: netId of the staff user, None if unknown
+    :param reason: why the status was changed, e.g. a revert
+    """
+    event = _status_event(
+        mrn, from_status, to_status, actor, reason, utils.current_time()
+    )
     _update_one(
         app.config["COLLECTIONS"].get("seeds"),
-        mrn_query,
-        {
-            "$set": {
-                "STATUS": new_status,
-                app.config["UPDATED_AT"]: utils.current_time(),
-            },
-            "$push": {app.config["STATUS_LOG"]: new_log},
-        },
+        {"MRN": mrn},
+        _seed_status_update(to_status, event),
     )
+    _record_status_events([mrn])
+
+
+def update_seed_statuses(changes, reason=None):
+    """
+    Set the status of many seeds in one unordered bulk write, each with its
+    status event, and move the events into the status events with one insert
+    :param changes: list of (mrn, from_status, to_status, actor)
+    :return: error message of the failed updates by index into changes
+    """
+    now = utils.current_time()
+    write_errors = _bulk_update_seeds(
+        [
+            UpdateOne(
+                {"MRN": change[0]},
+                _seed_status_update(change[2], _status_event(*change, reason, now)),
+            )
+            for change in changes
+        ]
+    )
+    _record_status_events(
+        [change[0] for i, change in enumerate(changes) if i not in write_errors]
+    )
+    return write_errors
+
+
+def get_status_events(query, limit=None, after=None):
+    """
+    Seed status changes, newest first
+    :param limit: number of events per page, all if None
+    :return: (events, token of the next page or None)
+    """
+    # events whose move failed before
+    _flush_status_events()
+    coll = app.config["COLLECTIONS"].get("status_events")
+    fields = app.config["STATUS_EVENT_FIELDS"]
+    sort = [(app.config["CHANGED_AT"], DESCENDING), ("_id", DESCENDING)]
+    if limit is None:
+        return list(get_db_handle()[coll].find(query, fields).sort(sort)), None
+    events, next_token, _ = _get_page(coll, query, fields, sort, limit, after)
+    return events, next_token
 
 
 def update_participant(record_id, updates):
@@ -143,17 +560,332 @@ def update_participant(record_id, updates):
 
 
 def update_crm(record_id, data):
-    query = {"_id": utils.record_id_str(record_id)}
-    # no more crm collection, now saved into participants collection
+    """
+    Save a CRM comment into the comments collection and into the summary of
+    the latest CRM_LATEST_COMMENTS comments of the participant
+    :param data: time and comment
+    """
+    _insert_one(
+        app.config["COLLECTIONS"].get("comments"),
+        {**data, app.config["RECORD_ID"]: int(record_id)},
+    )
+    latest = app.config["CRM_LATEST_COMMENTS"]
+    if latest <= 0:
+        return
     _update_one(
         app.config["COLLECTIONS"].get("participants"),
-        query,
-        {"$push": {"comments": {"$each": [data], "$position": 0}}},
+        {"_id": utils.record_id_str(record_id)},
+        {
+            "$push": {
+                app.config["CRM_COMMENTS"]: {
+                    "$each": [data],
+                    "$position": 0,
+                    "$slice": latest,
+                }
+            },
+            "$set": {app.config["UPDATED_AT"]: utils.current_time()},
+        },
     )
 
 
+def migrate_comments(batch_size=500):
+    """
+    Copy the comments arrays of the participants into the comments collection
+    and cut the arrays down to the latest CRM_LATEST_COMMENTS. Comments that
+    are already in the collection are skipped, so it can run again. Identical
+    comments are counted, a comment repeated in the array is copied as often
+    as it is missing from the collection.
+    :return: (participants, comments copied)
+    """
+    db = get_db_handle()
+    participants = db[app.config["COLLECTIONS"].get("participants")]
+    comments_coll = app.config["COLLECTIONS"].get("comments")
+    record_id = app.config["RECORD_ID"]
+    field = app.config["CRM_COMMENTS"]
+    time_field = app.config["CRM_TIME"]
+    latest = max(app.config["CRM_LATEST_COMMENTS"], 0)
+    cursor = participants.find(
+        {field: {"$exists": True}}, {record_id: 1, field: 1}
+    ).sort("_id", ASCENDING)
+    migrated = copied = 0
+    while True:
+        batch = [doc for doc in islice(cursor, batch_size) if record_id in doc]
+        if not batch:
+            return migrated, copied
+        existing = Counter(
+            (doc[record_id], doc.get(time_field), doc.get("comment"))
+            for doc in db[comments_coll].find(
+                {record_id: {"$in": [doc[record_id] for doc in batch]}},
+                {"_id": 0, record_id: 1, time_field: 1, "comment": 1},
+            )
+        )
+        docs = []
+        for participant in batch:
+            # arrays are newest first, insert oldest first to keep the order
+            for comment in reversed(participant[field] or []):
+                key = (
+                    participant[record_id],
+                    comment.get(time_field),
+                    comment.get("comment"),
+                )
+                if existing[key]:
+                    existing[key] -= 1
+                else:
+                    docs.append({**comment, record_id: participant[record_id]})
+        if docs:
+            inserted, write_errors = _insert_many(comments_coll, docs)
+            if write_errors:
+                raise RuntimeError(
+                    f"Failed to copy {len(write_errors)} comments: "
+                    + write_errors[0]["errmsg"]
+                )
+            copied += inserted
+        try:
+            participants.update_many(
+                {
+                    "_id": {"$in": [doc["_id"] for doc in batch]},
+                    f"{field}.{latest}": {"$exists": True},
+                },
+                {"$push": {field: {"$each": [], "$slice": latest}}},
+            )
+        finally:
+            report_cache.invalidate(participants.name)
+        migrated += len(batch)
+
+
+def migrate_status_log(batch_size=500):
+    """
+    Turn the status logs of the seeds into status events and remove the logs.
+    "Changed STATUS to: X at time" lines give the new status and time, other
+    lines are kept as the reason. Each event keeps the position of its line in
+    the log (LOG_INDEX), lines already migrated are skipped so it can run
+    again.
+    :return: (seeds, events added)
+    """
+    db = get_db_handle()
+    seeds = db[app.config["COLLECTIONS"].get("seeds")]
+    events_coll = db[app.config["COLLECTIONS"].get("status_events")]
+    field = app.config["STATUS_LOG"]
+    cursor = seeds.find({field: {"$exists": True}}, {"MRN": 1, field: 1}).sort(
+        "_id", ASCENDING
+    )
+    migrated = added = 0
+    while True:
+        batch = list(islice(cursor, batch_size))
+        if not batch:
+            return migrated, added
+        existing = {
+            (event["MRN"], event["LOG_INDEX"])
+            for event in events_coll.find(
+                {
+                    "MRN": {"$in": [seed.get("MRN") for seed in batch]},
+                    "LOG_INDEX": {"$exists": True},
+                },
+                {"_id": 0, "MRN": 1, "LOG_INDEX": 1},
+            )
+        }
+        events = []
+        for seed in batch:
+            for i, line in enumerate(seed[field] or []):
+                if (seed.get("MRN"), i) not in existing:
+                    event = _status_log_event(seed.get("MRN"), line)
+                    event["LOG_INDEX"] = i
+                    events.append(event)
+        _insert_status_events(events)
+        added += len(events)
+        try:
+            seeds.update_many(
+                {"_id": {"$in": [seed["_id"] for seed in batch]}},
+                {"$unset": {field: ""}},
+            )
+        finally:
+            report_cache.invalidate(seeds.name)
+        migrated += len(batch)
+
+
+def _status_log_event(mrn, line):
+    prefix, separator = "Changed STATUS to: ", " at "
+    if line.startswith(prefix) and separator in line:
+        to_status, changed_at = line[len(prefix) :].split(separator, 1)
+        try:
+            return _status_event(
+                mrn, None, to_status, None, None, dateutil.parser.parse(changed_at)
+            )
+        except (ValueError, OverflowError):
+            pass
+    return _status_event(mrn, None, None, None, line, None)
+
+
+def insert_participants(docs):
+    return _insert_many(app.config["COLLECTIONS"].get("participants"), docs)
+
+
+def insert_outbox_messages(messages):
+    now = utils.current_time()
+    for message in messages:
+        message.update({"status": "pending", "attempts": 0, "next_attempt_at": now})
+    return _insert_many(app.config["COLLECTIONS"].get("outbox"), messages)
+
+
+def claim_outbox_messages(lease_seconds, limit):
+    """
+    Claim up to limit due outbox messages, messages claimed by a worker that
+    did not finish within lease_seconds are claimed again
+    """
+    coll = get_db_handle()[app.config["COLLECTIONS"].get("outbox")]
+    now = utils.current_time()
+    due = {
+        "$or": [
+            {"status": "pending", "next_attempt_at": {"$lte": now}},
+            {
+                "status": "sending",
+                "claimed_at": {"$lte": now - timedelta(seconds=lease_seconds)},
+            },
+        ]
+    }
+    ids = [
+        message["_id"]
+        for message in coll.find(due, {"_id": 1})
+        .sort("next_attempt_at", ASCENDING)
+        .limit(limit)
+    ]
+    if not ids:
+        return []
+    # the due condition is checked again per document, so a message raced by
+    # another worker is only claimed once
+    claim = ObjectId()
+    coll.update_many(
+        {"_id": {"$in": ids}, **due},
+        {
+            "$set": {
+                "status": "sending",
+                "claimed_at": now,
+                "claim": claim,
+                app.config["UPDATED_AT"]: now,
+            },
+            "$inc": {"attempts": 1},
+        },
+    )
+    return list(coll.find({"_id": {"$in": ids}, "claim": claim}))
+
+
+def retry_outbox_message(_id, delay_seconds, error):
+    now = utils.current_time()
+    _update_one(
+        app.config["COLLECTIONS"].get("outbox"),
+        {"_id": _id},
+        {
+            "$set": {
+                "status": "pending",
+                "next_attempt_at": now + timedelta(seconds=delay_seconds),
+                "last_error": error,
+                app.config["UPDATED_AT"]: now,
+            }
+        },
+    )
+
+
+def finish_outbox_message(_id, new_status, error=None):
+    # finished_at starts the OUTBOX_RETENTION_DAYS of the message
+    now = utils.current_time()
+    _update_one(
+        app.config["COLLECTIONS"].get("outbox"),
+        {"_id": _id},
+        {
+            "$set": {
+                "status": new_status,
+                "last_error": error,
+                "finished_at": now,
+                app.config["UPDATED_AT"]: now,
+            }
+        },
+    )
+
+
+def reserve_record_ids(count=1):
+    """
+    Atomically reserve a contiguous block of record ids
+    :param count: number of record ids to reserve
+    :return: range of reserved record ids
+    """
+    coll = get_db_handle()[app.config["COLLECTIONS"].get("counters")]
+    query = {"_id": app.config["RECORD_ID"]}
+    update = {"$inc": {"seq": count}}
+    counter = coll.find_one_and_update(
+        query, update, return_document=ReturnDocument.AFTER
+    )
+    if counter is None:
+        init_record_id_counter()
+        counter = coll.find_one_and_update(
+            query, update, return_document=ReturnDocument.AFTER
+        )
+    return range(counter["seq"] - count + 1, counter["seq"] + 1)
+
+
+def init_record_id_counter():
+    # one time bootstrap from the current max RECORD_ID, only the first insert
+    # wins if several workers race on it
+    field = app.config["RECORD_ID"]
+    latest = get_latest("participants", field, field)
+    try:
+        _insert_one(
+            app.config["COLLECTIONS"].get("counters"),
+            {"_id": field, "seq": int(latest[field]) if latest else 0},
+        )
+    except errors.DuplicateKeyError:
+        logger.debug("Record id counter already exists")
+
+
 def delete_participant(_id):
-    return _delete_one(app.config["COLLECTIONS"].get("participants"), {"_id": _id})
+    """
+    Delete a participant and keep a tombstone with its record id for the
+    clients syncing the participant lists
+    :return: the deleted participant (RECORD_ID only) or None
+    """
+    coll_name = app.config["COLLECTIONS"].get("participants")
+    record_id = app.config["RECORD_ID"]
+    try:
+        deleted = get_db_handle()[coll_name].find_one_and_delete(
+            {"_id": _id}, {record_id: 1}
+        )
+    finally:
+        report_cache.invalidate(coll_name)
+    if deleted is not None:
+        _insert_one(
+            app.config["COLLECTIONS"].get("tombstones"),
+            _tombstone(coll_name, deleted.get(record_id)),
+        )
+    return deleted
+
+
+def delete_participants(ids):
+    """
+    Delete participants by _id, keeping tombstones like delete_participant
+    :return: number of deleted participants
+    """
+    coll_name = app.config["COLLECTIONS"].get("participants")
+    record_id = app.config["RECORD_ID"]
+    coll = get_db_handle()[coll_name]
+    docs = list(coll.find({"_id": {"$in": list(ids)}}, {record_id: 1}))
+    if not docs:
+        return 0
+    try:
+        deleted = coll.delete_many({"_id": {"$in": [doc["_id"] for doc in docs]}})
+    finally:
+        report_cache.invalidate(coll_name)
+    _insert_many(
+        app.config["COLLECTIONS"].get("tombstones"),
+        [_tombstone(coll_name, doc.get(record_id)) for doc in docs],
+    )
+    return deleted.deleted_count
+
+
+def _tombstone(coll_name, key):
+    return {
+        "collection": coll_name,
+        "key": key,
+        app.config["DELETED_AT"]: utils.current_time(),
+    }
 
 
 def save_new_consent_form(form, comments, modifier):
@@ -168,16 +900,82 @@ def save_new_consent_form(form, comments, modifier):
         modifier=modifier,
         _id=version,
     )
+    consent_form_cache.invalidate()
     return version
 
 
+def get_collection_version(collection):
+    """
+    Cheap validator of the content of a collection, changes with every
+    insert, update setting UPDATED_AT and delete. Served by the CREATED_AT and
+    UPDATED_AT indexes and the collection metadata.
+    :return: [document count, latest CREATED_AT, latest UPDATED_AT]
+    """
+    coll = get_db_handle()[app.config["COLLECTIONS"].get(collection)]
+    version = [coll.estimated_document_count()]
+    for field in (app.config["CREATED_AT"], app.config["UPDATED_AT"]):
+        doc = coll.find_one({}, {"_id": 0, field: 1}, sort=[(field, DESCENDING)])
+        version.append(doc.get(field) if doc else None)
+    return version
+
+
+def get_removed_keys(collection, key_field, query, since):
+    """
+    Keys of the documents to remove from a copy of a report synced at since:
+    deleted documents and documents written since that no longer match the
+    report query
+    :param key_field: field identifying the documents in the report
+    """
+    db = get_db_handle()
+    coll_name = app.config["COLLECTIONS"].get(collection)
+    tombstones = db[app.config["COLLECTIONS"].get("tombstones")].find(
+        {"collection": coll_name, app.config["DELETED_AT"]: {"$gte": since}},
+        {"_id": 0, "key": 1},
+    )
+    keys = [doc["key"] for doc in tombstones]
+    changed = {"$and": [{app.config["UPDATED_AT"]: {"$gte": since}}, {"$nor": [query]}]}
+    for doc in db[coll_name].find(changed, {"_id": 0, key_field: 1}):
+        if key_field in doc:
+            keys.append(doc[key_field])
+    return keys
+
+
 def get_seed_report(mrn, fields=None):
     mrn_query = {"MRN": mrn}
     return _get_one(app.config["COLLECTIONS"].get("seeds"), mrn_query, fields)
 
 
-def get_seeds(query, fields=None, sort_field=None):
-    return _get_many(app.config["COLLECTIONS"].get("seeds"), query, fields, sort_field)
+def get_seed_reports(mrns, fields=None):
+    # many seeds with one $in query
+    return list(
+        _get_many(
+            app.config["COLLECTIONS"].get("seeds"),
+            {"MRN": {"$in": list(mrns)}},
+            fields,
+            "MRN",
+            ASCENDING,
+        )
+    )
+
+
+def get_seeds(query, fields=None, sort_field=None, version=None):
+    coll = app.config["COLLECTIONS"].get("seeds")
+    return report_cache.get(
+        coll,
+        ["seeds", query, fields, sort_field, version],
+        lambda: list(_get_many(coll, query, fields, sort_field)),
+    )
+
+
+def get_seeds_page(query, fields, limit, after=None, count=False, version=None):
+    # newest report first, _id breaks ties within the same report date
+    coll = app.config["COLLECTIONS"].get("seeds")
+    sort = [(app.config["REPORT_DATE"], DESCENDING), ("_id", DESCENDING)]
+    return report_cache.get(
+        coll,
+        ["seeds_page", query, fields, limit, after, count, version],
+        lambda: _get_page(coll, query, fields, sort, limit, after, count),
+    )
 
 
 def get_participant(query_field, query_value, extract_fields=None):
@@ -187,19 +985,97 @@ def get_participant(query_field, query_value, extract_fields=None):
     )
 
 
-def get_participants(query, fields=None):
-    return _get_many(
+def get_participants(query, fields=None, computed=None, version=None):
+    coll = app.config["COLLECTIONS"].get("participants")
+    return report_cache.get(
+        coll,
+        ["participants", query, fields, computed, version],
+        lambda: list(
+            _get_many(coll, query, fields, app.config["RECORD_ID"], ASCENDING, computed)
+        ),
+    )
+
+
+def get_participants_page(
+    query, fields, limit, after=None, count=False, computed=None, version=None
+):
+    coll = app.config["COLLECTIONS"].get("participants")
+    sort = [(app.config["RECORD_ID"], ASCENDING)]
+    return report_cache.get(
+        coll,
+        ["participants_page", query, fields, limit, after, count, computed, version],
+        lambda: _get_page(coll, query, fields, sort, limit, after, count, computed),
+    )
+
+
+def get_participant_contacts(
+    query, fields, limit=None, after=None, count=False, version=None
+):
+    """
+    Peer coupon distribution rows, one per contact of the participants with
+    the participant fields and CONTACT as "LAST_NAME,FIRST_NAME" of the contact
+    :param limit: number of participants (not rows) per page, all if None
+    :param version: get_collection_version of the participants, cached rows
+        of another version are not used
+    :return: (rows, token of the next page or None, total count or None)
+    """
+    coll = app.config["COLLECTIONS"].get("participants")
+    return report_cache.get(
+        coll,
+        ["participant_contacts", query, fields, limit, after, count, version],
+        lambda: _get_participant_contacts(coll, query, fields, limit, after, count),
+    )
+
+
+def _get_participant_contacts(collection_name, query, fields, limit, after, count):
+    record_id = app.config["RECORD_ID"]
+    next_token = total = None
+    if limit is not None:
+        sort = [(record_id, ASCENDING)]
+        page, next_token, total = _get_page(
+            collection_name, query, {"_id": 0, record_id: 1}, sort, limit, after, count
+        )
+        query = {record_id: {"$in": [doc[record_id] for doc in page]}}
+    project = {field: value for field, value in fields.items() if field != "contacts"}
+    project["CONTACT"] = concat_fields("contacts.LAST_NAME", "contacts.FIRST_NAME")
+    pipeline = [
+        {"$match": query},
+        {"$sort": {record_id: ASCENDING}},
+        {"$unwind": "$contacts"},
+        {"$project": project},
+    ]
+    coll = get_db_handle()[collection_name]
+    return list(coll.aggregate(pipeline)), next_token, total
+
+
+def get_issued_coupons(coupons):
+    query = {app.config["PARTICIPANT_TOKEN"]: {"$in": list(coupons)}}
+    fields = {app.config["PARTICIPANT_TOKEN"]: 1, "_id": 0}
+    participants = _get_many(
         app.config["COLLECTIONS"].get("participants"),
         query,
         fields,
-        app.config["RECORD_ID"],
-        ASCENDING,
+        app.config["PARTICIPANT_TOKEN"],
     )
-
-
-def get_comments(record_id, fields=None):
-    query = {"_id": utils.record_id_str(record_id)}
-    return _get_one(app.config["COLLECTIONS"].get("participants"), query, fields)
+    return {
+        participant[app.config["PARTICIPANT_TOKEN"]] for participant in participants
+    }
+
+
+def get_comments(record_id, limit=None, after=None):
+    """
+    CRM comments of a participant, newest first
+    :param limit: number of comments per page, all if None
+    :return: (comments, token of the next page or None)
+    """
+    coll = app.config["COLLECTIONS"].get("comments")
+    query = {app.config["RECORD_ID"]: int(record_id)}
+    fields = app.config["CRM_FIELDS"]
+    sort = [(app.config["CRM_TIME"], DESCENDING), ("_id", DESCENDING)]
+    if limit is None:
+        return list(get_db_handle()[coll].find(query, fields).sort(sort)), None
+    comments, next_token, _ = _get_page(coll, query, fields, sort, limit, after)
+    return comments, next_token
 
 
 # General get method using record_id
@@ -230,7 +1106,12 @@ def get_latest(collection, sort_field, field=None):
 def get_current_consent_version():
     db = get_db_handle()
     coll = db[app.config["COLLECTIONS"].get("consentform") + ".files"]
-    return len(list(coll.find({"filename": app.config["CONSENT_FORM_FILENAME"]})))
+    latest = list(
+        coll.find({"filename": app.config["CONSENT_FORM_FILENAME"]}, {"version": 1})
+        .sort("version", DESCENDING)
+        .limit(1)
+    )
+    return latest[0]["version"] if latest else 0
 
 
 def get_version_consent_form(version):
@@ -238,6 +1119,42 @@ def get_version_consent_form(version):
     return fs.get_version(filename=app.config["CONSENT_FORM_FILENAME"], version=version)
 
 
+def get_consent_form(version=None):
+    """
+    Consent form and its metadata, served from the per worker cache when it
+    has been read before
+    :param version: version saved with the form, latest if None
+    :return: dict with version, uploadDate, comments, modifier and the pdf in
+        data, or the gridfs file in file if it is too large to be cached
+    """
+    form = consent_form_cache.get(version)
+    if form is not None:
+        return form
+
+    if version is None:
+        consent = get_version_consent_form(-1)
+    else:
+        fs = GridFS(get_db_handle(), app.config["COLLECTIONS"].get("consentform"))
+        consent = fs.find_one(
+            {"filename": app.config["CONSENT_FORM_FILENAME"], "version": version}
+        )
+        if consent is None:
+            raise NoFile(f"no version {version} of consent form")
+    form = {
+        "version": consent.version,
+        "uploadDate": consent.upload_date,
+        "comments": consent.comments,
+        "modifier": consent.modifier,
+        "length": consent.length,
+    }
+    if consent.length > app.config["CONSENT_FORM_CACHE_MAX_BYTES"]:
+        form["file"] = consent
+    else:
+        form["data"] = consent.read()
+        consent_form_cache.put(form, current=version is None)
+    return form
+
+
 def get_consent_form_history():
     db = get_db_handle()
     coll = db[app.config["COLLECTIONS"].get("consentform") + ".files"]
@@ -247,6 +1164,9 @@ def get_consent_form_history():
 
 
 def download_report(coll):
+    fields = {"_id": 0}
+    if coll == "seeds":
+        fields[app.config["PENDING_STATUS_EVENTS"]] = 0
     return _get_many(
-        app.config["COLLECTIONS"].get(coll), {}, {"_id": 0}, app.config["CREATED_AT"]
-    )
+        app.config["COLLECTIONS"].get(coll), {}, fields, app.config["CREATED_AT"]
+    ).batch_size(app.config["DOWNLOAD_BATCH_SIZE"])
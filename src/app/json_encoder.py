@@ -0,0 +1,113 @@
+import json
+import re
+import time
+from base64 import b64encode
+from datetime import date, datetime
+from email.utils import formatdate
+
+import orjson
+from bson import ObjectId
+from flask import current_app as app
+from flask.json import JSONEncoder as FlaskJSONEncoder
+
+
+class JSONEncoder(FlaskJSONEncoder):
+    """
+    Flask encoder (http dates for datetime and date) that also encodes mongo
+    ObjectId as its hex string and bytes as base64
+    """
+
+    def default(self, o):
+        if isinstance(o, ObjectId):
+            return str(o)
+        if isinstance(o, (bytes, bytearray)):
+            return b64encode(o).decode("ascii")
+        return super().default(o)
+
+
+_encoder = JSONEncoder()
+# json.dumps escapes DEL as well with ensure_ascii
+_NON_ASCII = re.compile(r"[^\x00-\x7e]")
+
+
+def dumps(obj):
+    """
+    Encode obj the way flask jsonify does, with orjson unless JSON_ENCODER is
+    stdlib. orjson only writes compact json, pretty printed output in debug
+    mode always goes through the stdlib encoder.
+
+    Only responses built with make_json_response (response_with_status_code)
+    use this; plain data returned by a resource (health check, flask restful
+    errors) keeps the flask restful representation, whose ", " separators
+    orjson can not write.
+    """
+    pretty = app.config["JSONIFY_PRETTYPRINT_REGULAR"] or app.debug
+    if app.config["JSON_ENCODER"] == "orjson" and not pretty:
+        option = orjson.OPT_PASSTHROUGH_DATETIME
+        if app.config["JSON_SORT_KEYS"]:
+            option |= orjson.OPT_SORT_KEYS
+        try:
+            rv = orjson.dumps(obj, default=_make_default(), option=option)
+        except TypeError:
+            # non string keys, integers over 64 bits or too deeply nested
+            return _stdlib_dumps(obj, pretty)
+        if app.config["JSON_AS_ASCII"] and (not rv.isascii() or b"\x7f" in rv):
+            return _NON_ASCII.sub(_escape, rv.decode("utf-8"))
+        return rv.decode("utf-8")
+    return _stdlib_dumps(obj, pretty)
+
+
+def _make_default():
+    # report rows share a few dates (e.g. REPORT_DATE of an upload), format
+    # each distinct date once per response
+    http_dates = {}
+
+    def default(o):
+        if isinstance(o, date):
+            rv = http_dates.get(o)
+            if rv is None:
+                rv = http_dates[o] = _http_date(o)
+            return rv
+        return _encoder.default(o)
+
+    return default
+
+
+def _http_date(o):
+    # flask passes utctimetuple (datetime) or timetuple (date) to werkzeug
+    # http_date, which reads the tuple back through mktime as local time
+    if isinstance(o, datetime):
+        timestamp = time.mktime(o.utctimetuple())
+    else:
+        timestamp = time.mktime(o.timetuple())
+    return formatdate(timestamp, usegmt=True)
+
+
+def _stdlib_dumps(obj, pretty):
+    return json.dumps(
+        obj,
+        cls=app.json_encoder,
+        indent=2 if pretty else None,
+        separators=(", ", ": ") if pretty else (",", ":"),
+        ensure_ascii=app.config["JSON_AS_ASCII"],
+        sort_keys=app.config["JSON_SORT_KEYS"],
+    )
+
+
+def _escape(match):
+    # \uXXXX escapes as written by json.dumps with ensure_ascii
+    code = ord(match.group(0))
+    if code < 0x10000:
+        return f"\\u{code:04x}"
+    code -= 0x10000
+    return f"\\u{0xD800 | (code >> 10):04x}\\u{0xDC00 | (code & 0x3FF):04x}"
+
+
+def make_json_response(data, status_code=200, headers=None):
+    response = app.response_class(
+        dumps(data) + "\n", mimetype=app.config["JSONIFY_MIMETYPE"]
+    )
+    response.status_code = status_code
+    if headers:
+        response.headers.extend(headers)
+    return response
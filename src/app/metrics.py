@@ -0,0 +1,245 @@
+import glob
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import request
+from pymongo import monitoring
+
+from app.services import logger
+
+REQUEST_SECONDS = "snowballgr_request_duration_seconds"
+MONGO_COMMANDS = "snowballgr_mongo_commands_total"
+MONGO_SECONDS = "snowballgr_mongo_duration_seconds_total"
+EXTERNAL_SECONDS = "snowballgr_external_call_duration_seconds"
+REPORT_CACHE = "snowballgr_report_cache_requests_total"
+# metrics of the workers that exited, kept so the counters do not go back
+DEAD_WORKERS = "dead-workers"
+
+HELP = {
+    REQUEST_SECONDS: ("histogram", "Request latency by endpoint"),
+    MONGO_COMMANDS: ("counter", "Mongo commands sent while serving the endpoint"),
+    MONGO_SECONDS: ("counter", "Mongo time spent while serving the endpoint"),
+    EXTERNAL_SECONDS: ("histogram", "SendGrid and SMS call latency"),
+    REPORT_CACHE: ("counter", "Report queries served from the cache (hit) or mongo"),
+}
+
+
+class Metrics(object):
+    """
+    Request latency, mongo usage per request and external call latency. Each
+    worker process keeps its own metrics and writes them to METRICS_DIR, the
+    metrics endpoint adds up the files of every worker. The file of a worker
+    that exited is folded into the dead workers file by the gunicorn master.
+    """
+
+    def __init__(self, app=None):
+        self.directory = None
+        self.flush_interval = 0
+        self.buckets = ()
+        self._histograms = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._next_flush = 0
+        self._listener = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.directory = app.config["METRICS_DIR"]
+        self.flush_interval = app.config["METRICS_FLUSH_SECONDS"]
+        self.buckets = tuple(app.config["METRICS_BUCKETS"])
+        os.makedirs(self.directory, exist_ok=True)
+        if self._listener is None:
+            # applies to the mongo clients created after, so before mongo
+            self._listener = MongoCommandListener(self)
+            monitoring.register(self._listener)
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+
+    @contextmanager
+    def timed(self, service):
+        # latency of a call to an external service
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(
+                EXTERNAL_SECONDS, {"service": service}, time.perf_counter() - start
+            )
+
+    def observe(self, name, labels, value):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                # bucket counts, then sum and count
+                histogram = self._histograms[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[i] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def inc(self, name, labels, value=1):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def mongo_command(self, seconds):
+        local = self._local
+        if getattr(local, "start", None) is not None:
+            local.commands += 1
+            local.mongo_seconds += seconds
+        else:
+            # outbox and coupon pool threads
+            self.inc(MONGO_COMMANDS, {"endpoint": "background"})
+            self.inc(MONGO_SECONDS, {"endpoint": "background"}, seconds)
+
+    def render(self):
+        """
+        :return: prometheus text exposition of the metrics of all workers
+        """
+        self.flush()
+        histograms, counters = {}, {}
+        for path in glob.glob(os.path.join(self.directory, "*.json")):
+            _add_snapshot(histograms, counters, _read_snapshot(path))
+
+        lines = []
+        for name, (kind, text) in HELP.items():
+            lines += [f"# HELP {name} {text}", f"# TYPE {name} {kind}"]
+            if kind == "counter":
+                for (metric, labels), value in sorted(counters.items()):
+                    if metric == name:
+                        lines.append(f"{name}{_labels(labels)} {value}")
+                continue
+            for (metric, labels), values in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                for bound, count in zip(self.buckets, values):
+                    le = labels + (("le", repr(float(bound))),)
+                    lines.append(f"{name}_bucket{_labels(le)} {count}")
+                inf = labels + (("le", "+Inf"),)
+                lines.append(f"{name}_bucket{_labels(inf)} {values[-1]}")
+                lines.append(f"{name}_sum{_labels(labels)} {values[-2]}")
+                lines.append(f"{name}_count{_labels(labels)} {values[-1]}")
+        return "\n".join(lines) + "\n"
+
+    def flush(self):
+        # write the metrics of this worker, replaced atomically
+        with self._lock:
+            histograms = {key: list(values) for key, values in self._histograms.items()}
+            counters = dict(self._counters)
+        path = os.path.join(self.directory, f"{os.getpid()}.json")
+        _write_snapshot(path, histograms, counters)
+        self._next_flush = time.monotonic() + self.flush_interval
+
+    def mark_process_dead(self, pid, directory=None):
+        """
+        Fold the metrics file of an exited worker into the dead workers file
+        and remove it, so that files do not pile up and a new worker reusing
+        the pid does not reset its counters. Called by the gunicorn master.
+        """
+        directory = directory or self.directory
+        path = os.path.join(directory, f"{pid}.json")
+        if not os.path.exists(path):
+            return
+        dead = os.path.join(directory, f"{DEAD_WORKERS}.json")
+        histograms, counters = {}, {}
+        _add_snapshot(histograms, counters, _read_snapshot(dead))
+        _add_snapshot(histograms, counters, _read_snapshot(path))
+        if _write_snapshot(dead, histograms, counters):
+            os.remove(path)
+
+    def _before_request(self):
+        local = self._local
+        local.start = time.perf_counter()
+        local.commands = 0
+        local.mongo_seconds = 0.0
+
+    def _after_request(self, response):
+        local = self._local
+        if getattr(local, "start", None) is None:
+            return response
+        endpoint = request.endpoint or "none"
+        self.observe(
+            REQUEST_SECONDS,
+            {"endpoint": endpoint, "method": request.method},
+            time.perf_counter() - local.start,
+        )
+        self.inc(MONGO_COMMANDS, {"endpoint": endpoint}, local.commands)
+        self.inc(MONGO_SECONDS, {"endpoint": endpoint}, local.mongo_seconds)
+        local.start = None
+        if time.monotonic() >= self._next_flush:
+            self.flush()
+        return response
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    # adds each mongo command to the request being served by the thread
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self.metrics.mongo_command(event.duration_micros / 1e6)
+
+    def failed(self, event):
+        self.metrics.mongo_command(event.duration_micros / 1e6)
+
+
+def _read_snapshot(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as err:
+        logger.warning(f"Skipping metrics file {path}: {str(err)}")
+        return None
+
+
+def _add_snapshot(histograms, counters, snapshot):
+    if snapshot is None:
+        return
+    for name, labels, values in snapshot["histograms"]:
+        key = (name, tuple(sorted(labels.items())))
+        if key in histograms:
+            histograms[key] = [a + b for a, b in zip(histograms[key], values)]
+        else:
+            histograms[key] = values
+    for name, labels, value in snapshot["counters"]:
+        key = (name, tuple(sorted(labels.items())))
+        counters[key] = counters.get(key, 0) + value
+
+
+def _write_snapshot(path, histograms, counters):
+    snapshot = {
+        "histograms": [
+            [name, dict(labels), values]
+            for (name, labels), values in histograms.items()
+        ],
+        "counters": [
+            [name, dict(labels), value] for (name, labels), value in counters.items()
+        ],
+    }
+    try:
+        with open(path + ".tmp", "w") as f:
+            json.dump(snapshot, f)
+        os.replace(path + ".tmp", path)
+    except OSError as err:
+        logger.error(f"Failed to write metrics to {path}: {str(err)}")
+        return False
+    return True
+
+
+def _labels(labels):
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+
+metrics = Metrics()
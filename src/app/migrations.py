@@ -0,0 +1,26 @@
+import click
+from flask.cli import with_appcontext
+
+from app import db_utils
+
+
+@click.command("migrate-comments")
+@click.option(
+    "--batch-size", default=500, show_default=True, help="Participants per batch"
+)
+@with_appcontext
+def migrate_comments(batch_size):
+    """Move the CRM comments of the participants into the comments collection."""
+    db_utils.create_indexes()
+    participants, copied = db_utils.migrate_comments(batch_size)
+    click.echo(f"{participants} participants, {copied} comments copied")
+
+
+@click.command("migrate-status-log")
+@click.option("--batch-size", default=500, show_default=True, help="Seeds per batch")
+@with_appcontext
+def migrate_status_log(batch_size):
+    """Move the status logs of the seeds into the status events collection."""
+    db_utils.create_indexes()
+    seeds, added = db_utils.migrate_status_log(batch_size)
+    click.echo(f"{seeds} seeds, {added} status events added")
@@ -0,0 +1,152 @@
+import threading
+
+from app import db_utils, status, utils
+from app.services import logger
+
+
+class EnqueueError(RuntimeError):
+    def __init__(self, msg, failed):
+        super().__init__(msg)
+        # indexes into the enqueued messages that were not saved
+        self.failed = failed
+
+
+class Outbox(object):
+    """
+    Deliver coupon invitations outside of the request: messages are saved into
+    the outbox collection and a pool of worker threads sends them by email or
+    sms, retrying failed deliveries with exponential backoff. The outcome is
+    saved as a CRM comment of the participant.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self._threads = []
+        self._wakeup = threading.Event()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.workers = app.config["OUTBOX_WORKERS"]
+        self.batch_size = app.config["OUTBOX_BATCH_SIZE"]
+        self.max_attempts = app.config["OUTBOX_MAX_ATTEMPTS"]
+        self.backoff = app.config["OUTBOX_BACKOFF_SECONDS"]
+        self.poll_interval = app.config["OUTBOX_POLL_SECONDS"]
+        self.lease = app.config["OUTBOX_LEASE_SECONDS"]
+
+    def start(self):
+        """
+        Start the worker threads, only in the server processes (see
+        gunicorn.conf.py), messages queued by other processes wait for them
+        """
+        for _ in range(self.workers - len(self._threads)):
+            thread = threading.Thread(target=self._run, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def enqueue(self, messages):
+        """
+        Save messages into the outbox and wake up the workers
+        :param messages: list of dict with RECORD_ID, channel, recipient,
+            coupon and name
+        """
+        if not messages:
+            return
+        count, write_errors = db_utils.insert_outbox_messages(messages)
+        logger.debug(f"Queued {count} messages into outbox")
+        if count and self.workers == 0:
+            # no worker threads, deliver within the request
+            self.deliver_pending()
+        elif count:
+            self._wakeup.set()
+        if write_errors:
+            raise EnqueueError(
+                f"Failed to queue {len(write_errors)} messages: "
+                + write_errors[0]["errmsg"],
+                {write_error["index"] for write_error in write_errors},
+            )
+
+    def deliver_pending(self):
+        # deliver messages that are due until none is left
+        while True:
+            messages = db_utils.claim_outbox_messages(self.lease, self.batch_size)
+            if not messages:
+                return
+            emails = [message for message in messages if message["channel"] == "email"]
+            errors = self._send_emails(emails) if emails else {}
+            for message in messages:
+                if message["channel"] != "email":
+                    errors[message["_id"]] = self._send_sms(message)
+                self._finish(message, errors[message["_id"]])
+
+    def _send_emails(self, messages):
+        # all emails of the round go out in one batched SendGrid request
+        invites = [
+            (message["recipient"], message["coupon"], message["name"], None)
+            for message in messages
+        ]
+        try:
+            status_codes = utils.send_emails(
+                invites, self.app.config["SENDGRID_SEED_TEMPLATE"]
+            )
+            return {
+                message["_id"]: _delivery_error(status_code)
+                for message, status_code in zip(messages, status_codes)
+            }
+        except Exception as err:
+            return {message["_id"]: str(err) for message in messages}
+
+    def _send_sms(self, message):
+        try:
+            return _delivery_error(
+                utils.send_sms_txt(message["recipient"], message["coupon"])
+            )
+        except Exception as err:
+            return str(err)
+
+    def _finish(self, message, error):
+        recipient = message["recipient"]
+        coupon = message["coupon"]
+        if error is None:
+            msg = f"Successfully sent coupon {coupon} to {recipient}"
+            db_utils.finish_outbox_message(message["_id"], "sent")
+        elif message["attempts"] < self.max_attempts:
+            delay = self.backoff * 2 ** (message["attempts"] - 1)
+            logger.warning(
+                f"Failed to send coupon {coupon} to {recipient}: {error}, "
+                f"retry in {delay} seconds"
+            )
+            db_utils.retry_outbox_message(message["_id"], delay, error)
+            return
+        else:
+            msg = f"Failed to send coupon {coupon} to {recipient}: {error}"
+            db_utils.finish_outbox_message(message["_id"], "failed", error)
+
+        logger.info(msg)
+        db_utils.update_crm(
+            message[self.app.config["RECORD_ID"]],
+            {
+                "time": utils.current_time().strftime("%Y-%m-%dT%H:%M:%S"),
+                "comment": msg,
+            },
+        )
+
+    def _run(self):
+        while True:
+            self._wakeup.clear()
+            try:
+                with self.app.app_context():
+                    self.deliver_pending()
+            except Exception as err:
+                logger.error(f"Outbox worker exception: {str(err)}")
+            self._wakeup.wait(self.poll_interval)
+
+
+def _delivery_error(status_code):
+    if status_code in (status.HTTP_200_OK, status.HTTP_202_ACCEPTED):
+        return None
+    return str(status_code)
+
+
+outbox = Outbox()
@@ -0,0 +1,125 @@
+import json
+import os
+import signal
+import threading
+import time
+
+from app.services import logger
+
+# rbac_config.json key mapping a role to its permissions, every other key is
+# a netId, e.g.
+# {"roles": {"admin": ["seeds", "download"]}, "abc123": {"role": "admin"}}
+ROLES_KEY = "roles"
+
+
+class RoleRegistry(object):
+    """
+    Access roles of rbac_config.json held in memory by each worker. The file
+    modification time is checked at most every RBAC_CHECK_SECONDS and the file
+    is parsed again only when it changed, or on SIGHUP.
+    """
+
+    def __init__(self, app=None):
+        self.path = None
+        self.check_interval = 0
+        self._roles = {}
+        self._permissions = {}
+        self._mtime = None
+        self._next_check = 0
+        self._stale = False
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.path = app.config["RBAC_CONFIG_PATH"]
+        self.check_interval = app.config["RBAC_CHECK_SECONDS"]
+        self._next_check = 0
+
+    def install_signal_handler(self):
+        """
+        Reload on SIGHUP. Only set by the server worker hooks, so that the
+        cli, migrations and tests keep their own SIGHUP handler
+        """
+        signal.signal(signal.SIGHUP, self._on_signal)
+
+    def role(self, net_id):
+        """
+        :return: role of the netId, None if it has no access
+        """
+        self._check()
+        return self._roles.get(net_id)
+
+    def permissions(self, role):
+        """
+        :return: frozenset of the permissions granted to the role
+        """
+        self._check()
+        return self._permissions.get(role, frozenset())
+
+    def has_permission(self, net_id, permission):
+        return permission in self.permissions(self.role(net_id))
+
+    def reload(self):
+        with self._lock:
+            self._load()
+
+    def _on_signal(self, signum, frame):
+        # only flag it, the file is read by the next lookup
+        self._stale = True
+
+    def _check(self):
+        now = time.monotonic()
+        if not self._stale and now < self._next_check:
+            return
+        with self._lock:
+            if not self._stale and now < self._next_check:
+                return
+            self._next_check = now + self.check_interval
+            try:
+                mtime = os.stat(self.path).st_mtime_ns
+            except OSError:
+                mtime = None
+            if self._stale or mtime != self._mtime:
+                self._load()
+
+    def _load(self):
+        self._stale = False
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+            with open(self.path) as json_file:
+                access_roles = json.load(json_file)
+        except FileNotFoundError:
+            logger.warning(f"No access roles file {self.path}")
+            self._mtime = None
+            self._roles, self._permissions = {}, {}
+            return
+        except (OSError, ValueError) as err:
+            # keep the roles loaded before, the file may be half written
+            logger.error(f"Failed to load access roles from {self.path}: {str(err)}")
+            return
+        if not isinstance(access_roles, dict):
+            logger.error(f"Failed to load access roles from {self.path}: not a dict")
+            return
+        permissions = access_roles.pop(ROLES_KEY, {})
+        if not isinstance(permissions, dict):
+            logger.warning(f"Ignored {ROLES_KEY} of {self.path}: not a dict")
+            permissions = {}
+        roles = {}
+        for net_id, entry in access_roles.items():
+            if not isinstance(entry, dict):
+                logger.warning(f"Ignored access role of {net_id}: {entry!r}")
+            elif entry.get("role"):
+                roles[net_id] = entry["role"]
+        self._roles = roles
+        self._permissions = {}
+        for role, granted in permissions.items():
+            if isinstance(granted, list):
+                self._permissions[role] = frozenset(granted)
+            else:
+                logger.warning(f"Ignored permissions of role {role}: {granted!r}")
+        self._mtime = mtime
+        logger.info(f"Loaded {len(self._roles)} access roles from {self.path}")
+
+
+role_registry = RoleRegistry()
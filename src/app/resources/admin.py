@@ -1,9 +1,15 @@
+import csv
+import io
+import pickle
+import tempfile
+
 import pandas as pd
-from flask import request
+from flask import Response, request, stream_with_context
 from flask_restful import Resource
 
 from app import db_utils, utils
 from app.db_utils import mongodb_check
+from app.metrics import metrics
 from app.services import api, logger
 
 
@@ -19,6 +25,12 @@ class HealthCheck(Resource):
         return health_dict
 
 
+class Metrics(Resource):
+    def get(self):
+        # prometheus text format, summed over all workers
+        return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
 class Download(Resource):
     def get(self):
         # seeds/participants/consent/survey
@@ -26,14 +38,46 @@ class Download(Resource):
         logger.info(f"download request for {collection}")
         try:
             cursor = db_utils.download_report(collection)
-            rl = list(cursor)
-            df = pd.DataFrame(rl)
-            csv = df.to_csv(index=False, sep=",")
-            return csv
         except Exception as err:
             logger.error(str(err))
             return utils.response_with_status_code(f"Exception caught: {str(err)}")
 
+        return Response(
+            stream_with_context(
+                _generate_csv(cursor, api.app.config["DOWNLOAD_BATCH_SIZE"])
+            ),
+            mimetype="text/csv",
+        )
+
+
+def _generate_csv(cursor, batch_size):
+    """
+    Yield csv chunks of batch_size rows each. The header has every field of
+    the rows in the order they first appear, so the rows are spooled to a
+    temporary file while the fields are collected.
+    """
+    with tempfile.TemporaryFile() as spool:
+        columns = {}
+        rows = 0
+        for row in cursor:
+            columns.update(dict.fromkeys(row))
+            pickle.dump(row, spool, pickle.HIGHEST_PROTOCOL)
+            rows += 1
+        spool.seek(0)
+        header = list(columns)
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator="\n")
+        writer.writerow(header)
+        for start in range(0, rows, batch_size):
+            batch = [pickle.load(spool) for _ in range(min(batch_size, rows - start))]
+            writer.writerows([row.get(field) for field in header] for row in batch)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        if buffer.tell():
+            # empty collection, header only
+            yield buffer.getvalue()
+
 
 class DownloadFileFromURL(Resource):
     def get(self):
@@ -1,9 +1,11 @@
 from base64 import b64encode
 
-from flask import make_response, request
+from flask import Response, request
 from flask_restful import Resource
+from werkzeug.wsgi import wrap_file
 
 from app import db_utils, status, utils
+from app.json_encoder import make_json_response
 from app.services import logger
 
 
@@ -28,13 +30,16 @@ class ConsentForm(Resource):
 
     def get(self):
         try:
-            version = request.args.get("version", -1)
-            consent = db_utils.get_version_consent_form(version)
-            logger.info(f"comments: {consent.comments}, modifier: {consent.modifier}")
+            version = request.args.get("version")
+            consent = db_utils.get_consent_form(int(version) if version else None)
+            logger.info(
+                f"comments: {consent['comments']}, modifier: {consent['modifier']}"
+            )
+            data = consent["data"] if "data" in consent else consent["file"].read()
             dict = {
-                "version": consent.version,
-                "uploadDate": consent.uploadDate,
-                "form": b64encode(consent.read()).decode("utf-8"),
+                "version": consent["version"],
+                "uploadDate": consent["uploadDate"],
+                "form": b64encode(data).decode("utf-8"),
             }
             logger.debug(
                 "Successfully retrieved version "
@@ -42,9 +47,7 @@ class ConsentForm(Resource):
                 + " consent form uploaded on "
                 + str(dict["uploadDate"])
             )
-            response = make_response(dict)
-            response.status_code = status.HTTP_200_OK
-            return response
+            return make_json_response(dict, status.HTTP_200_OK)
         except Exception as err:
             logger.error(err)
             error_msg = f"Failed to retrieve latest consent document: {str(err)}"
@@ -52,6 +55,45 @@ class ConsentForm(Resource):
             return utils.response_with_status_code(error_msg)
 
 
+class ConsentFormPdf(Resource):
+    def get(self):
+        # raw pdf streamed from gridfs, versioned urls are cacheable forever
+        try:
+            version = request.args.get("version")
+            consent = db_utils.get_consent_form(int(version) if version else None)
+        except Exception as err:
+            error_msg = f"Failed to retrieve consent document: {str(err)}"
+            logger.error(error_msg)
+            return utils.response_with_status_code(error_msg)
+
+        if "data" in consent:
+            response = Response(consent["data"], mimetype="application/pdf")
+        else:
+            # too large to be cached, stream it from gridfs
+            file = consent["file"]
+            response = Response(
+                wrap_file(request.environ, file, file.chunk_size),
+                mimetype="application/pdf",
+                direct_passthrough=True,
+            )
+        response.content_length = consent["length"]
+        response.last_modified = consent["uploadDate"]
+        # a version never changes once uploaded
+        response.set_etag(
+            f"consent-form-{consent['version']}-{consent['uploadDate'].timestamp():.0f}"
+        )
+        if "version" in request.args:
+            response.cache_control.public = True
+            response.cache_control.max_age = 31536000
+            response.cache_control.immutable = True
+        else:
+            # latest version changes when a new one is uploaded
+            response.cache_control.no_cache = True
+        return response.make_conditional(
+            request, accept_ranges=True, complete_length=consent["length"]
+        )
+
+
 class ConsentFormHistory(Resource):
     def get(self):
         try:
@@ -1,10 +1,10 @@
-import copy
-
 from flask import current_app as app
 from flask import make_response, request
 from flask_restful import Resource
 
 from app import db_utils, status, utils
+from app.coupons import coupon_pool
+from app.outbox import EnqueueError, outbox
 from app.services import logger
 
 
@@ -21,6 +21,8 @@ class SeedStatus(Resource):
         current_time = utils.current_time()
         mrn = update.get("MRN")
         new_status = update.get("STATUS")
+        # netId of the staff user, kept in the status events
+        actor = utils.current_user()
         if not mrn or not new_status:
             return utils.response_with_status_code("Missing MRN or STATUS")
         if new_status not in app.config["SEED_STATUS_LIST"]:
@@ -38,32 +40,38 @@ class SeedStatus(Resource):
                 return utils.response_with_status_code(
                     "No action taken, status not changed", status.HTTP_200_OK
                 )
-            new_log = f"Changed STATUS to: {new_status} at {str(current_time)}"
-            db_utils.update_seed_status(mrn, new_status, new_log)
+            db_utils.update_seed_status(mrn, current["STATUS"], new_status, actor)
 
             # send invitation only to "included" seeds
             resp = {"status_code": status.HTTP_200_OK, "msg": "success"}
             if new_status.upper() == "INCLUDE":
                 revert_step = 1
                 doc = _create_pdoc(current, "seed", current_time)
-                resp["msg"] = _send_coupon(doc)
-                doc["comments"] = [
-                    {
-                        "time": current_time.strftime("%Y-%m-%dT%H:%M:%S"),
-                        "comment": resp["msg"],
-                    }
-                ]
+                recipient = _get_recipient(doc)
                 # create a participant, removed UPDATED_AT copied from seed
-                db_utils.insert_doc("participants", doc)
+                write_errors = _insert_participants([doc])
+                if write_errors:
+                    raise RuntimeError(write_errors[0]["errmsg"])
+                revert_step = 2
+                message = _create_coupon_message(doc, doc, *recipient)
+                outbox.enqueue([message])
+                resp["msg"] = (
+                    f"Queued coupon {message['coupon']} for {message['recipient']}"
+                )
 
         # except (ConnectionFailure, exceptions.BadRequestsError, exceptions.ForbiddenError) as e:
         except Exception as err:
             logger.error(f"SeedStatus Exception: {str(err)}")
+            if revert_step > 1:
+                # remove the participant whose coupon could not be queued
+                db_utils.delete_participant(doc["_id"])
             if revert_step > 0:
-                # revert seed status and log
+                # revert seed status
                 db_utils.update_seed_status(
                     mrn,
+                    new_status,
                     current["STATUS"],
+                    actor,
                     "Failed to invite seed, revert status",
                 )
             resp = {
@@ -74,9 +82,202 @@ class SeedStatus(Resource):
         return utils.response_with_status_code(resp["msg"], resp["status_code"])
 
 
-def _get_new_record_id():
-    record_id_dict = db_utils.get_latest("participants", "RECORD_ID", "RECORD_ID")
-    return int(record_id_dict["RECORD_ID"]) + 1 if record_id_dict else 1
+class BulkSeedStatus(Resource):
+    def post(self):
+        # list of {MRN, STATUS}, same outcome per MRN as SeedStatus
+        updates = request.get_json()
+        if not isinstance(updates, list):
+            return utils.response_with_status_code("Expected a list of MRN and STATUS")
+        max_seeds = app.config["MAX_BULK_SEED_STATUS"]
+        if len(updates) > max_seeds:
+            return utils.response_with_status_code(
+                f"At most {max_seeds} seeds can be updated at once"
+            )
+
+        try:
+            results = _update_seed_statuses(updates, utils.current_user())
+        except Exception as err:
+            logger.error(f"BulkSeedStatus Exception: {str(err)}")
+            return utils.response_with_status_code("Exception occurred: " + str(err))
+        failed = sum(result["status_code"] != status.HTTP_200_OK for result in results)
+        return utils.response_with_status_code(
+            f"Updated {len(results) - failed} of {len(results)} seeds",
+            status.HTTP_200_OK,
+            results,
+        )
+
+
+class StatusEvents(Resource):
+    def get(self):
+        # who changed the status of which seed when, filtered by mrn, actor
+        # and date_range (days)
+        q = {}
+        try:
+            if request.args.get("mrn"):
+                q["MRN"] = request.args.get("mrn")
+            if request.args.get("actor"):
+                q["ACTOR"] = request.args.get("actor")
+            if request.args.get("date_range"):
+                q[app.config["CHANGED_AT"]] = utils.parse_date_range(
+                    request.args.get("date_range")
+                )
+            limit, after, _ = utils.parse_page_args(request.args)
+            events, next_token = db_utils.get_status_events(q, limit, after)
+        except Exception as err:
+            error_msg = f"Error retrieving status events: {str(err)}"
+            logger.error(error_msg)
+            return utils.response_with_status_code(error_msg)
+        extra = utils.page_info(next_token, None) if limit else None
+        return utils.response_with_status_code(
+            "success", status.HTTP_200_OK, events, extra
+        )
+
+
+def _update_seed_statuses(updates, actor):
+    """
+    Bulk SeedStatus: one query for the seeds, one bulk write for the status
+    changes, one insert for the participants of the included seeds and one for
+    their coupon messages. A seed whose invitation fails gets its participant
+    removed and its status reverted, like with SeedStatus.
+    :param actor: netId of the staff user, kept in the status events
+    :return: list of {MRN, status_code, msg}, one per update
+    """
+    current_time = utils.current_time()
+    results = [
+        {"MRN": update.get("MRN") if isinstance(update, dict) else None}
+        for update in updates
+    ]
+
+    def finish(i, msg, status_code=status.HTTP_422_UNPROCESSABLE_ENTITY):
+        results[i].update({"status_code": status_code, "msg": msg})
+
+    pending = {}
+    for i, update in enumerate(updates):
+        new_status = update.get("STATUS") if isinstance(update, dict) else None
+        mrn = results[i]["MRN"]
+        if not mrn or not new_status:
+            finish(i, "Missing MRN or STATUS")
+        elif new_status not in app.config["SEED_STATUS_LIST"]:
+            finish(i, f"Failed to update STATUS: invalid status {new_status}")
+        elif mrn in pending:
+            finish(i, f"Duplicate MRN {mrn}")
+        else:
+            pending[mrn] = i
+
+    seeds = {
+        seed["MRN"]: seed
+        for seed in db_utils.get_seed_reports(
+            pending, app.config["FIELDS_FROM_SEEDS_TO_PARTICIPANT"]
+        )
+    }
+    changes, changed = [], []
+    for mrn, i in pending.items():
+        new_status = updates[i]["STATUS"]
+        if mrn not in seeds:
+            finish(i, f"Seed {mrn} not found")
+        elif new_status == seeds[mrn]["STATUS"]:
+            finish(i, "No action taken, status not changed", status.HTTP_200_OK)
+        else:
+            changes.append((mrn, seeds[mrn]["STATUS"], new_status, actor))
+            changed.append(i)
+    write_errors = db_utils.update_seed_statuses(changes)
+    included = []
+    for j, i in enumerate(changed):
+        if j in write_errors:
+            finish(i, "Exception occurred: " + str(write_errors[j]))
+        elif updates[i]["STATUS"] == "INCLUDE":
+            included.append(i)
+        else:
+            finish(i, "success", status.HTTP_200_OK)
+    if not included:
+        return results
+
+    # send invitation only to "included" seeds
+    reverted, participant_ids = [], {}
+
+    def revert(i, err):
+        logger.error(f"SeedStatus Exception for MRN {results[i]['MRN']}: {err}")
+        finish(i, "Exception occurred: " + str(err))
+        reverted.append(i)
+
+    try:
+        invited, docs, recipients = [], [], []
+        record_ids = db_utils.reserve_record_ids(len(included))
+        for i, record_id in zip(included, record_ids):
+            try:
+                doc = _create_pdoc(
+                    seeds[results[i]["MRN"]], "seed", current_time, record_id
+                )
+                recipients.append(_get_recipient(doc))
+            except Exception as err:
+                revert(i, err)
+                continue
+            docs.append(doc)
+            invited.append(i)
+        write_errors = _insert_participants(docs)
+        not_saved = {error["index"]: error["errmsg"] for error in write_errors}
+        saved = [k for k in range(len(docs)) if k not in not_saved]
+        # only saved participants are removed on a revert, the _id of one that
+        # failed to insert may belong to another participant
+        for k in saved:
+            participant_ids[invited[k]] = docs[k]["_id"]
+        for k, errmsg in not_saved.items():
+            revert(invited[k], errmsg)
+
+        # built after the insert, a coupon may have been replaced
+        messages = {
+            k: _create_coupon_message(docs[k], docs[k], *recipients[k]) for k in saved
+        }
+        try:
+            outbox.enqueue([messages[k] for k in saved])
+            not_queued, queue_error = set(), None
+        except EnqueueError as err:
+            not_queued, queue_error = err.failed, err
+        except Exception as err:
+            not_queued, queue_error = set(range(len(saved))), err
+        for n, k in enumerate(saved):
+            if n in not_queued:
+                # remove the participant whose coupon could not be queued
+                revert(invited[k], queue_error)
+            else:
+                message = messages[k]
+                finish(
+                    invited[k],
+                    f"Queued coupon {message['coupon']} for {message['recipient']}",
+                    status.HTTP_200_OK,
+                )
+    except Exception as err:
+        # the statuses are saved already, revert every seed not invited yet
+        for i in included:
+            if "msg" not in results[i]:
+                revert(i, err)
+
+    removed = [participant_ids[i] for i in reverted if i in participant_ids]
+    if removed:
+        try:
+            db_utils.delete_participants(removed)
+        except Exception as err:
+            logger.error(f"Failed to remove participants {removed}: {str(err)}")
+    if reverted:
+        # revert seed status
+        write_errors = db_utils.update_seed_statuses(
+            [
+                (
+                    results[i]["MRN"],
+                    updates[i]["STATUS"],
+                    seeds[results[i]["MRN"]]["STATUS"],
+                    actor,
+                )
+                for i in reverted
+            ],
+            "Failed to invite seed, revert status",
+        )
+        for j, errmsg in write_errors.items():
+            logger.error(
+                f"Failed to revert status of MRN {results[reverted[j]]['MRN']}: "
+                + str(errmsg)
+            )
+    return results
 
 
 def _copy_seed_info_to_participant(seed):
@@ -88,13 +289,11 @@ def _copy_seed_info_to_participant(seed):
         # for now set first name to empty
         name += ","
     pat_name = name.split(",") if name else ["", ""]
-    participant = copy.deepcopy(seed)
+    participant = dict(seed)
     participant["LAST_NAME"] = pat_name[0]
     participant["FIRST_NAME"] = pat_name[1]
     participant["STATUS"] = "INCLUDE"
     del participant["PAT_NAME"]
-    if participant.get(app.config["STATUS_LOG"]):
-        del participant[app.config["STATUS_LOG"]]
     return participant
 
 
@@ -105,13 +304,14 @@ def _copy_peer_info_to_participant(parent):
     }
 
 
-def _create_pdoc(from_data, ptype, timestamp):
+def _create_pdoc(from_data, ptype, timestamp, record_id=None):
     if ptype == "seed":
         doc = _copy_seed_info_to_participant(from_data)
     else:
         doc = _copy_peer_info_to_participant(from_data)
-    doc[app.config["PARTICIPANT_TOKEN"]] = utils.generate_coupon()
-    record_id = _get_new_record_id()
+    doc[app.config["PARTICIPANT_TOKEN"]] = coupon_pool.pop()
+    if record_id is None:
+        record_id = db_utils.reserve_record_ids()[0]
     doc[app.config["RECORD_ID"]] = record_id
     doc["_id"] = utils.record_id_str(record_id)
     doc["PTYPE"] = ptype
@@ -127,7 +327,6 @@ class InvitePeer(Resource):
             return utils.response_with_status_code("Missing record_id")
 
         logger.debug(f"Invite peers for record {parent_record_id}")
-        error_msg = None
         try:
             parent = db_utils.get_participant(
                 app.config["RECORD_ID"],
@@ -142,42 +341,65 @@ class InvitePeer(Resource):
             num_coupons = int(parent.get(app.config["PEER_COUPON_NUM"], 1))
             current_time = utils.current_time()
             peers = parent.get(app.config["PEER_COUPONS_LIST"], [])
-            num = 0
-            coupons_sent = 0
-            while num < num_coupons:
-                doc = _create_pdoc(parent, "peer", current_time)
-                record_id = doc[app.config["RECORD_ID"]]
-                coupon = doc[app.config["PARTICIPANT_TOKEN"]]
-                try:
-                    # send coupon one by one
-                    comment = _send_coupon(parent, to_peer=True, token=coupon)
-                    doc["comments"] = [
-                        {
-                            "time": current_time.strftime("%Y-%m-%dT%H:%M:%S"),
-                            "comment": comment,
-                        }
+            try:
+                channel, recipient = _get_recipient(parent, to_peer=True)
+            except ValueError:
+                return utils.response_with_status_code(
+                    "Failed to send any coupons", status.HTTP_500_INTERNAL_SERVER_ERROR
+                )
+
+            # reserve record ids for all coupons at once
+            docs = [
+                _create_pdoc(parent, "peer", current_time, record_id)
+                for record_id in db_utils.reserve_record_ids(num_coupons)
+            ]
+            # create participants for peers, then queue their coupons
+            write_errors = _insert_participants(docs)
+            failed = set()
+            for write_error in write_errors:
+                failed.add(write_error["index"])
+                coupon = docs[write_error["index"]][app.config["PARTICIPANT_TOKEN"]]
+                logger.error(
+                    f"Failed to save peer with coupon {coupon}: {write_error['errmsg']}"
+                )
+            docs = [doc for index, doc in enumerate(docs) if index not in failed]
+            try:
+                outbox.enqueue(
+                    [
+                        _create_coupon_message(parent, doc, channel, recipient)
+                        for doc in docs
                     ]
-                    # create a participant for peer
-                    db_utils.insert_doc("participants", doc)
-                    coupons_sent += 1
-                    peers.append(
-                        {
-                            app.config["RECORD_ID"]: record_id,
-                            app.config["PARTICIPANT_TOKEN"]: coupon,
-                        }
-                    )
-                except Exception as e1:
-                    logger.error(
-                        f"Failed to send coupon {coupon} for record {record_id}: {str(e1)}"
-                    )
-                    error_msg = "Exception occurred: " + str(e1)
-
-                num += 1
+                )
+                not_queued = set()
+            except EnqueueError as err:
+                logger.error(f"Failed to queue peer coupons: {str(err)}")
+                not_queued = err.failed
+            except Exception as err:
+                logger.error(f"Failed to queue peer coupons: {str(err)}")
+                not_queued = set(range(len(docs)))
+            if not_queued:
+                # remove the peers whose coupon could not be queued
+                db_utils.delete_participants(
+                    [docs[index]["_id"] for index in not_queued]
+                )
+                docs = [
+                    doc for index, doc in enumerate(docs) if index not in not_queued
+                ]
+            for doc in docs:
+                peers.append(
+                    {
+                        app.config["RECORD_ID"]: doc[app.config["RECORD_ID"]],
+                        app.config["PARTICIPANT_TOKEN"]: doc[
+                            app.config["PARTICIPANT_TOKEN"]
+                        ],
+                    }
+                )
+            coupons_queued = len(docs)
 
             # update parent participant
             updates = {
                 app.config["PEER_COUPONS_LIST"]: peers,
-                app.config["PEER_COUPONS_SENT"]: coupons_sent
+                app.config["PEER_COUPONS_SENT"]: coupons_queued
                 + parent.get(app.config["PEER_COUPONS_SENT"], 0),
             }
             db_utils.update_participant(parent_record_id, updates)
@@ -185,26 +407,25 @@ class InvitePeer(Resource):
                 f"Updated parent participant {parent_record_id} with {updates}"
             )
 
-            if coupons_sent == num_coupons:
+            if coupons_queued == num_coupons:
                 resp = {
-                    "msg": f"Successfully sent {coupons_sent} coupons",
+                    "msg": f"Queued {coupons_queued} coupons",
                     "status_code": status.HTTP_200_OK,
                 }
-            elif coupons_sent == 0:
+            elif coupons_queued == 0:
                 resp = {
-                    "msg": "Failed to send any coupons",
+                    "msg": "Failed to queue any coupons",
                     "status_code": status.HTTP_500_INTERNAL_SERVER_ERROR,
                 }
             else:
                 resp = {
-                    "msg": f"Successfully sent {coupons_sent} coupons, {num_coupons-coupons_sent} failed",
+                    "msg": f"Queued {coupons_queued} coupons, "
+                    f"{num_coupons - coupons_queued} failed",
                     "status_code": status.HTTP_200_OK,
                 }
 
         except Exception as err:
-            error_msg = (
-                f"Exception updating participant peer-coupons: {str(err)}, {updates}"
-            )
+            error_msg = f"Exception updating participant peer-coupons: {str(err)}"
             logger.error(error_msg)
             resp = {
                 "msg": error_msg,
@@ -214,40 +435,68 @@ class InvitePeer(Resource):
         return utils.response_with_status_code(resp["msg"], resp["status_code"])
 
 
-def _send_coupon(participant=None, to_peer=False, token=None):
+def _get_recipient(participant, to_peer=False):
+    """
+    Pick how to reach the participant, peer coupons go to the alternative email
+    of the inviting participant if there is one
+    :return: channel (email or sms) and recipient
+    """
     if to_peer and participant.get(app.config["ALTER_EMAIL"]):
-        comm_type = "email"
-        recipient = participant[app.config["ALTER_EMAIL"]]
+        return "email", participant[app.config["ALTER_EMAIL"]]
     elif participant.get(app.config["EMAIL_ADDRESS"]):
-        comm_type = "email"
-        recipient = participant[app.config["EMAIL_ADDRESS"]]
+        return "email", participant[app.config["EMAIL_ADDRESS"]]
     elif participant.get(app.config["MOBILE_NUM"]):
-        comm_type = "mobile"
-        recipient = participant[app.config["MOBILE_NUM"]]
+        return "sms", participant[app.config["MOBILE_NUM"]]
     else:
         # should never come here
         error_msg = "Failed to send token: neither email nor cell number exists"
         logger.error(error_msg)
         raise ValueError(error_msg)
 
-    logger.debug("Invite recipient: " + recipient)
 
-    if not token:
-        token = participant[app.config["PARTICIPANT_TOKEN"]]
-    if comm_type == "email":
-        status_code = utils.send_email(
-            recipient,
-            token,
-            app.config["SENDGRID_SEED_TEMPLATE"],
-            participant.get("FIRST_NAME", "") + " " + participant.get("LAST_NAME", ""),
-        )
-    else:
-        # send coupon invite by sms
-        status_code = utils.send_sms_txt(recipient, token)
+def _insert_participants(docs):
+    """
+    Insert participants, a participant whose coupon was issued by another
+    worker in between gets a new coupon from the pool and is inserted again
+    :return: write errors indexed into docs, see db_utils.insert_participants
+    """
+    token = app.config["PARTICIPANT_TOKEN"]
+    write_errors = []
+    pending = list(range(len(docs)))
+    for attempt in range(app.config["COUPON_INSERT_RETRIES"] + 1):
+        _, insert_errors = db_utils.insert_participants([docs[k] for k in pending])
+        failed = {pending[error["index"]]: error for error in insert_errors}
+        duplicates = [k for k, error in failed.items() if error["code"] == 11000]
+        retry = []
+        if duplicates and attempt < app.config["COUPON_INSERT_RETRIES"]:
+            # the duplicate key is the coupon if it is issued, otherwise _id
+            issued = db_utils.get_issued_coupons(docs[k][token] for k in duplicates)
+            retry = [k for k in duplicates if docs[k][token] in issued]
+        for k in retry:
+            logger.warning(f"Coupon {docs[k][token]} was issued already, replace it")
+            docs[k][token] = coupon_pool.pop()
+        write_errors += [
+            {**error, "index": k} for k, error in failed.items() if k not in retry
+        ]
+        pending = retry
+        if not pending:
+            break
+    return sorted(write_errors, key=lambda error: error["index"])
 
-    if status_code != status.HTTP_202_ACCEPTED and status_code != status.HTTP_200_OK:
-        msg = f"Failed to send coupon {token} to {recipient}: {str(status_code)}"
-    else:
-        msg = f"Successfully sent coupon {token} to {recipient}"
-    logger.info(msg)
-    return msg
+
+def _create_coupon_message(participant, doc, channel, recipient):
+    """
+    Build the outbox message that delivers the coupon of doc
+    :param participant: participant receiving the message
+    :param doc: participant the coupon was issued to
+    """
+    logger.debug("Invite recipient: " + recipient)
+    return {
+        app.config["RECORD_ID"]: doc[app.config["RECORD_ID"]],
+        "channel": channel,
+        "recipient": recipient,
+        "coupon": doc[app.config["PARTICIPANT_TOKEN"]],
+        "name": participant.get("FIRST_NAME", "")
+        + " "
+        + participant.get("LAST_NAME", ""),
+    }
@@ -1,5 +1,3 @@
-import copy
-
 from flask import current_app as app
 from flask import request
 from flask_restful import Resource
@@ -9,6 +7,15 @@ from app.services import logger
 
 
 class CohortReport(Resource):
+    # derived fields computed by mongo
+    computed_fields = {
+        "PAT_NAME": db_utils.concat_fields("LAST_NAME", "FIRST_NAME"),
+        "AGE_GROUP": db_utils.age_group(
+            "PAT_AGE", ["0-20", "21-40", "41-60", "61-80", "81-130"]
+        ),
+        "DAYS_SINCE_COUPON_ISSUE": db_utils.days_since("COUPON_ISSUE_DATE"),
+    }
+
     def get(self):
         q = {}
         if request.args.get("age"):
@@ -30,7 +37,7 @@ class CohortReport(Resource):
                 }
             )
         return _process_get_participants(
-            q, app.config["COHORT_REPORT_FIELDS"], cohort=True
+            q, app.config["COHORT_REPORT_FIELDS"], computed=self.computed_fields
         )
 
 
@@ -43,9 +50,14 @@ class CrmReport(Resource):
             logger.error(error_msg)
             return utils.response_with_status_code(error_msg)
         try:
-            comments = db_utils.get_comments(record_id, app.config["CRM_FIELD"])
+            limit, after, _ = utils.parse_page_args(request.args)
+            comments, next_token = db_utils.get_comments(record_id, limit, after)
+            extra = utils.page_info(next_token, None) if limit else None
             return utils.response_with_status_code(
-                "success", status.HTTP_200_OK, comments
+                "success",
+                status.HTTP_200_OK,
+                {app.config["CRM_COMMENTS"]: comments},
+                extra,
             )
         except Exception as err:
             error_msg = f"Error retrieving logs for record id {record_id}: {str(err)}"
@@ -220,7 +232,7 @@ def _process_post_requests(
                 data["_id"] = utils.record_id_str(record_id)
                 db_utils.upsert_doc(coll, {"_id": data["_id"]}, data)
             elif coll == "crm":
-                # No more crm collection, data saved in participants collection
+                # comments collection, latest ones also in the participant
                 del data[app.config["RECORD_ID"]]
                 db_utils.update_crm(record_id, data)
             else:
@@ -245,41 +257,71 @@ def _process_post_requests(
         return utils.response_with_status_code(error_msg)
 
 
-def _process_get_participants(query, fields_to_get, cohort=False, contacts=None):
+def _process_get_participants(query, fields_to_get, computed=None, contacts=None):
     error_msg = None
+    extra = None
     try:
-        participants = db_utils.get_participants(query, fields_to_get)
+        limit, after, count = utils.parse_page_args(request.args)
+        since = utils.parse_since(request.args)
+        report_query = query
+        if since is not None:
+            # only what changed since the client last synced
+            synced_at = utils.current_time()
+            query = {**query, app.config["UPDATED_AT"]: {"$gte": since}}
+        # cached rows of another worker's version are not sent under this etag
+        version = db_utils.get_collection_version("participants")
+        etag = utils.make_etag(
+            request.path,
+            query,
+            fields_to_get,
+            computed,
+            contacts,
+            limit,
+            after,
+            count,
+            version,
+            # computed fields may depend on the day
+            utils.current_time().date().isoformat() if computed else None,
+        )
+        not_modified = utils.not_modified_response(etag)
+        if not_modified is not None:
+            return not_modified
+
+        if contacts == "y":
+            # peer coupon distribution page, one row per contact built by mongo
+            participants, next_token, total = db_utils.get_participant_contacts(
+                query, fields_to_get, limit, after, count, version
+            )
+            if limit is not None:
+                extra = utils.page_info(next_token, total)
+        elif limit is not None:
+            participants, next_token, total = db_utils.get_participants_page(
+                query, fields_to_get, limit, after, count, computed, version
+            )
+            extra = utils.page_info(next_token, total)
+        else:
+            participants = db_utils.get_participants(
+                query, fields_to_get, computed, version
+            )
         if participants is None:
             error_msg = f"Failed to retrieve participants with query {query}"
         else:
             participants = list(participants)
+        if since is not None:
+            removed = db_utils.get_removed_keys(
+                "participants", app.config["RECORD_ID"], report_query, since
+            )
+            extra = {**(extra or {}), **utils.since_info(synced_at, removed)}
     except Exception as err:
         error_msg = f"Exception in retrieving participants with {query}: {str(err)}"
 
     if error_msg is None:
-        if cohort:
-            # cohort page requires full name
-            for participant in participants:
-                fn = participant.get("FIRST_NAME", "")
-                ln = participant.get("LAST_NAME", "")
-                participant[app.config["PAT_NAME"]] = ln + "," + fn
-        elif contacts == "y":
-            # peer coupon distribution page
-            data = []
-            for participant in participants:
-                peers = participant["contacts"]
-                dict = {k: participant[k] for k in participant if k != "contacts"}
-                for peer in peers:
-                    new_ele = copy.deepcopy(dict)
-                    fn = peer.get("FIRST_NAME", "")
-                    ln = peer.get("LAST_NAME", "")
-                    new_ele["CONTACT"] = ln + "," + fn
-                    data.append(new_ele)
-            participants = data
-
         logger.debug(f"Found {len(participants)} participants")
-        return utils.response_with_status_code(
-            "success", status.HTTP_200_OK, participants
+        return utils.set_etag(
+            utils.response_with_status_code(
+                "success", status.HTTP_200_OK, participants, extra
+            ),
+            etag,
         )
     else:
         logger.error(error_msg)
@@ -1,3 +1,6 @@
+from datetime import timezone
+
+import dateutil.parser
 import pandas as pd
 from bson.json_util import dumps
 from flask import current_app as app
@@ -8,6 +11,8 @@ from pymongo import errors
 from app import db_utils, status, utils
 from app.services import logger
 
+DUPLICATE_KEY_ERROR = 11000
+
 
 class UploadCSV(Resource):
     def post(self):
@@ -18,22 +23,29 @@ class UploadCSV(Resource):
                 f"Failed to read csv file: {str(err)}"
             )
 
-        count = 0
-        rejected = 0
-        error_list = []
-        for index, row in df.iterrows():
-            try:
-                db_utils.insert_seed(_create_seed_report_row(row))
-                count += 1
-            except errors.DuplicateKeyError as dup_error:
+        if "MRN" not in df.columns:
+            return utils.response_with_status_code("MRN is missing")
+
+        total_lines = len(df) + 1
+        columns_found = len(df.columns)
+        try:
+            docs, row_index, error_list = _create_seed_report_rows(df)
+            count, write_errors = db_utils.insert_seeds(docs)
+        except Exception as err:
+            return utils.response_with_status_code(
+                f"Failed to save seed records: {str(err)}"
+            )
+
+        for write_error in write_errors:
+            row = row_index[write_error["index"]] + 1
+            if write_error["code"] == DUPLICATE_KEY_ERROR:
                 error_msg = "Duplicate MRN"
-                logger.error(f"{error_msg} from row {index+1}: {str(dup_error)}")
-                rejected += 1
-                error_list.append({"row": index + 1, "errorMsg": error_msg})
-            except Exception as e:
-                logger.error(f"Failed to save row {index+1}: {str(e)}")
-                rejected += 1
-                error_list.append({"row": index + 1, "errorMsg": str(e)})
+            else:
+                error_msg = write_error["errmsg"]
+            logger.error(f"Failed to save row {row}: {write_error['errmsg']}")
+            error_list.append({"row": row, "errorMsg": error_msg})
+        error_list.sort(key=lambda error: error["row"])
+        rejected = len(error_list)
 
         logger.info(f"Saved {count} seed records")
         if count == 0:
@@ -43,8 +55,8 @@ class UploadCSV(Resource):
             return utils.response_with_status_code(errorMsg)
         else:
             dict = {
-                "totalLines": len(df) + 1,
-                "columnsFound": len(df.columns),
+                "totalLines": total_lines,
+                "columnsFound": columns_found,
                 "totalDataLinesInserted": count,
                 "rejectedLines": rejected,
                 "errors": error_list,
@@ -56,25 +68,67 @@ class UploadCSV(Resource):
             )
 
 
-def _create_seed_report_row(csv_row):
+def _create_seed_report_rows(df):
+    """
+    Build the seed documents column-wise from the csv data frame
+    :return: documents to insert, their row index in df and rejected rows
+    """
     # mandotory columns cannot be empty
     preferred = app.config["PREFERRED_COMM"]
-    if preferred not in csv_row:
-        csv_row[preferred] = "Email"
-
-    return {
-        **{
-            key: value
-            for key, value in csv_row.items()
-        },
-        "REPORT_DATE": utils.current_time(),
-        "STATUS": _get_status(csv_row),
-    }
+    if preferred not in df.columns:
+        df[preferred] = "Email"
+    df["REPORT_DATE"] = utils.current_time()
+    df["STATUS"] = _get_status(df)
+
+    error_list = []
+    field = app.config["RESULT_DATE"]
+    if field in df.columns:
+        df[field], date_errors = _parse_dates(df[field])
+        for index, error_msg in date_errors.items():
+            logger.error(f"Failed to save row {index+1}: {error_msg}")
+            error_list.append({"row": index + 1, "errorMsg": error_msg})
+        df = df.drop(index=list(date_errors))
+
+    # Set _id to MRN to ensure MRN is unique
+    df.insert(0, "_id", df["MRN"])
+    return df.astype(object).to_dict("records"), list(df.index), error_list
+
+
+def _parse_dates(values):
+    """
+    Parse a column of date strings, pandas handles the bulk of the column and
+    dateutil is only used for the values pandas could not parse
+    :return: column of datetimes (empty values untouched) and errors by row
+    """
+    present = values.astype(bool)
+    try:
+        # utc keeps a datetime column when the values carry different offsets,
+        # naive values are taken as utc the way mongo stores them
+        parsed = pd.to_datetime(values.where(present), errors="coerce", utc=True)
+        parsed = parsed.dt.tz_convert(None)
+    except (ValueError, TypeError):
+        parsed = pd.Series(pd.NaT, index=values.index)
+
+    resolved = parsed.notna()
+    dates = dict(zip(values.index[resolved], parsed[resolved].dt.to_pydatetime()))
+    date_errors = {}
+    for index in values.index[present & ~resolved]:
+        try:
+            parsed_date = dateutil.parser.parse(values[index])
+        except (ValueError, OverflowError, TypeError) as err:
+            date_errors[index] = str(err)
+            continue
+        if parsed_date.tzinfo is not None:
+            parsed_date = parsed_date.astimezone(timezone.utc).replace(tzinfo=None)
+        dates[index] = parsed_date
+
+    dates = pd.Series(dates, index=values.index, dtype=object)
+    return dates.where(dates.notna(), values), date_errors
 
 
-def _get_status(csv_row):
-    if "STATUS" in csv_row:
-        return csv_row["STATUS"]
+def _get_status(df):
+    if "STATUS" in df.columns:
+        return df["STATUS"]
 
     excluded_email_addresses = {
         "none@email.com",
@@ -82,11 +136,9 @@ def _get_status(csv_row):
         "none@emil.aom",
         "none@gmail.com",
     }
-    should_be_excluded = (
-        not csv_row["EMAIL_ADDRESS"]
-        or csv_row["EMAIL_ADDRESS"] in excluded_email_addresses
-    )
-    return "EXCLUDE" if should_be_excluded else "ELIGIBLE"
+    emails = df["EMAIL_ADDRESS"]
+    should_be_excluded = ~emails.astype(bool) | emails.isin(excluded_email_addresses)
+    return should_be_excluded.map({True: "EXCLUDE", False: "ELIGIBLE"})
 
 
 class UpdateSeeds(Resource):
@@ -97,31 +149,9 @@ class UpdateSeeds(Resource):
             return ret
 
         mrn = request_data.get("MRN")
-        updates = {}
-        updated_logs = ""
-        if app.config["MOBILE_NUM"] in request_data:
-            updated_mobile = request_data.get(app.config["MOBILE_NUM"])
-            logger.info("updated mobile is:" + updated_mobile)
-            updates.update({"MOBILE_NUM": updated_mobile})
-            updated_logs += f"changed mobile to: {updated_mobile}"
-        if app.config["EMAIL_ADDRESS"] in request_data:
-            updated_email = request_data.get(app.config["EMAIL_ADDRESS"])
-            logger.info("updated email is:" + updated_email)
-            updates.update({"EMAIL_ADDRESS": updated_email})
-            if updated_logs:
-                updated_logs += "; "
-            updated_logs += "email address to: " + updated_email
-        if app.config["TEST_RESULT"] in request_data:
-            myc_viewed = request_data.get(app.config["TEST_RESULT"])
-            logger.info("updated test_result is:" + myc_viewed)
-            updates.update({"TEST_RESULT": myc_viewed})
-            if updated_logs:
-                updated_logs += "; "
-            updated_logs += "TEST_RESULT to: " + myc_viewed
         try:
+            updates = _seed_updates(request_data)
             if updates:
-                updated_logs += " at:" + str(utils.current_time())
-                updates.update({"LOGS": updated_logs})
                 logger.info(f"Update seed MRN {mrn} with {updates}")
                 db_utils.update_seed_report(mrn, updates)
                 resp_msg = mrn + ": information successfully updated."
@@ -136,6 +166,123 @@ class UpdateSeeds(Resource):
             )
 
 
+class BulkUpdateSeeds(Resource):
+    def post(self):
+        # list of UpdateSeeds requests, all validated before one bulk write
+        request_data = request.get_json()
+        if not isinstance(request_data, list):
+            return utils.response_with_status_code("Expected a list of seed updates")
+        max_seeds = app.config["MAX_BULK_SEED_STATUS"]
+        if len(request_data) > max_seeds:
+            return utils.response_with_status_code(
+                f"At most {max_seeds} seeds can be updated at once"
+            )
+
+        results = []
+        pending = {}
+        for i, data in enumerate(request_data):
+            mrn = data.get("MRN") if isinstance(data, dict) else None
+            results.append({"MRN": mrn})
+            error_msg = _bulk_update_error(data, mrn, pending)
+            if error_msg:
+                results[i].update(
+                    {
+                        "status_code": status.HTTP_422_UNPROCESSABLE_ENTITY,
+                        "msg": error_msg,
+                    }
+                )
+            else:
+                pending[mrn] = i
+
+        try:
+            found = {
+                seed["MRN"]
+                for seed in db_utils.get_seed_reports(pending, {"MRN": 1, "_id": 0})
+            }
+            changes, changed = [], []
+            for mrn, i in pending.items():
+                updates = _seed_updates(request_data[i])
+                if mrn not in found:
+                    status_code = status.HTTP_422_UNPROCESSABLE_ENTITY
+                    msg = f"Seed {mrn} not found"
+                elif updates:
+                    changes.append((mrn, updates))
+                    changed.append(i)
+                    status_code = status.HTTP_200_OK
+                    msg = mrn + ": information successfully updated."
+                else:
+                    status_code = status.HTTP_200_OK
+                    msg = f"Nothing updated for MRN {mrn}"
+                results[i].update({"status_code": status_code, "msg": msg})
+            logger.info(f"Update {len(changes)} seeds")
+            write_errors = db_utils.update_seed_reports(changes)
+        except Exception as err:
+            return utils.response_with_status_code(
+                "Failed to update information for seeds: " + str(err)
+            )
+        for j, errmsg in write_errors.items():
+            results[changed[j]].update(
+                {
+                    "status_code": status.HTTP_422_UNPROCESSABLE_ENTITY,
+                    "msg": "Failed to update information for MRN: "
+                    + str(errmsg)
+                    + changes[j][0],
+                }
+            )
+
+        failed = sum(result["status_code"] != status.HTTP_200_OK for result in results)
+        return utils.response_with_status_code(
+            f"Updated {len(results) - failed} of {len(results)} seeds",
+            status.HTTP_200_OK,
+            results,
+        )
+
+
+def _bulk_update_error(data, mrn, pending):
+    if not isinstance(data, dict) or not mrn:
+        return "MRN is missing"
+    if not isinstance(mrn, str):
+        return "MRN must be a string"
+    if mrn in pending:
+        return f"Duplicate MRN {mrn}"
+    for field in ("MOBILE_NUM", "EMAIL_ADDRESS", "TEST_RESULT"):
+        if field in data and not isinstance(data[field], str):
+            return f"{field} must be a string"
+    return None
+
+
+def _seed_updates(request_data):
+    """
+    Contact corrections of an UpdateSeeds request, with LOGS describing them
+    :return: fields to set, empty if there is nothing to update
+    """
+    updates = {}
+    updated_logs = ""
+    if app.config["MOBILE_NUM"] in request_data:
+        updated_mobile = request_data.get(app.config["MOBILE_NUM"])
+        logger.info("updated mobile is:" + updated_mobile)
+        updates.update({"MOBILE_NUM": updated_mobile})
+        updated_logs += f"changed mobile to: {updated_mobile}"
+    if app.config["EMAIL_ADDRESS"] in request_data:
+        updated_email = request_data.get(app.config["EMAIL_ADDRESS"])
+        logger.info("updated email is:" + updated_email)
+        updates.update({"EMAIL_ADDRESS": updated_email})
+        if updated_logs:
+            updated_logs += "; "
+        updated_logs += "email address to: " + updated_email
+    if app.config["TEST_RESULT"] in request_data:
+        myc_viewed = request_data.get(app.config["TEST_RESULT"])
+        logger.info("updated test_result is:" + myc_viewed)
+        updates.update({"TEST_RESULT": myc_viewed})
+        if updated_logs:
+            updated_logs += "; "
+        updated_logs += "TEST_RESULT to: " + myc_viewed
+    if updates:
+        updated_logs += " at:" + str(utils.current_time())
+        updates.update({"LOGS": updated_logs})
+    return updates
+
+
 class AddNewSeed(Resource):
     def get(self):
         logger.error("Should never come here")
@@ -200,18 +347,11 @@ class SeedReport(Resource):
                 )
             }
             req_status = request.args.get("status")
+            # $in instead of $or so one index scan serves every status
             if req_status:
-                q.update({"$or": [{"STATUS": req_status.upper()}]})
+                q.update({"STATUS": req_status.upper()})
             else:
-                q.update(
-                    {
-                        "$or": [
-                            {"STATUS": "ELIGIBLE"},
-                            {"STATUS": "DEFER"},
-                            {"STATUS": "EXCLUDE"},
-                        ]
-                    }
-                )
+                q.update({"STATUS": {"$in": ["ELIGIBLE", "DEFER", "EXCLUDE"]}})
 
             if request.args.get("age"):
                 q.update(
@@ -231,13 +371,44 @@ class SeedReport(Resource):
             if request.args.get("sex"):
                 q.update({app.config["PAT_SEX"]: request.args.get("sex")})
 
-            records = db_utils.get_seeds(
-                q, app.config["SEED_REPORT_FIELDS"], app.config["REPORT_DATE"]
-            )
-            if records:
-                data = list(records)
+            limit, after, count = utils.parse_page_args(request.args)
+            since = utils.parse_since(request.args)
+            report_q = q
+            if since is not None:
+                # only what changed since the client last synced
+                synced_at = utils.current_time()
+                q = {**q, app.config["UPDATED_AT"]: {"$gte": since}}
+            # cached rows of another worker's version are not sent under this etag
+            version = db_utils.get_collection_version("seeds")
+            etag = utils.make_etag(request.path, q, limit, after, count, version)
+            not_modified = utils.not_modified_response(etag)
+            if not_modified is not None:
+                return not_modified
+
+            extra = {}
+            if limit is not None:
+                data, next_token, total = db_utils.get_seeds_page(
+                    q, app.config["SEED_REPORT_FIELDS"], limit, after, count, version
+                )
+                extra.update(utils.page_info(next_token, total))
+                logger.info(f"Found {len(data)} records for seed report page!")
+            else:
+                data = db_utils.get_seeds(
+                    q,
+                    app.config["SEED_REPORT_FIELDS"],
+                    app.config["REPORT_DATE"],
+                    version,
+                )
                 logger.info(f"Found {len(data)} records for seed report!")
-            return utils.response_with_status_code("success", status.HTTP_200_OK, data)
+            if since is not None:
+                removed = db_utils.get_removed_keys("seeds", "MRN", report_q, since)
+                extra.update(utils.since_info(synced_at, removed))
+            return utils.set_etag(
+                utils.response_with_status_code(
+                    "success", status.HTTP_200_OK, data, extra
+                ),
+                etag,
+            )
         except Exception as err:
             error_msg = "Error when retrieving daily seed report: " + str(err)
             return utils.response_with_status_code(error_msg)
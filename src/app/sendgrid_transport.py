@@ -0,0 +1,85 @@
+import requests
+from requests.adapters import HTTPAdapter
+from sendgrid.helpers.mail import Mail, Personalization, To
+
+from app.metrics import metrics
+from app.services import logger
+
+# SendGrid accepts at most 1000 personalizations per mail/send request
+MAX_PERSONALIZATIONS = 1000
+# client errors caused by the request as a whole, not by one of its recipients
+WHOLE_REQUEST_ERRORS = (401, 403, 429)
+
+
+class SendGridTransport(object):
+    """
+    SendGrid v3 mail/send client keeping one HTTP session, so its pooled TLS
+    connections are reused for every request sent by the worker
+    """
+
+    def __init__(
+        self,
+        api_key,
+        host="https://api.sendgrid.com",
+        timeout=30,
+        batch_size=MAX_PERSONALIZATIONS,
+        pool_size=10,
+    ):
+        self.url = host.rstrip("/") + "/v3/mail/send"
+        self.timeout = timeout
+        self.batch_size = min(batch_size, MAX_PERSONALIZATIONS)
+        self.session = requests.Session()
+        self.session.headers.update(
+            {
+                "Authorization": f"Bearer {api_key}",
+                "Content-Type": "application/json",
+            }
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def send(self, message):
+        """
+        Send a sendgrid Mail
+        :return: http status code of the SendGrid response
+        """
+        with metrics.timed("sendgrid"):
+            response = self.session.post(
+                self.url, json=message.get(), timeout=self.timeout
+            )
+        if response.status_code >= 300:
+            logger.error(f"SendGrid responded {response.status_code}: {response.text}")
+        return response.status_code
+
+    def send_template(self, from_email, template_id, recipients):
+        """
+        Send a dynamic template to many recipients with one personalization per
+        recipient, in as few requests as possible
+        :param recipients: list of (email, dynamic_template_data)
+        :return: status code of the request each recipient was sent in
+        """
+        status_codes = []
+        for start in range(0, len(recipients), self.batch_size):
+            batch = recipients[start : start + self.batch_size]
+            status_codes += self._send_batch(from_email, template_id, batch)
+        return status_codes
+
+    def _send_batch(self, from_email, template_id, batch):
+        message = Mail(from_email=from_email)
+        message.template_id = template_id
+        for index, (email, template_data) in enumerate(batch):
+            personalization = Personalization()
+            personalization.add_to(To(email))
+            personalization.dynamic_template_data = template_data
+            message.add_personalization(personalization, index)
+        status_code = self.send(message)
+        if 400 <= status_code < 500 and status_code not in WHOLE_REQUEST_ERRORS:
+            if len(batch) > 1:
+                # e.g. one malformed address rejects the request, send the
+                # halves so only the bad recipient fails
+                half = len(batch) // 2
+                return self._send_batch(
+                    from_email, template_id, batch[:half]
+                ) + self._send_batch(from_email, template_id, batch[half:])
+        return [status_code] * len(batch)
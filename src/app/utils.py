@@ -1,49 +1,67 @@
-import json
-import os
+import hashlib
 from datetime import datetime, timedelta
+from functools import lru_cache
 
+import dateutil.parser
 from azure.communication.sms import SmsClient
+from bson import json_util
 from flask import current_app as app
-from flask import make_response
-from sendgrid import SendGridAPIClient
-from sendgrid.helpers.mail import Mail
+from flask import make_response, request
 from xkcdpass import xkcd_password as xp
 
 from app import status
+from app.json_encoder import make_json_response
+from app.metrics import metrics
+from app.rbac import role_registry
+from app.sendgrid_transport import SendGridTransport
 from app.services import logger
 
 
 # send email via sendgrid template
 def send_email(email, token, template_id, recipient, seed=None):
+    return send_emails([(email, token, recipient, seed)], template_id)[0]
+
+
+def send_emails(invites, template_id):
+    """
+    Send the invitation template to many recipients in batched SendGrid
+    requests, one personalization per recipient
+    :param invites: list of (email, token, recipient name, seed)
+    :return: status code for each invite
+    """
     if app.testing:
         # for testing only
-        return status.HTTP_202_ACCEPTED
+        return [status.HTTP_202_ACCEPTED] * len(invites)
 
-    # Build the invitation email and submit the request to SendGrid
-    logger.info("Sending email through sendgrid to recipient:" + email)
-    message = Mail(
-        from_email=app.config["SENDGRID_FROM_ADDRESS"],
-        to_emails=email,
-    )
     expire_date = datetime.today() + timedelta(
         days=int(app.config["TTLD_GENERATION_TO_CONSENT"])
     )
     date_time = expire_date.strftime("%m-%d-%Y")
+    recipients = []
+    for email, token, recipient, seed in invites:
+        logger.info("Sending email through sendgrid to recipient:" + email)
+        dict = {
+            "coupon": token,
+            "expireDate": date_time,
+            "url": app.config["REACT_APP_UI_ROOT"],
+            "user": recipient,
+        }
+        if seed:
+            dict["seed"] = seed
+        recipients.append((email, dict))
+
+    transport = _sendgrid_transport(
+        app.config["SENDGRID_API_KEY"], app.config["SENDGRID_API_HOST"]
+    )
+    return transport.send_template(
+        app.config["SENDGRID_FROM_ADDRESS"], template_id, recipients
+    )
 
-    dict = {
-        "coupon": token,
-        "expireDate": date_time,
-        "url": app.config["REACT_APP_UI_ROOT"],
-        "user": recipient,
-    }
-    if seed:
-        dict["seed"] = seed
-    message.dynamic_template_data = dict
-    message.template_id = template_id
-    sendgrid_client = SendGridAPIClient(app.config["SENDGRID_API_KEY"])
-    sendgrid_response = sendgrid_client.send(message)
 
-    return sendgrid_response.status_code
+@lru_cache(maxsize=None)
+def _sendgrid_transport(api_key, host):
+    # one long lived transport per worker process
+    return SendGridTransport(api_key, host)
 
 
 # send SMS text message via AWS Pinpoint
@@ -54,11 +72,12 @@ def send_sms_txt(phone_number, coupon):
     message = generate_sms_message(coupon)
     client = SmsClient.from_connection_string(app.config["SMS_CONNECTION_STRING"])
     to_number = "+1" + phone_number.replace("-", "")
-    responses = client.send(
-        from_=app.config["SMS_PHONE_NUMBER"],
-        to=to_number,
-        message=message,
-    )
+    with metrics.timed("sms"):
+        responses = client.send(
+            from_=app.config["SMS_PHONE_NUMBER"],
+            to=to_number,
+            message=message,
+        )
     for response in responses:
         if response.successful:
             logger.info(f"SMS message successfully sent to {to_number}")
@@ -82,15 +101,19 @@ def generate_sms_message(coupon):
     return message
 
 
+@lru_cache(maxsize=None)
+def _coupon_wordlist():
+    # the word file is read and filtered once per process
+    word_file = xp.locate_wordfile()
+    return xp.generate_wordlist(wordfile=word_file, min_length=4, max_length=5)
+
+
 def generate_coupon():
     """
     Generate the coupon
     :return: 4 words coupon
     """
-    # """"""
-    word_file = xp.locate_wordfile()
-    my_words = xp.generate_wordlist(wordfile=word_file, min_length=4, max_length=5)
-    coupon = xp.generate_xkcdpassword(my_words, numwords=4)
+    coupon = xp.generate_xkcdpassword(_coupon_wordlist(), numwords=4)
     coupon = "-".join(coupon.title().split())
 
     return coupon
@@ -104,21 +127,45 @@ def current_time():
 
 
 def response_with_status_code(
-    msg, status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, data=None
+    msg, status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, data=None, extra=None
 ):
     resp = {"reason": msg}
     if data:
         resp["records"] = data
         resp["result"] = len(data)
+    if extra:
+        resp.update(extra)
     if status_code != status.HTTP_200_OK:
         resp["result"] = 0
         logger.error(resp)
-    response = make_response(resp)
-    response.status_code = status_code
+    return make_json_response(resp, status_code)
+
 
+def make_etag(*parts):
+    # parts are the query, options and collection version of a report
+    return hashlib.sha1(
+        json_util.dumps(parts, sort_keys=True).encode("utf-8")
+    ).hexdigest()
+
+
+def set_etag(response, etag):
+    # weak, the body may be re-encoded on the way to the client
+    response.set_etag(etag, weak=True)
+    # clients revalidate before every use
+    response.headers["Cache-Control"] = "no-cache"
     return response
 
 
+def not_modified_response(etag):
+    """
+    :return: 304 response if the client already has the representation with
+        this etag (If-None-Match), otherwise None
+    """
+    if not request.if_none_match.contains_weak(etag):
+        return None
+    return set_etag(make_response("", status.HTTP_304_NOT_MODIFIED), etag)
+
+
 def unauthorized_response():
     logger.info("Current user does not have permission to access this information.")
     resp = make_response(app.config["UNAUTHORIZED_MESSAGE"])
@@ -126,17 +173,22 @@ def unauthorized_response():
     return resp
 
 
-def get_access_role(net_id):
-    with open(
-        os.path.join(os.path.dirname(__file__), "", "rbac_config.json")
-    ) as json_file:
-        access_roles = json.load(json_file)
+def current_user():
+    """
+    netId of the signed in user, from AUTH_USER_HEADER set by the
+    authenticating proxy or REMOTE_USER set by the wsgi server
+    :return: netId, None if unknown
+    """
+    return request.headers.get(app.config["AUTH_USER_HEADER"]) or request.environ.get(
+        "REMOTE_USER"
+    )
 
-        if access_roles.get(net_id):
-            return access_roles.get(net_id).get("role")
-        else:
-            logger.warning("This netId doesn't exist on access roles list.")
-            return None
+
+def get_access_role(net_id):
+    role = role_registry.role(net_id)
+    if role is None:
+        logger.warning("This netId doesn't exist on access roles list.")
+    return role
 
 
 def count_list_of_lists(input_lists):
@@ -155,7 +207,60 @@ def parse_age_group(age_group):
 
 
 def parse_date_range(date_range):
-    return {"$gte": (current_time() - timedelta(int(date_range)))}
+    start = current_time() - timedelta(int(date_range))
+    granularity = app.config["REPORT_DATE_GRANULARITY"]
+    if granularity:
+        # round down so report queries only change every granularity seconds
+        seconds = start.hour * 3600 + start.minute * 60 + start.second
+        start = start.replace(microsecond=0) - timedelta(seconds=seconds % granularity)
+    return {"$gte": start}
+
+
+def parse_page_args(args):
+    """
+    Pagination request args: limit, after (token of the previous page) and
+    count=y to include the total number of matches
+    :return: (limit, after, count), limit is None if not paginated
+    """
+    limit = args.get("limit")
+    if limit is None:
+        return None, None, False
+    limit = int(limit)
+    if limit < 1 or limit > app.config["MAX_PAGE_SIZE"]:
+        raise ValueError(f"limit must be between 1 and {app.config['MAX_PAGE_SIZE']}")
+    return limit, args.get("after"), args.get("count") == "y"
+
+
+def parse_since(args):
+    """
+    The since request arg: only documents written at or after it are listed
+    :return: since as a naive local datetime like current_time, moved back by
+        SINCE_MARGIN_SECONDS, None if not set
+    """
+    since = args.get("since")
+    if since is None:
+        return None
+    since = dateutil.parser.parse(since)
+    if since.tzinfo is not None:
+        since = since.astimezone().replace(tzinfo=None)
+    if since < current_time() - timedelta(days=app.config["TOMBSTONE_TTL_DAYS"]):
+        raise ValueError("since is older than deleted records are kept, reload all")
+    return since - timedelta(seconds=app.config["SINCE_MARGIN_SECONDS"])
+
+
+def since_info(synced_at, removed):
+    # sync fields added to the response of a since request, synced_at is the
+    # since of the next request. It is sent as iso with its utc offset, an http
+    # date of the naive local time is only right when local time is utc
+    return {"synced_at": synced_at.astimezone().isoformat(), "removed": removed}
+
+
+def page_info(next_token, total):
+    # pagination fields added to the response next to records
+    extra = {"next": next_token}
+    if total is not None:
+        extra["total"] = total
+    return extra
 
 
 def record_id_str(record_id):
@@ -26,6 +26,7 @@ def load_seeds_for_participant_testing():
     # remove all existing seeds and participants
     db_utils.remove_collection("seeds")
     db_utils.remove_collection("participants")
+    db_utils.remove_collection("counters")
     # db_utils.remove_all_collections()
     file = "test-data/seeds.json"
     return _import_data_from_json(file, "seeds")
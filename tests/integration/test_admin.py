@@ -3,6 +3,7 @@ from base64 import b64decode
 from pathlib import Path
 
 from app import db_utils, status
+from app.resources.admin import _generate_csv
 from app.services import api
 
 # import pytest
@@ -42,6 +43,54 @@ class TestAdmin:
         assert response.json.get("version") == 2
         assert "uploadDate" in response.json
 
+        # a new upload replaces the cached latest version
+        newdata = {"comments": "test version 3", "form": open(path / file, "rb")}
+        response = client.post("/api/consentform", data=newdata)
+        assert response.status_code == status.HTTP_200_OK
+        response = client.get("/api/consentform")
+        assert response.json.get("version") == 3
+        response = client.get("/api/consentform?version=2")
+        assert response.json.get("version") == 2
+
+    def test_consent_form_pdf(self, client):
+        file = "test-data/Consent.pdf"
+        path = Path(__file__).parent.parent.absolute()
+        pdf = open(path / file, "rb").read()
+        response = client.get("/api/consentformpdf?version=1")
+        assert response.status_code == status.HTTP_200_OK
+        assert response.mimetype == "application/pdf"
+        assert response.data == pdf
+        assert response.cache_control.immutable
+        etag = response.headers["ETag"]
+
+        # cached copy is still valid
+        response = client.get(
+            "/api/consentformpdf?version=1", headers={"If-None-Match": etag}
+        )
+        assert response.status_code == status.HTTP_304_NOT_MODIFIED
+
+        # partial content
+        response = client.get(
+            "/api/consentformpdf?version=1", headers={"Range": "bytes=100-199"}
+        )
+        assert response.status_code == status.HTTP_206_PARTIAL_CONTENT
+        assert response.data == pdf[100:200]
+
+        # latest version must be revalidated
+        response = client.get("/api/consentformpdf")
+        assert response.status_code == status.HTTP_200_OK
+        assert response.cache_control.no_cache
+        assert response.headers["ETag"] != etag
+
+    def test_download_header(self, app):
+        rows = [{"MRN": "1", "STATUS": "INCLUDE"}, {"MRN": "2", "ZIP": "27701"}]
+        rows.append({"MRN": "3", "LATE": "x"})
+        chunks = list(_generate_csv(iter(rows), 2))
+        # fields of later rows are kept, the header goes out with the first batch
+        assert chunks[0] == "MRN,STATUS,ZIP,LATE\n1,INCLUDE,,\n2,,27701,\n"
+        assert chunks[1] == "3,,,x\n"
+        assert list(_generate_csv(iter([]), 2)) == ["\n"]
+
     def test_download_from_url(self, client):
         url = "https://raw.githubusercontent.com/duke-crucible/snowballgr-api/master/tests/test-data/seeds_10.csv"
         response = client.get(f"/api/downloadfile?url={url}")
@@ -0,0 +1,39 @@
+from app.advisor import plan_issues, plan_stages
+
+
+class TestIndexAdvisor:
+    def test_index_scan(self):
+        explain = {
+            "queryPlanner": {
+                "winningPlan": {
+                    "stage": "FETCH",
+                    "inputStage": {
+                        "stage": "SORT_MERGE",
+                        "inputStages": [
+                            {"stage": "IXSCAN", "indexName": "STATUS_1"},
+                            {"stage": "IXSCAN", "indexName": "STATUS_1"},
+                        ],
+                    },
+                }
+            }
+        }
+        assert plan_stages(explain["queryPlanner"]["winningPlan"]) == [
+            "FETCH",
+            "SORT_MERGE",
+            "IXSCAN",
+            "IXSCAN",
+        ]
+        assert plan_issues(explain) == []
+
+    def test_collscan_and_sort(self):
+        explain = {
+            "queryPlanner": {
+                "winningPlan": {
+                    "queryPlan": {
+                        "stage": "SORT",
+                        "inputStage": {"stage": "COLLSCAN"},
+                    }
+                }
+            }
+        }
+        assert plan_issues(explain) == ["COLLSCAN", "SORT"]
@@ -0,0 +1,84 @@
+import json
+import zlib
+
+import brotli
+import pytest
+import zstandard
+from flask import Flask
+from prepare_test_data import load_seeds_for_participant_testing
+
+from app import status
+from app.compression import COMPRESSORS, Compression, compression
+
+
+def gunzip(data):
+    return zlib.decompress(data, 31)
+
+
+DECOMPRESS = {
+    "gzip": gunzip,
+    "br": brotli.decompress,
+    "zstd": lambda data: zstandard.ZstdDecompressor().decompressobj().decompress(data),
+}
+
+
+class TestCompression:
+    def test_negotiated_gzip(self, client):
+        load_seeds_for_participant_testing()
+        plain = client.get("/api/seedreport")
+        assert plain.status_code == status.HTTP_200_OK
+        assert "Content-Encoding" not in plain.headers
+        assert plain.headers["Vary"] == "Accept-Encoding"
+
+        headers = {"Accept-Encoding": "gzip;q=1.0, identity;q=0.5"}
+        response = client.get("/api/seedreport", headers=headers)
+        assert response.headers["Content-Encoding"] == "gzip"
+        body = response.get_data()
+        assert int(response.headers["Content-Length"]) == len(body)
+        assert len(body) < len(plain.get_data())
+        assert json.loads(gunzip(body)) == plain.json
+        assert response.headers["ETag"] == plain.headers["ETag"]
+
+        # gzip not accepted
+        headers = {"Accept-Encoding": "gzip;q=0, identity"}
+        response = client.get("/api/seedreport", headers=headers)
+        assert "Content-Encoding" not in response.headers
+
+    def test_small_responses_are_not_compressed(self, client, monkeypatch):
+        monkeypatch.setattr(compression, "min_size", 10**6)
+        response = client.get("/api/seedreport", headers={"Accept-Encoding": "gzip"})
+        assert response.status_code == status.HTTP_200_OK
+        assert "Content-Encoding" not in response.headers
+
+    def test_streamed_download(self, client, monkeypatch):
+        monkeypatch.setitem(client.application.config, "DOWNLOAD_BATCH_SIZE", 2)
+        plain = client.get("/api/download?type=seeds").get_data()
+        response = client.get(
+            "/api/download?type=seeds", headers={"Accept-Encoding": "gzip"}
+        )
+        assert response.status_code == status.HTTP_200_OK
+        assert response.headers["Content-Encoding"] == "gzip"
+        assert "Content-Length" not in response.headers
+        # every chunk can be decoded as soon as it arrives
+        decompressor = zlib.decompressobj(31)
+        rows = b""
+        for chunk in response.response:
+            rows += decompressor.decompress(chunk)
+            assert rows.endswith(b"\n")
+        assert rows == plain
+
+    @pytest.mark.parametrize("encoding", sorted(COMPRESSORS))
+    def test_compressors(self, encoding):
+        data = b"MRN,PAT_NAME,STATUS\n" + b"MRN0000001,Smith,John,ELIGIBLE\n" * 100
+        compressor = COMPRESSORS[encoding](3)
+        compressed = compressor.compress(data[:50]) + compressor.compress(data[50:])
+        compressed += compressor.finish()
+        assert len(compressed) < len(data) / 5
+        assert DECOMPRESS[encoding](compressed) == data
+
+    def test_unsupported_encoding(self, app):
+        config = {**app.config, "COMPRESS_ENCODINGS": ["zstd", "deflate"]}
+        other = Flask(__name__)
+        other.config.update(config)
+        with pytest.raises(ValueError, match="deflate"):
+            Compression(other)
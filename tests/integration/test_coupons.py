@@ -0,0 +1,55 @@
+from itertools import cycle
+
+from app import db_utils, utils
+from app.coupons import CouponPool, coupon_pool
+from app.resources.invite import _insert_participants
+
+
+def make_pool(app, monkeypatch, coupons, issued=()):
+    generated = cycle(coupons)
+    monkeypatch.setattr(utils, "generate_coupon", lambda: next(generated))
+    monkeypatch.setattr(
+        db_utils, "get_issued_coupons", lambda candidates: set(issued) & candidates
+    )
+    pool = CouponPool(app)
+    pool.size = 3
+    pool.low_water = 0
+    return pool
+
+
+class TestCouponPool:
+    def test_refill(self, app, monkeypatch):
+        # neither issued coupons nor coupons already in the pool are added
+        pool = make_pool(app, monkeypatch, ["A", "B", "A", "C"], issued=["B"])
+        pool.refill()
+        assert list(pool._coupons) == ["A"]
+        pool.refill()
+        assert list(pool._coupons) == ["A", "C"]
+
+    def test_pop_unique(self, app, monkeypatch):
+        pool = make_pool(app, monkeypatch, ["A", "B", "C", "D", "E", "F"])
+        # a drained pool is refilled within the pop
+        popped = [pool.pop() for _ in range(6)]
+        assert sorted(popped) == ["A", "B", "C", "D", "E", "F"]
+
+    def test_insert_coupon_collision(self, app, monkeypatch):
+        # the unique coupon index is only created outside of local and test
+        participants = db_utils.get_db_handle()[
+            app.config["COLLECTIONS"]["participants"]
+        ]
+        index = participants.create_index("COUPON", unique=True, sparse=True)
+        try:
+            db_utils.insert_participants([{"_id": "coupon-1", "COUPON": "Taken"}])
+            monkeypatch.setattr(coupon_pool, "pop", lambda: "Fresh")
+            docs = [
+                {"_id": "coupon-2", "COUPON": "Taken"},
+                {"_id": "coupon-1", "COUPON": "Other"},
+            ]
+            # issued by another worker: new coupon, duplicate _id: failed
+            write_errors = _insert_participants(docs)
+            assert [error["index"] for error in write_errors] == [1]
+            assert docs[0]["COUPON"] == "Fresh"
+            assert participants.find_one({"_id": "coupon-2"})["COUPON"] == "Fresh"
+        finally:
+            participants.delete_many({"_id": {"$in": ["coupon-1", "coupon-2"]}})
+            participants.drop_index(index)
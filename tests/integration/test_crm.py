@@ -1,6 +1,6 @@
 from prepare_test_data import load_seeds_for_participant_testing
 
-from app import status
+from app import db_utils, status
 
 
 class TestCRM:
@@ -21,6 +21,24 @@ class TestCRM:
         assert len(records) == 2
         assert any(record["MRN"] == test_data[0]["MRN"] for record in records)
         assert any(record["MRN"] == test_data[1]["MRN"] for record in records)
+        # fields computed by mongo
+        for record in records:
+            assert record["PAT_NAME"] == f"{record['LAST_NAME']},{record['FIRST_NAME']}"
+            assert record["DAYS_SINCE_COUPON_ISSUE"] == 0
+        age_groups = {record["MRN"]: record["AGE_GROUP"] for record in records}
+        assert age_groups[test_data[1]["MRN"]] == "21-40"
+
+        # Test pagination
+        response = client.get("/api/cohort?limit=1")
+        assert response.status_code == status.HTTP_200_OK
+        first = response.json.get("records")
+        assert len(first) == 1
+        assert "total" not in response.json
+        response = client.get(f"/api/cohort?limit=1&after={response.json['next']}")
+        second = response.json.get("records")
+        assert len(second) == 1
+        assert response.json.get("next") is None
+        assert {first[0]["MRN"], second[0]["MRN"]} == {r["MRN"] for r in records}
 
         # Test filter days
         response = client.get("/api/cohort?date_range=5")
@@ -71,3 +89,71 @@ class TestCRM:
         assert response.status_code == status.HTTP_200_OK
         comments = response.json.get("records").get("comments")
         assert comment == comments[0].get("comment")
+
+        # fields posted with a comment are read back, bookkeeping ones are not
+        update = {"RECORD_ID": "1", "comment": comment, "author": "tester"}
+        response = client.post("/api/crm", json=update)
+        assert response.status_code == status.HTTP_200_OK
+        for url in ("/api/crm?record_id=1", "/api/crm?record_id=1&limit=1"):
+            response = client.get(url)
+            latest = response.json["records"]["comments"][0]
+            assert latest == {
+                "time": latest["time"],
+                "comment": comment,
+                "author": "tester",
+            }
+
+    def test_crm_comments_pages(self, app, client):
+        record_id = 1
+        for i in range(app.config["CRM_LATEST_COMMENTS"] + 2):
+            update = {"RECORD_ID": record_id, "comment": f"Paged comment {i}"}
+            response = client.post("/api/crm", json=update)
+            assert response.status_code == status.HTTP_200_OK
+        response = client.get(f"/api/crm?record_id={record_id}")
+        comments = response.json["records"]["comments"]
+        assert "next" not in response.json
+
+        # pages follow each other, newest first
+        response = client.get(f"/api/crm?record_id={record_id}&limit=3")
+        assert response.status_code == status.HTTP_200_OK
+        first = response.json["records"]["comments"]
+        assert first == comments[:3]
+        assert first[0]["comment"].startswith("Paged comment")
+        url = f"/api/crm?record_id={record_id}&limit=3&after={response.json['next']}"
+        response = client.get(url)
+        assert response.json["records"]["comments"] == comments[3:6]
+        response = client.get(f"/api/crm?record_id={record_id}&limit=0")
+        assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
+
+        # the participant only keeps the latest comments
+        participant = db_utils.get_participant("RECORD_ID", record_id)
+        latest = participant["comments"]
+        assert len(latest) == app.config["CRM_LATEST_COMMENTS"]
+        assert latest == comments[: len(latest)]
+
+    def test_migrate_comments(self, app, client):
+        record_id = 2
+        old = [
+            {"time": f"2020-01-0{day}T10:00:00", "comment": f"Old comment {day}"}
+            for day in range(9, 0, -1)
+        ]
+        # the same comment saved twice is kept twice
+        old.insert(5, dict(old[4]))
+        participants = app.config["COLLECTIONS"]["participants"]
+        db_utils.get_db_handle()[participants].update_one(
+            {"RECORD_ID": record_id}, {"$push": {"comments": {"$each": old}}}
+        )
+        before = len(db_utils.get_comments(record_id)[0])
+        runner = app.test_cli_runner()
+        result = runner.invoke(args=["migrate-comments", "--batch-size", "1"])
+        assert result.exit_code == 0
+        comments = db_utils.get_comments(record_id)[0]
+        # migrating again copies nothing
+        result = runner.invoke(args=["migrate-comments"])
+        assert result.exit_code == 0
+        assert db_utils.get_comments(record_id)[0] == comments
+
+        participant = db_utils.get_participant("RECORD_ID", record_id)
+        assert len(comments) == before + len(old)
+        assert comments[-len(old) :] == old
+        assert len(participant["comments"]) <= app.config["CRM_LATEST_COMMENTS"]
@@ -0,0 +1,67 @@
+import time
+from datetime import date, datetime, timedelta, timezone
+
+from bson import ObjectId
+from flask import jsonify
+from flask_restful.representations.json import output_json
+
+from app import json_encoder
+
+
+class TestJSONEncoder:
+    def test_same_output_as_flask(self, app):
+        data = {
+            "records": [
+                {
+                    "MRN": "MRN0000001",
+                    "LAST_NAME": 'Núñez 李 😀\x7f\n"',
+                    "PAT_AGE": 45,
+                    "SCORE": 0.1,
+                    "REPORT_DATE": datetime(2021, 3, 4, 5, 6, 7, 891011),
+                    "TEST_DATE": date(2021, 3, 4),
+                    "peer-coupons": ["Apple-Pie-42", None, True],
+                }
+            ],
+            "reason": "success",
+            "result": 1,
+        }
+        debug = app.debug
+        try:
+            for app.debug in (False, True):
+                expected = jsonify(data).get_data(as_text=True)
+                assert (
+                    json_encoder.make_json_response(data).get_data(as_text=True)
+                    == expected
+                )
+        finally:
+            app.debug = debug
+
+    def test_dates_on_local_time_host(self, app, monkeypatch):
+        # flask formats dates through local time, match it off UTC and in DST
+        data = [
+            datetime(2021, 7, 4, 5, 6, 7),
+            datetime(2021, 1, 4, 23, 30),
+            datetime(2021, 7, 4, 5, 6, tzinfo=timezone(timedelta(hours=-4))),
+            date(2021, 7, 4),
+            date(2021, 1, 4),
+        ]
+        monkeypatch.setattr(app, "debug", False)
+        monkeypatch.setenv("TZ", "America/New_York")
+        time.tzset()
+        try:
+            assert json_encoder.dumps(data) == json_encoder._stdlib_dumps(data, False)
+        finally:
+            monkeypatch.undo()
+            time.tzset()
+
+    def test_mongo_types(self, app):
+        _id = ObjectId()
+        encoded = json_encoder.dumps({"_id": _id, "data": b"%PDF"})
+        assert str(_id) in encoded
+        assert "JVBERg==" in encoded
+
+    def test_plain_resources_unchanged(self, app, client):
+        # resources returning plain data keep the flask restful encoding
+        response = client.get("/api/healthcheck")
+        expected = output_json(response.json, response.status_code)
+        assert response.get_data() == expected.get_data()
@@ -0,0 +1,70 @@
+import json
+import os
+from types import SimpleNamespace
+
+from app import status
+from app.metrics import DEAD_WORKERS, metrics
+
+
+class TestMetrics:
+    def test_metrics_endpoint(self, client):
+        response = client.get("/api/healthcheck")
+        assert response.status_code == status.HTTP_200_OK
+
+        # another worker with its own metrics file
+        other = os.path.join(metrics.directory, "other-worker.json")
+        labels = {"endpoint": "healthcheck"}
+        with open(other, "w") as f:
+            json.dump(
+                {
+                    "histograms": [],
+                    "counters": [["snowballgr_mongo_commands_total", labels, 5]],
+                },
+                f,
+            )
+        try:
+            response = client.get("/api/metrics")
+        finally:
+            os.remove(other)
+        assert response.status_code == status.HTTP_200_OK
+        assert response.mimetype == "text/plain"
+        text = response.get_data(as_text=True)
+        assert "# TYPE snowballgr_request_duration_seconds histogram" in text
+        assert (
+            'snowballgr_request_duration_seconds_count{endpoint="healthcheck",'
+            'method="GET"}'
+        ) in text
+        assert 'le="+Inf"' in text
+        commands = [
+            line
+            for line in text.splitlines()
+            if line.startswith(
+                'snowballgr_mongo_commands_total{endpoint="healthcheck"}'
+            )
+        ]
+        assert len(commands) == 1
+        assert float(commands[0].split()[-1]) >= 5
+
+    def test_mongo_commands_of_request(self, app):
+        with app.test_request_context("/api/seedreport"):
+            metrics._before_request()
+            metrics._listener.succeeded(SimpleNamespace(duration_micros=1500))
+            metrics._listener.succeeded(SimpleNamespace(duration_micros=500))
+            assert metrics._local.commands == 2
+            assert metrics._local.mongo_seconds == 0.002
+            metrics._after_request(None)
+
+    def test_mark_process_dead(self, tmp_path):
+        name = "snowballgr_mongo_commands_total"
+        labels = {"endpoint": "healthcheck"}
+        for pid in (101, 102):
+            with open(tmp_path / f"{pid}.json", "w") as f:
+                json.dump({"histograms": [], "counters": [[name, labels, pid]]}, f)
+
+        # exited workers are folded into one file, totals are kept
+        metrics.mark_process_dead(101, str(tmp_path))
+        metrics.mark_process_dead(102, str(tmp_path))
+        metrics.mark_process_dead(103, str(tmp_path))
+        assert sorted(os.listdir(tmp_path)) == [f"{DEAD_WORKERS}.json"]
+        with open(tmp_path / f"{DEAD_WORKERS}.json") as f:
+            assert json.load(f)["counters"] == [[name, labels, 203]]
@@ -1,12 +1,14 @@
 import copy
-from datetime import date, timedelta
+from datetime import date, timedelta, timezone
 from pathlib import Path
 
 import pytest
 import pytz
+from flask import json
 from prepare_test_data import load_seeds_for_participant_testing
 
-from app import status, utils
+from app import db_utils, status, utils
+from app.outbox import outbox
 
 
 class SharedData:
@@ -188,6 +190,14 @@ class TestParticipants:
         records = response.json.get("records")
         assert len(records) == 2
         assert all(record["RECORD_ID"] == 1 for record in records)
+        assert [record["CONTACT"] for record in records] == ["Doe,Jane", "Doe,Mike"]
+        assert all("contacts" not in record for record in records)
+
+        # Test paging by participant
+        response = client.get("/api/participants?contacts=y&limit=1&count=y")
+        assert len(response.json.get("records")) == 2
+        assert response.json.get("total") == 1
+        assert response.json.get("next") is None
 
         response = client.get("/api/participants?contacts=n")
         assert response.status_code == status.HTTP_200_OK
@@ -223,14 +233,12 @@ class TestParticipants:
         data = {"RECORD_ID": 1}
         response = client.post("/api/invitepeer", json=data)
         assert response.status_code == status.HTTP_200_OK
-        assert b"Successfully sent 1 coupons" in response.data
+        assert b"Queued 1 coupons" in response.data
 
         data = {"RECORD_ID": 2}
         response = client.post("/api/invitepeer", json=data)
         assert response.status_code == status.HTTP_200_OK
-        assert f"Successfully sent {p_env.num_coupons} coupons" in response.json.get(
-            "reason"
-        )
+        assert f"Queued {p_env.num_coupons} coupons" in response.json.get("reason")
 
         response = client.get("/api/participants?contacts=y")
         assert response.status_code == status.HTTP_200_OK
@@ -275,6 +283,12 @@ class TestParticipants:
         records = response.json.get("records")
         assert len(records) == 1
         assert records[0]["EMAIL_ADDRESS"] == data["email"]
+        # conditional get, not modified until the next update
+        etag = response.headers["ETag"]
+        response = client.get("/api/testschedule", headers={"If-None-Match": etag})
+        assert response.status_code == status.HTTP_304_NOT_MODIFIED
+        assert response.headers["ETag"] == etag
+        assert response.data == b""
 
         update = {"RECORD_ID": 3, "TEST_DATE": date.today().strftime("%a, %d %b %Y")}
         response = client.post("/api/testschedule", json=update)
@@ -284,7 +298,9 @@ class TestParticipants:
         update["RESULT_NOTIFIED"] = "Yes"
         response = client.post("/api/testschedule", json=update)
         assert response.status_code == status.HTTP_200_OK
-        response = client.get("/api/testschedule")
+        response = client.get("/api/testschedule", headers={"If-None-Match": etag})
+        assert response.status_code == status.HTTP_200_OK
+        assert response.headers["ETag"] != etag
         records = response.json.get("records")
         assert len(records) == 1
         assert records[0]["TEST_RESULT"] == update["TEST_RESULT"]
@@ -293,3 +309,64 @@ class TestParticipants:
             in records[0]["RESULT_DATE"]
         )
         assert records[0]["RESULT_NOTIFIED"] == update["RESULT_NOTIFIED"]
+
+    def test_since_sync(self, app, client):
+        # since is moved back by the margin, skip the writes of earlier tests
+        margin = timedelta(seconds=app.config["SINCE_MARGIN_SECONDS"])
+        since = (utils.current_time() + margin).isoformat()
+        response = client.get(f"/api/cohort?since={since}")
+        assert response.status_code == status.HTTP_200_OK
+        assert response.json.get("records") is None
+        assert response.json.get("removed") == []
+        synced_at = response.json.get("synced_at")
+
+        # a changed participant, and a new one deleted again
+        response = client.post("/api/crm", json={"RECORD_ID": 3, "comment": "sync"})
+        assert response.status_code == status.HTTP_200_OK
+        db_utils.insert_participants([{"_id": "00009999", "RECORD_ID": 9999}])
+        db_utils.delete_participant("00009999")
+        response = client.get(f"/api/cohort?since={since}")
+        assert [record["RECORD_ID"] for record in response.json.get("records")] == [3]
+        assert response.json.get("removed") == [9999]
+
+        # the synced_at of the response works as since
+        response = client.get(f"/api/testschedule?since={synced_at}")
+        assert response.status_code == status.HTTP_200_OK
+
+        response = client.get("/api/cohort?since=2000-01-01T00:00:00")
+        assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
+
+    def test_parse_since(self, app):
+        # since with any time zone compares with the naive local stamps
+        now = utils.current_time().replace(microsecond=0)
+        margin = timedelta(seconds=app.config["SINCE_MARGIN_SECONDS"])
+        for tz in (timezone.utc, timezone(timedelta(hours=-5))):
+            args = {"since": now.astimezone(tz).isoformat()}
+            assert utils.parse_since(args) == now - margin
+        assert utils.parse_since({"since": now.isoformat()}) == now - margin
+        synced_at = json.loads(json.dumps(utils.since_info(now, [])))["synced_at"]
+        assert utils.parse_since({"since": synced_at}) == now - margin
+
+    def test_invite_peers_not_queued(self, app, client, monkeypatch):
+        def fail(messages):
+            raise RuntimeError("outbox unavailable")
+
+        # peers whose coupon could not be queued are removed again
+        participants = db_utils.get_db_handle()[
+            app.config["COLLECTIONS"]["participants"]
+        ]
+        num_participants = participants.count_documents({})
+        monkeypatch.setattr(outbox, "enqueue", fail)
+        data = {"RECORD_ID": 1}
+        response = client.post("/api/invitepeer", json=data)
+        assert response.status_code == status.HTTP_500_INTERNAL_SERVER_ERROR
+        assert b"Failed to queue any coupons" in response.data
+        assert participants.count_documents({}) == num_participants
+
+    def test_outbox_finished(self, app):
+        # delivered messages are kept OUTBOX_RETENTION_DAYS from finished_at
+        outbox_coll = db_utils.get_db_handle()[app.config["COLLECTIONS"]["outbox"]]
+        sent = list(outbox_coll.find({"status": "sent"}))
+        assert sent
+        assert all(message["finished_at"] for message in sent)
+        assert outbox_coll.count_documents({"status": "sending"}) == 0
@@ -0,0 +1,65 @@
+import json
+import os
+import signal
+
+from app.rbac import RoleRegistry
+
+
+def write_roles(path, roles, mtime):
+    with open(path, "w") as f:
+        json.dump(roles, f)
+    os.utime(path, ns=(mtime, mtime))
+
+
+class TestRoleRegistry:
+    def test_lookup_and_reload(self, app, tmp_path):
+        path = str(tmp_path / "rbac_config.json")
+        write_roles(
+            path,
+            {"roles": {"admin": ["seeds", "download"]}, "abc123": {"role": "admin"}},
+            1_000_000_000,
+        )
+        registry = RoleRegistry()
+        registry.path = path
+        assert registry.role("abc123") == "admin"
+        assert registry.role("xyz789") is None
+        assert registry.permissions("admin") == frozenset(["seeds", "download"])
+        assert registry.has_permission("abc123", "download")
+        assert not registry.has_permission("xyz789", "download")
+
+        # picked up once the file modification time changes
+        write_roles(path, {"xyz789": {"role": "viewer"}}, 2_000_000_000)
+        assert registry.role("xyz789") == "viewer"
+        assert registry.role("abc123") is None
+
+        # not checked again within the interval unless signaled
+        registry.check_interval = 3600
+        registry.role("xyz789")
+        write_roles(path, {"xyz789": {"role": "admin"}}, 2_000_000_000)
+        assert registry.role("xyz789") == "viewer"
+        registry._on_signal(signal.SIGHUP, None)
+        assert registry.role("xyz789") == "admin"
+
+    def test_signal_handler_not_installed(self, app):
+        handler = signal.getsignal(signal.SIGHUP)
+        RoleRegistry(app)
+        assert signal.getsignal(signal.SIGHUP) is handler
+
+    def test_invalid_entries(self, app, tmp_path):
+        path = str(tmp_path / "rbac_config.json")
+        roles = {
+            "roles": {"admin": ["seeds"], "viewer": "seeds"},
+            "abc123": {"role": "admin"},
+            "xyz789": "admin",
+        }
+        write_roles(path, roles, 1_000_000_000)
+        registry = RoleRegistry()
+        registry.path = path
+        # malformed entries are skipped, the rest is loaded
+        assert registry.role("abc123") == "admin"
+        assert registry.role("xyz789") is None
+        assert registry.permissions("viewer") == frozenset()
+
+        # a file that is not a mapping keeps the roles loaded before
+        write_roles(path, ["abc123"], 2_000_000_000)
+        assert registry.role("abc123") == "admin"
@@ -1,6 +1,10 @@
 import json
+from datetime import datetime
+from io import BytesIO
 from pathlib import Path
 
+from pymongo import errors
+
 from app import db_utils, status, utils
 
 # from app.services import logger
@@ -109,14 +113,14 @@ class TestSeeds:
         update = {"MRN": "MRN0000008", "STATUS": "INCLUDE"}
         response = client.post("/api/seedstatus", json=update)
         assert response.status_code == status.HTTP_200_OK
-        assert b"Successfully sent coupon " in response.data
+        assert b"Queued coupon " in response.data
         assert b"snowballgr@duketest.com" in response.data
 
         # Test invite with sms
         update = {"MRN": "MRN0000007", "STATUS": "INCLUDE"}
         response = client.post("/api/seedstatus", json=update)
         assert response.status_code == status.HTTP_200_OK
-        assert b"Successfully sent coupon " in response.data
+        assert b"Queued coupon " in response.data
         assert b"919-555-1212" in response.data
 
     def test_seed_report_filters(self, client):
@@ -134,6 +138,20 @@ class TestSeeds:
         records = response.json.get("records")
         assert len(records) == 9
 
+        # Test pagination returns the same records page by page
+        mrns = []
+        after = ""
+        while after is not None:
+            response = client.get(f"/api/seedreport?limit=4&count=y&after={after}")
+            assert response.status_code == status.HTTP_200_OK
+            assert response.json.get("total") == 9
+            page = response.json.get("records")
+            assert len(page) <= 4
+            assert all("_id" not in record for record in page)
+            mrns += [record["MRN"] for record in page]
+            after = response.json.get("next")
+        assert sorted(mrns) == sorted(record["MRN"] for record in records)
+
         # Test filter days
         response = client.get("/api/seedreport?date_range=3")
         assert response.status_code == status.HTTP_200_OK
@@ -170,3 +188,330 @@ class TestSeeds:
         records = response.json.get("records")
         assert len(records) == 1
         assert any(record["MRN"] == "MRN0000003" for record in records)
+
+    def test_uploadcsv_rejected_rows(self, client):
+        # remove all existing seeds first
+        db_utils.remove_collection("seeds")
+        file = "test-data/seeds_10.csv"
+        path = Path(__file__).parent.parent.absolute()
+        data = {"csv": open(path / file, "rb")}
+        response = client.post(
+            "/api/uploadcsv", content_type="multipart/form-data", data=data
+        )
+        assert response.status_code == status.HTTP_200_OK
+
+        # upload two existing seeds along with a new one
+        lines = open(path / file, "rb").read().splitlines()
+        new_seed = lines[3].replace(b"MRN0000003", b"MRN9999999", 1)
+        csv = b"\n".join([lines[0], lines[1], lines[2], new_seed])
+        data = {"csv": (BytesIO(csv), "seeds.csv")}
+        response = client.post(
+            "/api/uploadcsv", content_type="multipart/form-data", data=data
+        )
+        assert response.status_code == status.HTTP_200_OK
+        records = response.json.get("records")
+        assert records.get("totalLines") == 4
+        assert records.get("totalDataLinesInserted") == 1
+        assert records.get("rejectedLines") == 2
+        assert records.get("errors") == [
+            {"row": 1, "errorMsg": "Duplicate MRN"},
+            {"row": 2, "errorMsg": "Duplicate MRN"},
+        ]
+
+    def test_uploadcsv_mixed_offsets(self, app, client):
+        db_utils.remove_collection("seeds")
+        file = "test-data/seeds_10.csv"
+        path = Path(__file__).parent.parent.absolute()
+        lines = open(path / file, "rb").read().splitlines()[:5]
+        # offsets differ between rows, stored as utc
+        dates = [
+            b"2021-09-05T11:26:00+01:00",
+            b"2021-09-05T11:26:00-04:00",
+            b"9/5/21 11:26",
+            b"not a date",
+        ]
+        column = lines[0].split(b",").index(b"RESULT_DATE")
+        for row, result_date in enumerate(dates, 1):
+            fields = lines[row].split(b",")
+            fields[column] = result_date
+            lines[row] = b",".join(fields)
+        data = {"csv": (BytesIO(b"\n".join(lines)), "seeds.csv")}
+        response = client.post(
+            "/api/uploadcsv", content_type="multipart/form-data", data=data
+        )
+        assert response.status_code == status.HTTP_200_OK
+        records = response.json.get("records")
+        assert records.get("totalDataLinesInserted") == 3
+        assert [error["row"] for error in records.get("errors")] == [4]
+        with app.app_context():
+            seeds = db_utils.get_db_handle()[app.config["COLLECTIONS"]["seeds"]]
+            stored = {doc["_id"]: doc["RESULT_DATE"] for doc in seeds.find()}
+        assert stored == {
+            "MRN0000001": datetime(2021, 9, 5, 10, 26),
+            "MRN0000002": datetime(2021, 9, 5, 15, 26),
+            "MRN0000003": datetime(2021, 9, 5, 11, 26),
+        }
+
+    def test_seed_report_cache(self, app, client):
+        db_utils.remove_collection("seeds")
+        file = "test-data/seeds_10.csv"
+        path = Path(__file__).parent.parent.absolute()
+        data = {"csv": open(path / file, "rb")}
+        response = client.post(
+            "/api/uploadcsv", content_type="multipart/form-data", data=data
+        )
+        assert response.status_code == status.HTTP_200_OK
+        response = client.get("/api/seedreport?date_range=30000")
+        assert len(response.json.get("records")) == 10
+
+        # written behind the back of db_utils without changing the collection
+        # version, the cached report is served
+        with app.app_context():
+            seeds = db_utils.get_db_handle()[app.config["COLLECTIONS"]["seeds"]]
+            seeds.update_one({"_id": "MRN0000001"}, {"$set": {"STATUS": "DEFER"}})
+            assert utils.parse_date_range("1")["$gte"].second == 0
+        response = client.get("/api/seedreport?date_range=30000")
+        records = response.json.get("records")
+        assert len(records) == 10
+        assert "DEFER" not in {record["STATUS"] for record in records}
+
+        # a delete by another worker changes the version, not served from cache
+        with app.app_context():
+            seeds.delete_one({"_id": "MRN0000001"})
+        response = client.get("/api/seedreport?date_range=30000")
+        assert len(response.json.get("records")) == 9
+
+        # writes through db_utils invalidate the cached reports
+        update = {"MRN": "MRN0000002", "STATUS": "DEFER"}
+        response = client.post("/api/seedstatus", json=update)
+        assert response.status_code == status.HTTP_200_OK
+        response = client.get("/api/seedreport?date_range=30000")
+        records = response.json.get("records")
+        assert len(records) == 9
+        assert {"MRN": "MRN0000002", "STATUS": "DEFER"}.items() <= next(
+            record for record in records if record["MRN"] == "MRN0000002"
+        ).items()
+
+    def test_bulk_seed_status(self, app, client):
+        db_utils.remove_collection("seeds")
+        db_utils.remove_collection("participants")
+        db_utils.remove_collection("status_events")
+        file = "test-data/seeds_10.csv"
+        path = Path(__file__).parent.parent.absolute()
+        data = {"csv": open(path / file, "rb")}
+        response = client.post(
+            "/api/uploadcsv", content_type="multipart/form-data", data=data
+        )
+        assert response.status_code == status.HTTP_200_OK
+
+        updates = [
+            {"MRN": "MRN0000001", "STATUS": "INCLUDE"},
+            {"MRN": "MRN0000002", "STATUS": "DEFER"},
+            {"MRN": "MRN0000002", "STATUS": "EXCLUDE"},
+            {"MRN": "MRN0000003", "STATUS": "ELIGIBLE"},
+            {"MRN": "MRN0000004", "STATUS": "UNKNOWN"},
+            {"MRN": "MRN9999999", "STATUS": "DEFER"},
+            {"STATUS": "DEFER"},
+            # neither email nor mobile, the invitation fails, the actor is the
+            # signed in user
+            {"MRN": "MRN0000007", "STATUS": "INCLUDE", "ACTOR": "forged"},
+            {"MRN": "MRN0000009", "STATUS": "INCLUDE"},
+        ]
+        headers = {app.config["AUTH_USER_HEADER"]: "abc123"}
+        response = client.post("/api/bulkseedstatus", json=updates, headers=headers)
+        assert response.status_code == status.HTTP_200_OK
+        assert response.json.get("reason") == "Updated 4 of 9 seeds"
+        results = response.json.get("records")
+        assert [result["status_code"] for result in results] == [
+            200,
+            200,
+            422,
+            200,
+            422,
+            422,
+            422,
+            422,
+            200,
+        ]
+        assert results[0]["msg"].startswith("Queued coupon ")
+        assert results[0]["msg"].endswith("PAT_NAME0000001@duke.com")
+        assert results[1]["msg"] == "success"
+        assert results[2]["msg"] == "Duplicate MRN MRN0000002"
+        assert results[3]["msg"] == "No action taken, status not changed"
+        assert results[5]["msg"] == "Seed MRN9999999 not found"
+        assert results[6]["msg"] == "Missing MRN or STATUS"
+        assert "neither email nor cell number" in results[7]["msg"]
+
+        with app.app_context():
+            seeds = {
+                seed["MRN"]: seed
+                for seed in db_utils.get_seed_reports(
+                    ["MRN0000001", "MRN0000002", "MRN0000007"]
+                )
+            }
+            invited = db_utils.get_participant("MRN", "MRN0000001")
+            assert db_utils.get_participant("MRN", "MRN0000007") is None
+        assert seeds["MRN0000001"]["STATUS"] == "INCLUDE"
+        assert seeds["MRN0000002"]["STATUS"] == "DEFER"
+        # reverted
+        assert seeds["MRN0000007"]["STATUS"] == "EXCLUDE"
+        assert invited["COUPON"] in results[0]["msg"]
+
+        # status events, newest first
+        response = client.get("/api/statusevents?mrn=MRN0000007")
+        assert response.status_code == status.HTTP_200_OK
+        events = response.json.get("records")
+        assert [
+            (event["FROM_STATUS"], event["TO_STATUS"], event["ACTOR"])
+            for event in events
+        ] == [("INCLUDE", "EXCLUDE", "abc123"), ("EXCLUDE", "INCLUDE", "abc123")]
+        assert events[0]["REASON"] == "Failed to invite seed, revert status"
+        assert "REASON" not in events[1]
+        url = "/api/statusevents?mrn=MRN0000007&actor=abc123&date_range=1&limit=1"
+        response = client.get(url)
+        assert response.json.get("records") == events[:1]
+        response = client.get(f"{url}&after={response.json['next']}")
+        assert response.json.get("records") == events[1:]
+        assert response.json.get("next") is None
+        response = client.get("/api/statusevents?actor=forged")
+        assert response.json.get("records") is None
+        response = client.get("/api/statusevents?date_range=abc")
+        assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
+
+        response = client.post("/api/bulkseedstatus", json={"MRN": "MRN0000001"})
+        assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
+
+    def test_bulk_seed_status_revert(self, app, client, monkeypatch):
+        def fail(count):
+            raise RuntimeError("counter unavailable")
+
+        # the invitation fails after the status is saved
+        monkeypatch.setattr(db_utils, "reserve_record_ids", fail)
+        updates = [{"MRN": "MRN0000003", "STATUS": "INCLUDE"}]
+        response = client.post("/api/bulkseedstatus", json=updates)
+        assert response.status_code == status.HTTP_200_OK
+        result = response.json.get("records")[0]
+        assert result["status_code"] == status.HTTP_422_UNPROCESSABLE_ENTITY
+        assert result["msg"] == "Exception occurred: counter unavailable"
+        seed = db_utils.get_seed_reports(["MRN0000003"])[0]
+        assert seed["STATUS"] == "ELIGIBLE"
+        assert db_utils.get_participant("MRN", "MRN0000003") is None
+
+    def test_bulk_seed_status_not_saved(self, app, client, monkeypatch):
+        # the participant fails to insert with the _id of another one, which
+        # the revert must keep
+        existing = db_utils.get_participant("MRN", "MRN0000001")
+        monkeypatch.setattr(
+            db_utils, "reserve_record_ids", lambda count: [existing["RECORD_ID"]]
+        )
+        updates = [{"MRN": "MRN0000003", "STATUS": "INCLUDE"}]
+        response = client.post("/api/bulkseedstatus", json=updates)
+        result = response.json.get("records")[0]
+        assert result["status_code"] == status.HTTP_422_UNPROCESSABLE_ENTITY
+        assert db_utils.get_seed_reports(["MRN0000003"])[0]["STATUS"] == "ELIGIBLE"
+        assert db_utils.get_participant("MRN", "MRN0000001") == existing
+
+    def test_seed_status_event_pending(self, app, client, monkeypatch):
+        def fail(events):
+            raise errors.PyMongoError("events unavailable")
+
+        # the event is saved with the status and moved once the events are back
+        monkeypatch.setattr(db_utils, "_insert_status_events", fail)
+        update = {"MRN": "MRN0000004", "STATUS": "DEFER"}
+        headers = {app.config["AUTH_USER_HEADER"]: "abc123"}
+        response = client.post("/api/seedstatus", json=update, headers=headers)
+        assert response.status_code == status.HTTP_200_OK
+        seed = db_utils.get_seed_reports(["MRN0000004"])[0]
+        assert seed["STATUS"] == "DEFER"
+        assert len(seed[app.config["PENDING_STATUS_EVENTS"]]) == 1
+        monkeypatch.undo()
+
+        response = client.get("/api/statusevents?mrn=MRN0000004")
+        events = response.json.get("records")
+        assert [(e["TO_STATUS"], e["ACTOR"]) for e in events] == [("DEFER", "abc123")]
+        seed = db_utils.get_seed_reports(["MRN0000004"])[0]
+        assert seed[app.config["PENDING_STATUS_EVENTS"]] == []
+
+    def test_bulk_update_seeds(self, app, client):
+        db_utils.remove_collection("seeds")
+        file = "test-data/seeds_10.csv"
+        path = Path(__file__).parent.parent.absolute()
+        data = {"csv": open(path / file, "rb")}
+        response = client.post(
+            "/api/uploadcsv", content_type="multipart/form-data", data=data
+        )
+        assert response.status_code == status.HTTP_200_OK
+
+        updates = [
+            {"MRN": "MRN0000001", "MOBILE_NUM": "919-555-0001"},
+            {
+                "MRN": "MRN0000002",
+                "EMAIL_ADDRESS": "fixed@duketest.com",
+                "TEST_RESULT": "POSITIVE",
+            },
+            {"MRN": "MRN0000002", "MOBILE_NUM": "919-555-0002"},
+            {"MRN": "MRN0000003", "PAT_NAME": "John Smith"},
+            {"MRN": "MRN0000004", "MOBILE_NUM": 9195550004},
+            {"MRN": "MRN9999999", "MOBILE_NUM": "919-555-9999"},
+            {"MOBILE_NUM": "919-555-0000"},
+        ]
+        response = client.post("/api/bulkupdateseed", json=updates)
+        assert response.status_code == status.HTTP_200_OK
+        assert response.json.get("reason") == "Updated 3 of 7 seeds"
+        assert [result["msg"] for result in response.json.get("records")] == [
+            "MRN0000001: information successfully updated.",
+            "MRN0000002: information successfully updated.",
+            "Duplicate MRN MRN0000002",
+            "Nothing updated for MRN MRN0000003",
+            "MOBILE_NUM must be a string",
+            "Seed MRN9999999 not found",
+            "MRN is missing",
+        ]
+
+        with app.app_context():
+            seeds = {
+                seed["MRN"]: seed
+                for seed in db_utils.get_seed_reports(
+                    ["MRN0000001", "MRN0000002", "MRN0000004"]
+                )
+            }
+        assert seeds["MRN0000001"]["MOBILE_NUM"] == "919-555-0001"
+        assert seeds["MRN0000001"]["LOGS"].startswith(
+            "changed mobile to: 919-555-0001 at:"
+        )
+        assert seeds["MRN0000002"]["LOGS"].startswith(
+            "email address to: fixed@duketest.com; TEST_RESULT to: POSITIVE at:"
+        )
+        assert "UPDATED_AT" in seeds["MRN0000002"]
+        assert "LOGS" not in seeds["MRN0000004"]
+
+    def test_migrate_status_log(self, app, client):
+        log = [
+            "Changed STATUS to: DEFER at 2021-05-01 10:00:00.000000",
+            "Failed to invite seed, revert status",
+            "Changed STATUS to: INCLUDE at 2021-05-02 10:00:00.000000",
+            "Failed to invite seed, revert status",
+        ]
+        seeds = app.config["COLLECTIONS"]["seeds"]
+        db_utils.get_db_handle()[seeds].update_one(
+            {"MRN": "MRN0000006"}, {"$set": {app.config["STATUS_LOG"]: log}}
+        )
+        runner = app.test_cli_runner()
+        result = runner.invoke(args=["migrate-status-log", "--batch-size", "1"])
+        assert result.exit_code == 0
+        events, _ = db_utils.get_status_events({"MRN": "MRN0000006"})
+        assert len(events) == len(log)
+        # migrating again adds nothing
+        db_utils.get_db_handle()[seeds].update_one(
+            {"MRN": "MRN0000006"}, {"$set": {app.config["STATUS_LOG"]: log}}
+        )
+        result = runner.invoke(args=["migrate-status-log"])
+        assert result.exit_code == 0
+        assert db_utils.get_status_events({"MRN": "MRN0000006"})[0] == events
+
+        changed = [event for event in events if event.get("TO_STATUS") == "DEFER"]
+        assert changed[0][app.config["CHANGED_AT"]] == datetime(2021, 5, 1, 10)
+        # both reverts are kept
+        assert sum(event.get("REASON") == log[1] for event in events) == 2
+        seed = db_utils.get_seed_reports(["MRN0000006"])[0]
+        assert app.config["STATUS_LOG"] not in seed
@@ -0,0 +1,93 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from app import status
+from app.sendgrid_transport import SendGridTransport
+
+
+class SendGridStandIn(BaseHTTPRequestHandler):
+    # keep connections open like the real service does
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        self.server.requests.append(
+            {
+                "path": self.path,
+                "client": self.client_address,
+                "auth": self.headers["Authorization"],
+                "body": json.loads(body),
+            }
+        )
+        emails = [
+            p["to"][0]["email"] for p in json.loads(body).get("personalizations", [])
+        ]
+        # the stand-in rejects a request with any address outside the test domain
+        if any(not email.endswith("@duketest.com") for email in emails):
+            self.send_response(status.HTTP_400_BAD_REQUEST)
+        else:
+            self.send_response(status.HTTP_202_ACCEPTED)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def sendgrid_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), SendGridStandIn)
+    server.daemon_threads = True
+    server.block_on_close = False
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+class TestSendGridTransport:
+    def test_send_template_batches(self, sendgrid_server):
+        host = f"http://127.0.0.1:{sendgrid_server.server_port}"
+        transport = SendGridTransport("test-key", host, batch_size=2)
+        recipients = [
+            (f"peer{i}@duketest.com", {"coupon": f"Coupon-{i}"}) for i in range(3)
+        ]
+        status_codes = transport.send_template("study@duketest.com", "tid", recipients)
+        assert status_codes == [status.HTTP_202_ACCEPTED] * 3
+
+        requests = sendgrid_server.requests
+        assert len(requests) == 2
+        assert all(r["path"] == "/v3/mail/send" for r in requests)
+        assert all(r["auth"] == "Bearer test-key" for r in requests)
+        # one personalization per recipient with its own template data
+        personalizations = [p for r in requests for p in r["body"]["personalizations"]]
+        assert [p["to"][0]["email"] for p in personalizations] == [
+            r[0] for r in recipients
+        ]
+        assert [p["dynamic_template_data"] for p in personalizations] == [
+            r[1] for r in recipients
+        ]
+        assert requests[0]["body"]["template_id"] == "tid"
+        # both requests went through the same connection
+        assert requests[0]["client"] == requests[1]["client"]
+
+    def test_send_template_bad_recipient(self, sendgrid_server):
+        host = f"http://127.0.0.1:{sendgrid_server.server_port}"
+        transport = SendGridTransport("test-key", host)
+        recipients = [
+            (f"peer{i}@duketest.com", {"coupon": f"Coupon-{i}"}) for i in range(5)
+        ]
+        recipients[3] = ("peer3@invalid", {"coupon": "Coupon-3"})
+        status_codes = transport.send_template("study@duketest.com", "tid", recipients)
+        # the rejected batch is split until only the bad recipient fails
+        assert status_codes == [status.HTTP_202_ACCEPTED] * 3 + [
+            status.HTTP_400_BAD_REQUEST,
+            status.HTTP_202_ACCEPTED,
+        ]
+        # 5 rejected, 0-1 sent, 2-4 rejected, 2 sent, 3-4 rejected, 3 and 4
+        assert len(sendgrid_server.requests) == 7